@@ -2,18 +2,19 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 import os
-from sqlalchemy import inspect, text, event
-from sqlalchemy.pool import StaticPool
+import threading
+import click
 
-db = SQLAlchemy()
+from app.database import RoutingSession
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager()
 
-def create_app():
+def create_app(config=None):
     """Application factory function"""
     app = Flask(__name__)
     app.config['SECRET_KEY'] = 'your-secret-key-change-in-production'
     
-    # SQLite database configuration
     basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
     instance_path = os.path.join(basedir, 'instance')
     
@@ -25,176 +26,185 @@ def create_app():
         # Vercel's filesystem may not allow chmod, ignore
         pass
     
+    # Any SQLAlchemy URL; SQLite in the instance folder by default (see app/database.py)
     db_path = os.path.join(instance_path, 'store.db')
-    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}?timeout=10&check_same_thread=False'
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', f'sqlite:///{db_path}')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-        'connect_args': {
-            'timeout': 10,
-            'check_same_thread': False
-        }
-    }
-    
-    # Initialize database
+    # Connection pool per engine and process (SQLite files included, in-memory databases excepted)
+    app.config['DATABASE_POOL_SIZE'] = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+    app.config['DATABASE_MAX_OVERFLOW'] = int(os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+    app.config['DATABASE_POOL_TIMEOUT'] = int(os.environ.get('DATABASE_POOL_TIMEOUT', 30))
+    app.config['DATABASE_POOL_RECYCLE'] = int(os.environ.get('DATABASE_POOL_RECYCLE', 1800))
+    # Read replicas (comma-separated URLs) for views marked @use_replica; a browser that
+    # wrote reads from the primary for DATABASE_REPLICA_STICKY_SECONDS afterwards
+    app.config['DATABASE_REPLICA_URLS'] = os.environ.get('DATABASE_REPLICA_URLS', '')
+    app.config['DATABASE_REPLICA_STICKY_SECONDS'] = int(os.environ.get('DATABASE_REPLICA_STICKY_SECONDS', 5))
+    # SQLite write transactions start with BEGIN IMMEDIATE and are retried while the database
+    # is locked; a background thread checkpoints the WAL (see app/writes.py)
+    app.config['SQLITE_WRITE_COORDINATOR'] = os.environ.get('SQLITE_WRITE_COORDINATOR', '1') == '1'
+    app.config['SQLITE_WRITE_RETRIES'] = int(os.environ.get('SQLITE_WRITE_RETRIES', 5))
+    app.config['SQLITE_RETRY_BACKOFF'] = float(os.environ.get('SQLITE_RETRY_BACKOFF', 0.05))
+    app.config['SQLITE_CHECKPOINT_INTERVAL'] = int(os.environ.get('SQLITE_CHECKPOINT_INTERVAL', 30))
+    # Apply pending migrations at startup; set False where `flask upgrade-schema` runs on deploy
+    app.config['AUTO_MIGRATE'] = True
+    # 'production' skips all database bootstrap at startup (see gunicorn.conf.py)
+    app.config['STARTUP_MODE'] = os.environ.get('STARTUP_MODE', 'development')
+    # In production, import models and views on the first request instead of at startup
+    app.config['LAZY_SETUP'] = os.environ.get('LAZY_SETUP', '1') == '1'
+    # Read-through cache for catalog data: 'local' (in-process LRU), 'redis' or 'none'
+    app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'local')
+    app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+    app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 300))
+    # Serve anonymous catalog pages from the cache with ETags (see app/page_cache.py)
+    app.config['PAGE_CACHE'] = os.environ.get('PAGE_CACHE', '1') == '1'
+    # Background jobs (see app/jobs.py): 'thread' runs them in this process, 'worker'
+    # leaves them to `flask run-worker` processes
+    app.config['JOB_MODE'] = os.environ.get('JOB_MODE', 'thread')
+    app.config['JOB_THREADS'] = int(os.environ.get('JOB_THREADS', 2))
+    app.config['JOB_VISIBILITY_TIMEOUT'] = int(os.environ.get('JOB_VISIBILITY_TIMEOUT', 300))
+    # Bulk product imports may name images inside this folder (see app/imports.py)
+    app.config['IMPORT_IMAGES_FOLDER'] = os.environ.get('IMPORT_IMAGES_FOLDER', os.path.join(instance_path, 'import-images'))
+    # Outgoing email; without MAIL_SERVER messages are only logged (see app/mail.py)
+    app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER')
+    app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
+    app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')
+    app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
+    app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', '1') == '1'
+    app.config['MAIL_SENDER'] = os.environ.get('MAIL_SENDER', 'Wonderland Toy Store <noreply@wonderland.local>')
+    # Per-request timing, SQL counts and N+1 detection (see app/metrics.py); /metrics
+    # also accepts "Authorization: Bearer <METRICS_TOKEN>" for Prometheus scrapers
+    app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') == '1'
+    app.config['METRICS_N_PLUS_ONE_THRESHOLD'] = int(os.environ.get('METRICS_N_PLUS_ONE_THRESHOLD', 5))
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    app.config['METRICS_PROFILE_HEADER'] = 'X-Profile'
+    
+    # Allow callers (scripts, benchmarks) to point the app at another database
+    if config:
+        app.config.update(config)
+    
+    # Initialize database; engine options and replica binds follow the final URLs
+    from app import database
+    database.configure(app)
     db.init_app(app)
+    database.init_app(app, db)
     login_manager.init_app(app)
     login_manager.login_view = 'main.login'
     
+    from app.cache import cache
+    cache.init_app(app)
+    
+    from app import metrics
+    metrics.init_app(app)
+    
+    from app import writes
+    writes.init_app(app)
+    
+    if app.config['STARTUP_MODE'] != 'production':
+        setup_app(app)
+        bootstrap_database(app)
+        return app
+    
+    # Production: never change the database at startup (deploys run `flask upgrade-schema`)
+    # and give each forked worker its own connection pool
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=lambda: dispose_engines(app))
+    
+    # Defer importing models and views to the first request, unless the app is being
+    # preloaded into a forking server's master or loaded by the flask CLI
+    if app.config['LAZY_SETUP'] and click.get_current_context(silent=True) is None:
+        app.wsgi_app = DeferredSetup(app, app.wsgi_app)
+    else:
+        setup_app(app)
+    
+    return app
+
+def setup_app(app):
+    """Import models and views and register them on the app"""
     # User loader for flask-login
     from app.models import User
     @login_manager.user_loader
     def load_user(user_id):
         return User.query.get(int(user_id))
     
+    # {% cache %} fragment tag used by the catalog templates
+    from app.page_cache import FragmentCacheExtension
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    
+    # Responsive product images: srcset helper for templates/_images.html and the backfill command
+    from app.images import picture_sources, process_images_command
+    app.jinja_env.globals['picture_sources'] = picture_sources
+    app.cli.add_command(process_images_command)
+    
     # Register blueprints
     from app.routes import main_bp
     app.register_blueprint(main_bp)
     
-    # Create tables and seed data
+    # Sales rollups are maintained by mapper events registered on import
+    from app.rollups import rebuild_rollups_command
+    app.cli.add_command(rebuild_rollups_command)
+    
+    from app.inventory import release_reservations_command
+    app.cli.add_command(release_reservations_command)
+    
+    # Background jobs; importing the task modules registers their handlers
+    from app import mail
+    from app.jobs import run_worker_command, job_status_command
+    app.cli.add_command(run_worker_command)
+    app.cli.add_command(job_status_command)
+    
+    from app.imports import import_products_command
+    app.cli.add_command(import_products_command)
+    
+    from app.migrations import upgrade_schema_command, schema_version_command
+    app.cli.add_command(upgrade_schema_command)
+    app.cli.add_command(schema_version_command)
+    
+    from app.query_plans import explain_queries_command
+    app.cli.add_command(explain_queries_command)
+
+def bootstrap_database(app):
+    """Bring the database schema up to date (development startup)"""
+    from app.migrations import schema_version, upgrade_schema, LATEST_VERSION
     try:
         with app.app_context():
-            # Enable WAL mode for SQLite for better concurrency
-            @event.listens_for(db.engine, 'connect')
-            def set_sqlite_pragma(dbapi_conn, connection_record):
-                if 'sqlite' in str(db.engine.url):
-                    cursor = dbapi_conn.cursor()
-                    cursor.execute('PRAGMA journal_mode=WAL')
-                    cursor.execute('PRAGMA synchronous=NORMAL')
-                    cursor.execute('PRAGMA cache_size=-64000')
-                    cursor.execute('PRAGMA foreign_keys=ON')
-                    cursor.close()
-            
-            db.create_all()
+            # A single version check; pending migrations run once per database
+            version = schema_version()
+            if version < LATEST_VERSION:
+                if app.config['AUTO_MIGRATE']:
+                    upgrade_schema()
+                else:
+                    print(f"Note: Database schema is at version {version} of {LATEST_VERSION}; run 'flask upgrade-schema'")
             
-            # Ensure database file has proper permissions
-            db_path = os.path.join(instance_path, 'store.db')
-            if os.path.exists(db_path):
+            # Ensure an SQLite database file has proper permissions
+            db_path = db.engine.url.database
+            if db.engine.dialect.name == 'sqlite' and db_path and os.path.exists(db_path):
                 try:
                     os.chmod(db_path, 0o666)
                 except (OSError, PermissionError):
                     # Vercel's filesystem may not allow chmod, ignore
                     pass
-            
-            # Add category_id column to products table if it doesn't exist
-            try:
-                inspector = inspect(db.engine)
-                products_columns = [col['name'] for col in inspector.get_columns('products')]
-                orders_columns = [col['name'] for col in inspector.get_columns('orders')]
-            except Exception as e:
-                # Tables might not exist yet, create them and retry
-                db.create_all()
-                inspector = inspect(db.engine)
-                try:
-                    products_columns = [col['name'] for col in inspector.get_columns('products')]
-                except:
-                    products_columns = []
-                try:
-                    orders_columns = [col['name'] for col in inspector.get_columns('orders')]
-                except:
-                    orders_columns = []
-            
-            # Helper function to refresh column list
-            def refresh_columns():
-                nonlocal products_columns, orders_columns
-                try:
-                    inspector = inspect(db.engine)
-                    products_columns = [col['name'] for col in inspector.get_columns('products')]
-                except:
-                    pass
-                try:
-                    inspector = inspect(db.engine)
-                    orders_columns = [col['name'] for col in inspector.get_columns('orders')]
-                except:
-                    pass
-            
-            if 'category_id' not in products_columns:
-                try:
-                    with db.engine.connect() as connection:
-                        connection.execute(text('ALTER TABLE products ADD COLUMN category_id INTEGER'))
-                        connection.commit()
-                    refresh_columns()
-                except:
-                    pass
-            
-            # Add image_filename column to products table if it doesn't exist
-            if 'image_filename' not in products_columns:
-                try:
-                    with db.engine.connect() as connection:
-                        connection.execute(text('ALTER TABLE products ADD COLUMN image_filename VARCHAR(255)'))
-                        connection.commit()
-                    refresh_columns()
-                except:
-                    pass
-            
-            # Add shipping and payment columns to orders table if they don't exist
-            order_columns_to_add = [
-                ('full_name', 'VARCHAR(200)'),
-                ('email', 'VARCHAR(120)'),
-                ('phone', 'VARCHAR(20)'),
-                ('shipping_address', 'TEXT'),
-                ('city', 'VARCHAR(100)'),
-                ('state', 'VARCHAR(100)'),
-                ('postal_code', 'VARCHAR(20)'),
-                ('payment_method', "VARCHAR(50) DEFAULT 'cash_on_delivery'"),
-                ('payment_status', "VARCHAR(20) DEFAULT 'pending'"),
-                ('transaction_id', 'VARCHAR(100)'),
-                ('promo_code', 'VARCHAR(50)'),
-                ('discount_percentage', 'FLOAT DEFAULT 0'),
-                ('discount_amount', 'FLOAT DEFAULT 0'),
-                ('tracking_number', 'VARCHAR(100)'),
-            ]
-            
-            for column_name, column_type in order_columns_to_add:
-                if column_name not in orders_columns:
-                    try:
-                        with db.engine.connect() as connection:
-                            connection.execute(text(f'ALTER TABLE orders ADD COLUMN {column_name} {column_type}'))
-                            connection.commit()
-                        refresh_columns()
-                        print(f"✓ Added column '{column_name}' to orders table")
-                    except Exception as e:
-                        # Column might already exist or other error - continue
-                        print(f"Note: Could not add column '{column_name}' to orders: {str(e)[:100]}")
-        
-        # Fix any empty string datetime values in users table
-        with db.engine.connect() as connection:
-            try:
-                connection.execute(text("UPDATE users SET reset_token_expires = NULL WHERE reset_token_expires = ''"))
-                connection.commit()
-            except:
-                pass  # If the operation fails, it's okay
-        
-        # Seed database with initial data if empty
-        from app.models import Product, Category
-        
-        # Create categories if they don't exist
-        if Category.query.first() is None:
-            categories_data = [
-                {'name': 'Lego', 'description': 'Building blocks and construction sets'},
-                {'name': 'Plush toys', 'description': 'Soft and cuddly plush toys'},
-                {'name': 'Board games', 'description': 'Family and strategy board games'},
-                {'name': 'Arts and Crafts', 'description': 'Creative art and craft supplies'},
-                {'name': 'Hotwheels', 'description': 'Die-cast model cars'},
-            ]
-            for cat_data in categories_data:
-                category = Category(name=cat_data['name'], description=cat_data['description'])
-                db.session.add(category)
-            db.session.commit()
-        
-        if Product.query.first() is None:
-            lego_cat = Category.query.filter_by(name='Lego').first()
-            products = [
-                Product(name='Teddy Bear', price=19.99, description='Cute and cuddly teddy bear', stock=50, category_id=None),
-                Product(name='Building Blocks', price=29.99, description='Colorful building blocks set', stock=35, category_id=lego_cat.id if lego_cat else None),
-                Product(name='Action Figure', price=24.99, description='Superhero action figure', stock=40, category_id=None),
-                Product(name='Doll House', price=49.99, description='Beautiful dollhouse with furniture', stock=20, category_id=None),
-                Product(name='Board Game', price=34.99, description='Fun family board game', stock=30, category_id=None),
-            ]
-            for product in products:
-                db.session.add(product)
-            db.session.commit()
     except Exception as e:
         print(f"Warning: Database initialization failed (may be normal on Vercel): {e}")
         # Continue anyway - the app can still serve requests
+
+def dispose_engines(app):
+    """Drop pooled connections inherited from the parent process after a fork"""
+    with app.app_context():
+        for engine in db.engines.values():
+            # close=False leaves the parent's connections alone; the child just stops using them
+            engine.dispose(close=False)
+
+class DeferredSetup:
+    """WSGI middleware running setup_app() once, before the first request is handled"""
     
-    return app
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.lock = threading.Lock()
+    
+    def __call__(self, environ, start_response):
+        with self.lock:
+            if self.app.wsgi_app is self:
+                setup_app(self.app)
+                self.app.wsgi_app = self.wsgi_app
+        return self.wsgi_app(environ, start_response)
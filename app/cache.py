@@ -0,0 +1,312 @@
+"""Read-through cache for catalog data
+
+Data that changes only when an admin edits the catalog (the category list,
+featured products, category summaries, facet counts) is read through
+``cache.get_or_load(namespace, key, loader)``: the loader runs on a miss and
+its result is stored for ``CACHE_TTL`` seconds. Values must be plain,
+picklable data; ``model_rows()`` / ``merge_rows()`` turn ORM objects into
+column dicts and back into session-attached objects without a query.
+
+``invalidate_on(Model, *namespaces)`` registers mapper events so that a
+committed insert, update or delete of that model drops the namespaces; writes
+that bypass the ORM call ``mark_cache_dirty()`` themselves. Invalidation
+happens on ``after_commit`` and is discarded on rollback.
+
+Namespaces holding one entry per user (the dashboard stats of
+app/user_stats.py) drop single keys with ``cache.invalidate_keys()``.
+
+Backends (``CACHE_BACKEND`` config):
+  'local'  in-process LRU with per-entry expiry (default)
+  'redis'  a Redis server at ``CACHE_REDIS_URL``, shared by all workers
+  'none'   no caching
+``CACHE_BACKEND`` may also be a backend instance, e.g. ``RedisCache(FakeRedis())``.
+"""
+import pickle
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session, make_transient_to_detached
+
+from app import db
+from app.database import primary
+
+CACHE_TTL = 300
+CACHE_MAX_ENTRIES = 1024
+
+_MISSING = object()
+
+
+class LocalCache:
+    """In-process LRU cache with per-entry expiry"""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, namespace, key):
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is None:
+                return _MISSING
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self._entries[(namespace, key)]
+                return _MISSING
+            self._entries.move_to_end((namespace, key))
+            return value
+
+    def set(self, namespace, key, value, ttl):
+        with self._lock:
+            self._entries[(namespace, key)] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._entries.pop((namespace, key), None)
+
+    def clear(self, namespace):
+        with self._lock:
+            for entry_key in [entry_key for entry_key in self._entries if entry_key[0] == namespace]:
+                del self._entries[entry_key]
+
+
+class RedisCache:
+    """Cache stored in Redis, one hash per namespace
+
+    Clearing a namespace is a single DEL. Redis hash fields cannot expire on
+    their own, so each value is stored with its expiry time.
+    """
+
+    def __init__(self, client, prefix='wonderland:cache:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, namespace, key):
+        raw = self.client.hget(self.prefix + namespace, key)
+        if raw is None:
+            return _MISSING
+        expires, value = pickle.loads(raw)
+        return value if expires > time.time() else _MISSING
+
+    def set(self, namespace, key, value, ttl):
+        raw = pickle.dumps((time.time() + ttl, value), protocol=pickle.HIGHEST_PROTOCOL)
+        pipe = self.client.pipeline()
+        pipe.hset(self.prefix + namespace, key, raw)
+        pipe.expire(self.prefix + namespace, ttl)
+        pipe.execute()
+
+    def delete(self, namespace, key):
+        self.client.hdel(self.prefix + namespace, key)
+
+    def clear(self, namespace):
+        self.client.delete(self.prefix + namespace)
+
+
+class FakeRedis:
+    """In-memory stand-in for the redis client commands RedisCache uses"""
+
+    def __init__(self):
+        self.hashes = {}
+        self.expiry = {}
+
+    def _live(self, name):
+        if name in self.expiry and self.expiry[name] <= time.time():
+            self.delete(name)
+        return self.hashes.get(name)
+
+    def hget(self, name, key):
+        fields = self._live(name)
+        return fields.get(key) if fields else None
+
+    def hset(self, name, key, value):
+        self._live(name)
+        self.hashes.setdefault(name, {})[key] = value
+
+    def hdel(self, name, key):
+        fields = self._live(name)
+        if fields:
+            fields.pop(key, None)
+
+    def expire(self, name, seconds):
+        if name in self.hashes:
+            self.expiry[name] = time.time() + seconds
+
+    def delete(self, name):
+        self.hashes.pop(name, None)
+        self.expiry.pop(name, None)
+
+    def pipeline(self):
+        return _FakePipeline(self)
+
+
+class _FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((name, args))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args) for name, args in self.commands]
+
+
+class NullCache:
+    """Backend that never stores anything"""
+
+    def get(self, namespace, key):
+        return _MISSING
+
+    def set(self, namespace, key, value, ttl):
+        pass
+
+    def delete(self, namespace, key):
+        pass
+
+    def clear(self, namespace):
+        pass
+
+
+def create_backend(app):
+    """Build the cache backend selected by the app config"""
+    backend = app.config.get('CACHE_BACKEND', 'local')
+    if not isinstance(backend, str):
+        return backend
+    if backend == 'local':
+        return LocalCache(app.config.get('CACHE_MAX_ENTRIES', CACHE_MAX_ENTRIES))
+    if backend == 'redis':
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("CACHE_BACKEND='redis' requires the redis package") from e
+        return RedisCache(redis.Redis.from_url(app.config['CACHE_REDIS_URL']))
+    if backend == 'none':
+        return NullCache()
+    raise ValueError(f'Unknown CACHE_BACKEND: {backend!r}')
+
+
+class ReadThroughCache:
+    """Namespaced read-through cache with hit/miss counters, bound to the current app"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {'hits': 0, 'misses': 0, 'invalidations': 0})
+        # Bumped on every invalidation so a load racing with a write is not stored
+        self._generations = defaultdict(int)
+
+    def init_app(self, app):
+        app.extensions['cache'] = create_backend(app)
+
+    @property
+    def backend(self):
+        return current_app.extensions['cache']
+
+    def get_or_load(self, namespace, key, loader, ttl=None):
+        """Return the cached value for key, calling loader() to fill it on a miss"""
+        backend = self.backend
+        value = backend.get(namespace, key)
+        with self._lock:
+            stats = self._stats[namespace]
+            if value is not _MISSING:
+                stats['hits'] += 1
+                return value
+            stats['misses'] += 1
+            generation = self._generations[namespace]
+
+        # Never from a lagging replica: the value outlives the request
+        with primary():
+            value = loader()
+        with self._lock:
+            if self._generations[namespace] == generation:
+                backend.set(namespace, key, value, ttl or current_app.config.get('CACHE_TTL', CACHE_TTL))
+        return value
+
+    def invalidate(self, *namespaces):
+        """Drop every cached value in the given namespaces"""
+        backend = self.backend
+        with self._lock:
+            for namespace in namespaces:
+                self._generations[namespace] += 1
+                self._stats[namespace]['invalidations'] += 1
+                backend.clear(namespace)
+
+    def invalidate_keys(self, namespace, *keys):
+        """Drop the cached values of some keys of a namespace"""
+        backend = self.backend
+        with self._lock:
+            self._generations[namespace] += 1
+            self._stats[namespace]['invalidations'] += 1
+            for key in keys:
+                backend.delete(namespace, key)
+
+    def stats(self):
+        """Hit, miss and invalidation counts per namespace, with hit ratios"""
+        with self._lock:
+            stats = {namespace: dict(counts) for namespace, counts in self._stats.items()}
+        for counts in stats.values():
+            lookups = counts['hits'] + counts['misses']
+            counts['hit_ratio'] = round(counts['hits'] / lookups, 3) if lookups else None
+        return stats
+
+
+cache = ReadThroughCache()
+
+
+def model_rows(objects):
+    """Column values of ORM objects as plain dicts, suitable for caching"""
+    return [{attr.key: getattr(obj, attr.key) for attr in db.inspect(obj).mapper.column_attrs}
+            for obj in objects]
+
+
+def merge_rows(model, rows):
+    """Attach cached column dicts to the session as model instances, without querying
+
+    Objects already in the session are returned as they are.
+    """
+    session = db.session()
+    mapper = db.inspect(model)
+    objects = []
+    for row in rows:
+        identity = mapper.identity_key_from_primary_key([row[column.key] for column in mapper.primary_key])
+        obj = session.identity_map.get(identity)
+        if obj is None:
+            obj = model(**row)
+            make_transient_to_detached(obj)
+            obj = session.merge(obj, load=False)
+        objects.append(obj)
+    return objects
+
+
+def mark_cache_dirty(session, *namespaces):
+    """Invalidate the namespaces once the session's transaction commits"""
+    session.info.setdefault('cache_dirty', set()).update(namespaces)
+
+
+def invalidate_on(model, *namespaces):
+    """Invalidate the namespaces after every committed write to model"""
+
+    def mark_dirty(mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            mark_cache_dirty(session, *namespaces)
+
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, event_name, mark_dirty)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    namespaces = session.info.pop('cache_dirty', None)
+    if namespaces and has_app_context() and 'cache' in current_app.extensions:
+        cache.invalidate(*namespaces)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('cache_dirty', None)
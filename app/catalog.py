@@ -0,0 +1,278 @@
+"""Catalog listing helpers for Wonderland Toy Store
+
+Products are listed in one of CATALOG_SORTS (newest first by default) and
+paginated with keyset (seek) pagination on the sort key, optionally scoped to
+a category and narrowed by CatalogFilters (price bucket, in stock, featured).
+The position in the listing is carried between requests as an opaque
+``cursor`` so that every page is served straight from the composite indexes
+on ``Product``, no matter how deep into the catalog it is.
+
+Category grids read per-category aggregates from ``category_summaries()``
+(one grouped query) or the denormalized ``Category.product_count`` column
+instead of loading each category's products.
+
+The category list, category summaries and featured products are read through
+the cache (app/cache.py) and dropped whenever a Product or Category write
+commits.
+"""
+import base64
+import json
+from datetime import datetime
+
+from app import db
+from app.cache import cache, invalidate_on, mark_cache_dirty, model_rows, merge_rows
+from app.images import image_urls
+from app.models import Product, Category
+
+# Number of products shown per catalog page
+CATALOG_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+# Price buckets offered as a filter: key -> (label, lower bound inclusive, upper bound exclusive)
+PRICE_BUCKETS = {
+    'under-10': ('Under $10', None, 10),
+    '10-25': ('$10 – $25', 10, 25),
+    '25-50': ('$25 – $50', 25, 50),
+    '50-100': ('$50 – $100', 50, 100),
+    '100-plus': ('$100 & above', 100, None),
+}
+
+
+class CatalogSort:
+    """A listing order; every key ends with a unique column (Product.id here) and runs in one direction"""
+
+    def __init__(self, label, columns, descending):
+        self.label = label
+        self.columns = columns
+        self.descending = descending
+
+    def order_by(self):
+        return [column.desc() if self.descending else column.asc() for column in self.columns]
+
+    def after(self, values):
+        """Condition selecting the rows that follow the given sort key values"""
+        key = db.tuple_(*self.columns)
+        return key < tuple(values) if self.descending else key > tuple(values)
+
+
+CATALOG_SORTS = {
+    'newest': CatalogSort('Newest', (Product.created_at, Product.id), True),
+    'featured': CatalogSort('Featured first', (Product.is_featured, Product.created_at, Product.id), True),
+    'price_asc': CatalogSort('Price: Low to High', (Product.price, Product.id), False),
+    'price_desc': CatalogSort('Price: High to Low', (Product.price, Product.id), True),
+}
+DEFAULT_SORT = 'newest'
+
+
+class CatalogFilters:
+    """Filters applied to a catalog listing"""
+
+    def __init__(self, category_id=None, price=None, in_stock=False, featured=False):
+        self.category_id = category_id
+        self.price = price if price in PRICE_BUCKETS else None
+        self.in_stock = in_stock
+        self.featured = featured
+
+    @classmethod
+    def from_args(cls, args, category_id=None):
+        """Read filters from request query arguments"""
+        return cls(
+            category_id=category_id,
+            price=args.get('price'),
+            in_stock=args.get('in_stock') == '1',
+            featured=args.get('featured') == '1',
+        )
+
+    def criteria(self, exclude=()):
+        """SQL conditions for the active filters, leaving out the named ones"""
+        criteria = []
+        if self.category_id is not None and 'category' not in exclude:
+            criteria.append(Product.category_id == self.category_id)
+        if self.price is not None and 'price' not in exclude:
+            _, low, high = PRICE_BUCKETS[self.price]
+            if low is not None:
+                criteria.append(Product.price >= low)
+            if high is not None:
+                criteria.append(Product.price < high)
+        if self.in_stock and 'in_stock' not in exclude:
+            criteria.append(Product.stock > 0)
+        if self.featured and 'featured' not in exclude:
+            criteria.append(Product.is_featured.is_(True))
+        return criteria
+
+    def query_args(self, **changes):
+        """Query arguments reproducing these filters (category excluded), with optional changes"""
+        args = {'price': self.price, 'in_stock': '1' if self.in_stock else None, 'featured': '1' if self.featured else None}
+        args.update(changes)
+        return {name: value for name, value in args.items() if value is not None}
+
+    @property
+    def active(self):
+        return bool(self.price or self.in_stock or self.featured)
+
+
+class CategorySummary:
+    """A category together with aggregates over its products"""
+
+    def __init__(self, category, product_count, min_price, max_price):
+        self.id = category.id
+        self.name = category.name
+        self.description = category.description
+        self.product_count = product_count
+        self.min_price = min_price
+        self.max_price = max_price
+
+
+class CatalogPage:
+    """One page of catalog results"""
+
+    def __init__(self, products, next_cursor):
+        self.products = products
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def encode_key(values):
+    """Encode sort key values as an opaque, URL-safe cursor"""
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    raw = json.dumps(values, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_key(cursor, columns):
+    """Decode a cursor made by encode_key into values for the given sort key columns
+
+    Raises ValueError if the cursor is malformed or has the wrong number of values.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError('wrong number of values')
+        decoded = []
+        for column, value in zip(columns, values):
+            python_type = column.type.python_type
+            if value is None and column.nullable:
+                decoded.append(None)
+            elif python_type is datetime:
+                decoded.append(datetime.fromisoformat(value))
+            elif python_type is bool:
+                decoded.append(bool(value))
+            else:
+                decoded.append(python_type(value))
+        return tuple(decoded)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from e
+
+
+def encode_cursor(product, sort=DEFAULT_SORT):
+    """Encode the position just after a product in a listing order as an opaque cursor"""
+    return encode_key([getattr(product, column.key) for column in CATALOG_SORTS[sort].columns])
+
+
+def decode_cursor(cursor, sort=DEFAULT_SORT):
+    """Decode a cursor into the sort key values of a listing order
+
+    Raises ValueError if the cursor is malformed or belongs to another order.
+    """
+    return decode_key(cursor, CATALOG_SORTS[sort].columns)
+
+
+def paginate_products(category_id=None, cursor=None, per_page=CATALOG_PAGE_SIZE, sort=DEFAULT_SORT, filters=None):
+    """Return a CatalogPage of products in the given order
+
+    Only the rows of the requested page (plus one to detect a following page)
+    are read, so the cost of a page does not depend on its depth.
+    """
+    per_page = max(1, min(per_page, MAX_PAGE_SIZE))
+    order = CATALOG_SORTS[sort]
+
+    query = Product.query
+    if category_id is not None:
+        query = query.filter(Product.category_id == category_id)
+    if filters is not None:
+        query = query.filter(*filters.criteria())
+    if cursor:
+        query = query.filter(order.after(decode_cursor(cursor, sort)))
+
+    rows = query.order_by(*order.order_by()).limit(per_page + 1).all()
+
+    products = rows[:per_page]
+    next_cursor = encode_cursor(products[-1], sort) if len(rows) > per_page else None
+    return CatalogPage(products, next_cursor)
+
+
+def serialize_product(product):
+    """Serialize a product for the catalog JSON API"""
+    return {
+        'id': product.id,
+        'name': product.name,
+        'price': product.price,
+        'description': product.description,
+        'stock': product.stock,
+        'category_id': product.category_id,
+        'image_filename': product.image_filename,
+        'images': image_urls(product),
+        'is_featured': product.is_featured,
+        'created_at': product.created_at.isoformat() if product.created_at else None,
+    }
+
+
+def cached_categories():
+    """Return every category, ordered by id, from the cache"""
+    rows = cache.get_or_load('categories', 'all', lambda: model_rows(Category.query.order_by(Category.id).all()))
+    return merge_rows(Category, rows)
+
+
+def cached_category(category_id):
+    """Return the category with the given id from the cache, or None"""
+    return next((category for category in cached_categories() if category.id == category_id), None)
+
+
+def cached_featured_products():
+    """Return the featured products from the cache"""
+    # Attach the categories first so product.category resolves without a query
+    cached_categories()
+    rows = cache.get_or_load('products', 'featured', lambda: model_rows(
+        Product.query.filter_by(is_featured=True).order_by(Product.id).all()))
+    return merge_rows(Product, rows)
+
+
+def category_summaries():
+    """Return a CategorySummary for every category, from the cache or one GROUP BY query"""
+    return cache.get_or_load('categories', 'summaries', _load_category_summaries)
+
+
+def _load_category_summaries():
+    rows = db.session.query(
+        Category,
+        db.func.count(Product.id),
+        db.func.min(Product.price),
+        db.func.max(Product.price)
+    ).outerjoin(Product, Product.category_id == Category.id) \
+        .group_by(Category.id) \
+        .order_by(Category.id) \
+        .all()
+    return [CategorySummary(*row) for row in rows]
+
+
+def refresh_category_counts():
+    """Recompute Category.product_count for every category
+
+    Needed after writes that bypass the ORM events, such as bulk inserts.
+    """
+    product_count = db.select(db.func.count(Product.id)) \
+        .where(Product.category_id == Category.id) \
+        .scalar_subquery()
+    db.session.execute(db.update(Category).values(product_count=product_count))
+    # Category counts appear in cached pages and fragments too (see app/page_cache.py)
+    mark_cache_dirty(db.session, 'categories', 'catalog', 'pages', 'fragments')
+    db.session.commit()
+
+
+# Product writes change category counts and price ranges as well as product data
+invalidate_on(Category, 'categories', 'products')
+invalidate_on(Product, 'categories', 'products')
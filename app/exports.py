@@ -0,0 +1,182 @@
+"""Streaming CSV/JSONL exports of orders, users and products for admins
+
+An export is written to the response as it is read, one batch of
+EXPORT_BATCH_SIZE rows at a time, so memory stays flat however many rows
+match. Only plain columns are selected (no ORM objects or identity map).
+
+Reading strategy depends on the database:
+  SQLite    keyset batches on the primary key, each on its own short-lived
+            connection, so no read snapshot outlives one batch and the WAL can
+            be checkpointed while a long export runs. Rows inserted meanwhile
+            are excluded, but a row updated between batches is exported as it
+            was when its batch was read.
+  others    a single query on a server-side cursor (``yield_per``)
+"""
+import csv
+import io
+import json
+from datetime import date, datetime, timedelta
+
+from app import db
+from app.admin_reports import ORDER_COUNT, LIFETIME_SPEND, ORDER_STATUSES
+from app.models import User, Product, Category, Order, OrderLine
+
+EXPORT_BATCH_SIZE = 2000
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+ITEM_COUNT = db.select(db.func.coalesce(db.func.sum(OrderLine.quantity), 0)) \
+    .where(OrderLine.order_id == Order.id).correlate(Order).scalar_subquery().label('items')
+
+
+class ExportError(ValueError):
+    """Raised for an unknown export or an invalid filter value"""
+
+
+class Export:
+    """One exportable table: its columns and how its status filter applies"""
+
+    def __init__(self, model, columns, statuses, status_filter, joins=()):
+        self.model = model
+        self.columns = columns
+        self.statuses = statuses
+        self.status_filter = status_filter
+        self.joins = joins
+
+    @property
+    def fields(self):
+        return [column.key for column in self.columns]
+
+    def select(self, start=None, end=None, statuses=None):
+        query = db.select(*self.columns).select_from(self.model)
+        for target, onclause in self.joins:
+            query = query.outerjoin(target, onclause)
+        if start:
+            query = query.where(self.model.created_at >= start)
+        if end:
+            query = query.where(self.model.created_at < end)
+        if statuses:
+            query = query.where(self.status_filter(statuses))
+        return query
+
+
+def _product_status(statuses):
+    conditions = {'in_stock': Product.stock > 0, 'out_of_stock': db.func.coalesce(Product.stock, 0) <= 0,
+                  'featured': Product.is_featured.is_(True)}
+    return db.or_(*(conditions[status] for status in statuses))
+
+
+EXPORTS = {
+    'orders': Export(
+        Order,
+        [Order.id, Order.created_at, Order.user_id, Order.status, Order.payment_method, Order.payment_status,
+         Order.total_price, Order.discount_amount, Order.promo_code, ITEM_COUNT, Order.full_name, Order.email,
+         Order.city, Order.state, Order.postal_code, Order.tracking_number],
+        ORDER_STATUSES,
+        lambda statuses: Order.status.in_(statuses),
+    ),
+    # Never password hashes or reset tokens
+    'users': Export(
+        User,
+        [User.id, User.created_at, User.username, User.email, User.is_admin, ORDER_COUNT, LIFETIME_SPEND],
+        ('admin', 'customer'),
+        lambda statuses: User.is_admin.in_([status == 'admin' for status in statuses]),
+    ),
+    'products': Export(
+        Product,
+        [Product.id, Product.created_at, Product.name, Category.name.label('category'), Product.price,
+         Product.stock, Product.is_featured, Product.image_filename],
+        ('in_stock', 'out_of_stock', 'featured'),
+        _product_status,
+        joins=[(Category, Category.id == Product.category_id)],
+    ),
+}
+
+
+def _parse_date(value, name):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ExportError(f'{name} must be a date (YYYY-MM-DD)')
+
+
+def export_query(name, start=None, end=None, status=None):
+    """Build the export and its SELECT from request arguments
+
+    start and end are inclusive YYYY-MM-DD dates on created_at; status is a
+    comma-separated list of the export's statuses.
+    """
+    export = EXPORTS.get(name)
+    if export is None:
+        raise ExportError(f'Unknown export: {name}')
+    start = _parse_date(start, 'start') if start else None
+    end = _parse_date(end, 'end') + timedelta(days=1) if end else None
+    statuses = [value.strip() for value in status.split(',') if value.strip()] if status else []
+    unknown = [value for value in statuses if value not in export.statuses]
+    if unknown:
+        raise ExportError(f"Unknown {name} status: {', '.join(unknown)} (expected {', '.join(export.statuses)})")
+    return export, export.select(start, end, statuses)
+
+
+def iter_batches(export, query, batch_size=EXPORT_BATCH_SIZE):
+    """Yield lists of rows of an export query, ordered by primary key"""
+    key = export.model.id
+    query = query.order_by(key)
+    engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        with engine.connect() as connection:
+            result = connection.execution_options(yield_per=batch_size).execute(query)
+            for partition in result.partitions():
+                yield partition
+        return
+
+    # Rows added after the export started are left out, as they would be from a single snapshot
+    with engine.connect() as connection:
+        max_id = connection.execute(db.select(db.func.max(key))).scalar()
+    if max_id is None:
+        return
+    query = query.where(key <= max_id)
+    last_id = None
+    while True:
+        batch_query = query if last_id is None else query.where(key > last_id)
+        with engine.connect() as connection:
+            rows = connection.execute(batch_query.limit(batch_size)).all()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1].id
+
+
+def _value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def stream_csv(fields, batches):
+    """Yield CSV text: a header line, then one chunk per batch"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    yield buffer.getvalue()
+    for rows in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([_value(value) for value in row] for row in rows)
+        yield buffer.getvalue()
+
+
+def stream_jsonl(fields, batches):
+    """Yield one JSON object per line, one chunk per batch"""
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(fields, map(_value, row)))) + '\n' for row in rows)
+
+
+STREAMERS = {
+    'csv': stream_csv,
+    'jsonl': stream_jsonl,
+}
@@ -0,0 +1,96 @@
+"""Facet counts for catalog filters
+
+Facet counts are derived from a small "cube": the number of products for
+every combination of category, price bucket, in-stock flag and featured flag,
+read with one GROUP BY over a covering index. The cube does not depend on
+the filters being viewed, so one cached copy answers every filter
+combination: each facet counts the cube rows that pass all the *other*
+active filters, which is what the count next to a filter option means.
+
+The cube is kept in the "facets" namespace of the read-through cache
+(app/cache.py). It is dropped after any committed Product write (and after
+stock changes that take a product in or out of stock), and also expires
+after FACET_CACHE_TTL seconds so stock changes made by other workers are
+picked up.
+"""
+from collections import defaultdict
+
+from app import db
+from app.cache import cache, invalidate_on, mark_cache_dirty
+from app.catalog import PRICE_BUCKETS
+from app.models import Product
+
+FACET_CACHE_TTL = 60
+
+
+class FacetCounts:
+    """Product counts for each option of each catalog filter"""
+
+    def __init__(self, total, categories, prices, in_stock, featured):
+        self.total = total
+        self.categories = categories
+        self.prices = prices
+        self.in_stock = in_stock
+        self.featured = featured
+
+
+def _price_bucket():
+    """SQL expression giving the PRICE_BUCKETS key of a product"""
+    keys = list(PRICE_BUCKETS)
+    whens = [(Product.price < high, key) for key, (_, _, high) in PRICE_BUCKETS.items() if high is not None]
+    return db.case(*whens, else_=keys[-1])
+
+
+def _load_cube():
+    """Count products per (category, price bucket, in stock, featured) in one grouped query"""
+    in_stock = Product.stock > 0
+    featured = db.func.coalesce(Product.is_featured, False)
+    bucket = _price_bucket()
+    rows = db.session.query(Product.category_id, bucket, in_stock, featured, db.func.count()) \
+        .group_by(Product.category_id, bucket, in_stock, featured) \
+        .all()
+    return [(category_id, bucket, bool(stocked), bool(is_featured), count)
+            for category_id, bucket, stocked, is_featured, count in rows]
+
+
+def invalidate_facets():
+    """Drop the cached facet cube"""
+    cache.invalidate('facets')
+
+
+def facet_counts(filters):
+    """Return FacetCounts for the given CatalogFilters"""
+    total = 0
+    categories = defaultdict(int)
+    prices = dict.fromkeys(PRICE_BUCKETS, 0)
+    in_stock = featured = 0
+
+    for category_id, bucket, stocked, is_featured, count in cache.get_or_load('facets', 'cube', _load_cube, ttl=FACET_CACHE_TTL):
+        passes = {
+            'category': filters.category_id is None or category_id == filters.category_id,
+            'price': filters.price is None or bucket == filters.price,
+            'in_stock': not filters.in_stock or stocked,
+            'featured': not filters.featured or is_featured,
+        }
+        failed = [name for name, ok in passes.items() if not ok]
+        if not failed:
+            total += count
+        # A row counts towards a facet if it passes every other filter
+        if not failed or failed == ['category']:
+            categories[category_id] += count
+        if not failed or failed == ['price']:
+            prices[bucket] += count
+        if stocked and (not failed or failed == ['in_stock']):
+            in_stock += count
+        if is_featured and (not failed or failed == ['featured']):
+            featured += count
+
+    return FacetCounts(total, dict(categories), prices, in_stock, featured)
+
+
+def mark_facets_dirty(session):
+    """Drop the cached facets once the session's transaction commits"""
+    mark_cache_dirty(session, 'facets')
+
+
+invalidate_on(Product, 'facets')
@@ -0,0 +1,289 @@
+"""Product image pipeline for Wonderland Toy Store
+
+Uploaded product images are resized into IMAGE_VARIANTS (thumb, card, large
+and detail widths, never upscaled), each encoded as AVIF (when Pillow has an AVIF
+encoder), WebP and JPEG, plus a tiny blurred placeholder inlined as a data
+URI. Files are named after a hash of the uploaded bytes, so they can be cached
+forever and re-processing the same image is a no-op.
+
+The result is a manifest stored in ``Product.image_variants``::
+
+    {'hash': ..., 'width': 1500, 'height': 1500, 'placeholder': 'data:image/webp;base64,...',
+     'variants': {'card': {'width': 400, 'height': 400,
+                           'files': {'avif': 'variants/<hash>-card.avif', ...}}, ...}}
+
+Templates render it with the ``product_picture`` macro (templates/_images.html)
+as a <picture> with a srcset per format. Products whose images predate the
+pipeline keep serving the original file until ``flask process-images`` has
+backfilled them.
+
+Admin uploads only store the original; the variants are generated by the
+``process_product_image`` background job (see app/jobs.py), so the request
+does not wait on encoding. Until the job has run the product serves the
+original, as above.
+
+Pillow is required for processing; without it uploads are stored unprocessed.
+"""
+import base64
+import hashlib
+import io
+import os
+
+import click
+from flask import current_app, url_for
+from flask.cli import with_appcontext
+
+from app import db
+from app.cache import mark_cache_dirty
+from app.jobs import task
+from app.models import Product
+
+try:
+    from PIL import Image, ImageFilter, ImageOps, UnidentifiedImageError, features
+except ImportError:
+    Image = None
+
+# Variant name -> largest width and height in pixels
+IMAGE_VARIANTS = {
+    'thumb': 160,
+    'card': 400,
+    # Card images on high-density screens
+    'large': 800,
+    'detail': 1200,
+}
+# Format -> (file extension, MIME type, Pillow save options), best compression first
+IMAGE_FORMATS = {
+    'avif': ('avif', 'image/avif', {'quality': 50, 'speed': 8}),
+    'webp': ('webp', 'image/webp', {'quality': 75, 'method': 4}),
+    'jpeg': ('jpg', 'image/jpeg', {'quality': 80, 'optimize': True, 'progressive': True}),
+}
+# Uploads and imported images must have one of these extensions
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+PLACEHOLDER_WIDTH = 16
+VARIANTS_DIR = 'variants'
+
+
+def images_folder():
+    """Directory product images are stored in"""
+    return os.path.join(current_app.static_folder, 'images', 'products')
+
+
+def image_hash(data):
+    return hashlib.sha256(data).hexdigest()[:20]
+
+
+def available_formats():
+    """Formats the installed Pillow can encode"""
+    if Image is None:
+        return []
+    return [name for name in IMAGE_FORMATS if name != 'avif' or features.check('avif')]
+
+
+def _flatten(image, format_name):
+    """Convert to a mode the format can store; JPEG has no transparency"""
+    if format_name == 'jpeg':
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image.convert('RGBA'), mask=image.convert('RGBA').getchannel('A'))
+            return background
+        return image.convert('RGB')
+    return image if image.mode in ('RGB', 'RGBA') else image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+
+def _placeholder(image):
+    """A few-hundred-byte blurred WebP of the image as a data URI"""
+    small = _flatten(image, 'webp').copy()
+    small.thumbnail((PLACEHOLDER_WIDTH, PLACEHOLDER_WIDTH))
+    small = small.filter(ImageFilter.GaussianBlur(1))
+    buffer = io.BytesIO()
+    small.save(buffer, 'WEBP', quality=30)
+    return 'data:image/webp;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+def process_image(data, folder=None):
+    """Write the resized and re-encoded variants of an image; return its manifest
+
+    Returns None if the data is not an image Pillow can read.
+    """
+    if Image is None:
+        return None
+    folder = folder or images_folder()
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.exif_transpose(image)
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+        return None
+
+    digest = image_hash(data)
+    os.makedirs(os.path.join(folder, VARIANTS_DIR), exist_ok=True)
+    manifest = {
+        'hash': digest,
+        'width': image.width,
+        'height': image.height,
+        'placeholder': _placeholder(image),
+        'variants': {},
+    }
+    for variant, size in IMAGE_VARIANTS.items():
+        resized = image.copy()
+        resized.thumbnail((size, size), Image.LANCZOS)
+        files = {}
+        for format_name in available_formats():
+            extension, _, options = IMAGE_FORMATS[format_name]
+            filename = f'{VARIANTS_DIR}/{digest}-{variant}.{extension}'
+            path = os.path.join(folder, filename)
+            # Names are derived from the content, so an existing file is already correct
+            if not os.path.exists(path):
+                _flatten(resized, format_name).save(path + '.tmp', format_name.upper(), **options)
+                os.replace(path + '.tmp', path)
+            files[format_name] = filename
+        manifest['variants'][variant] = {'width': resized.width, 'height': resized.height, 'files': files}
+    return manifest
+
+
+def _readable(data):
+    """Whether the data looks like an image Pillow can decode, judging by its header only"""
+    if Image is None:
+        return True
+    try:
+        Image.open(io.BytesIO(data)).verify()
+    except (UnidentifiedImageError, OSError, SyntaxError, Image.DecompressionBombError):
+        return False
+    return True
+
+
+def store_upload(file, folder=None):
+    """Store an uploaded image under a content-hashed name, without processing it
+
+    Returns the filename, or None if the upload is not a readable image.
+    """
+    data = file.read()
+    if not _readable(data):
+        return None
+    return _store_original(data, file.filename.rsplit('.', 1)[1].lower(), folder or images_folder())
+
+
+def _store_original(data, extension, folder):
+    filename = f'{image_hash(data)}.{extension}'
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, filename), 'wb') as original:
+        original.write(data)
+    return filename
+
+
+@task('process_product_image')
+def process_product_image(product_id, filename):
+    """Background job: generate the variants of a product's uploaded image"""
+    if Image is None:
+        return
+    folder = images_folder()
+    with open(os.path.join(folder, filename), 'rb') as original:
+        manifest = process_image(original.read(), folder)
+    if manifest is None:
+        current_app.logger.warning('Product image %s is not a readable image', filename)
+        return
+    # The product may have been given another image (or deleted) since the job was queued
+    updated = db.session.execute(
+        db.update(Product)
+        .where(Product.id == product_id, Product.image_filename == filename)
+        .values(image_variants=manifest)
+    ).rowcount
+    if updated:
+        # A Core UPDATE skips the mapper events that invalidate cached catalog pages
+        mark_cache_dirty(db.session, 'categories', 'products', 'catalog', 'pages', 'fragments')
+    db.session.commit()
+
+
+@task('import_product_image')
+def import_product_image(product_id, path):
+    """Background job: store an image named by a bulk import and generate its variants"""
+    with open(path, 'rb') as source:
+        data = source.read()
+    if not _readable(data):
+        current_app.logger.warning('Imported image %s is not a readable image', path)
+        return
+    filename = _store_original(data, path.rsplit('.', 1)[1].lower(), images_folder())
+    product = db.session.get(Product, product_id)
+    if product is None:
+        return
+    if product.image_filename != filename:
+        old_filename, old_manifest = product.image_filename, product.image_variants
+        product.image_filename = filename
+        product.image_variants = None
+        db.session.commit()
+        if old_filename:
+            remove_image(old_filename, old_manifest, product_id)
+    elif product.image_variants:
+        return
+    process_product_image(product_id, filename)
+
+
+@task('remove_product_image')
+def remove_image(filename, manifest, product_id):
+    """Delete a product's image files unless another product uses the same image"""
+    if Product.query.filter(Product.image_filename == filename, Product.id != product_id).first():
+        return
+    folder = images_folder()
+    paths = [filename]
+    if manifest:
+        paths += [name for info in manifest['variants'].values() for name in info['files'].values()]
+    for path in paths:
+        path = os.path.join(folder, path)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def image_urls(product):
+    """URLs of a product's image variants by variant and format, or None if it has none"""
+    if not product.image_variants:
+        return None
+    return {
+        variant: {format_name: url_for('static', filename=f'images/products/{filename}')
+                  for format_name, filename in info['files'].items()}
+        for variant, info in product.image_variants['variants'].items()
+    }
+
+
+def picture_sources(manifest):
+    """(MIME type, srcset) for each format of a manifest, best compression first"""
+    sources = []
+    for format_name, (_, mime_type, _) in IMAGE_FORMATS.items():
+        candidates = [(info['width'], info['files'][format_name])
+                      for info in manifest['variants'].values() if format_name in info['files']]
+        if not candidates:
+            continue
+        # Variants of small originals can share a width; keep one file per width
+        widths = dict(sorted(candidates))
+        srcset = ', '.join(f"{url_for('static', filename=f'images/products/{filename}')} {width}w"
+                           for width, filename in widths.items())
+        sources.append((mime_type, srcset))
+    return sources
+
+
+@click.command('process-images')
+@click.option('--force', is_flag=True, help='Re-process products that already have variants')
+@with_appcontext
+def process_images_command(force):
+    """Generate image variants for existing product images"""
+    if Image is None:
+        raise click.ClickException('Pillow is required to process images (pip install Pillow)')
+    folder = images_folder()
+    query = Product.query.filter(Product.image_filename.isnot(None))
+    if not force:
+        query = query.filter(Product.image_variants.is_(None))
+
+    processed = missing = failed = 0
+    for product in query.order_by(Product.id).all():
+        path = os.path.join(folder, product.image_filename)
+        if not os.path.exists(path):
+            missing += 1
+            continue
+        with open(path, 'rb') as original:
+            manifest = process_image(original.read(), folder)
+        if manifest is None:
+            failed += 1
+            click.echo(f'Note: {product.image_filename} is not a readable image')
+            continue
+        product.image_variants = manifest
+        db.session.commit()
+        processed += 1
+    click.echo(f'✓ Processed {processed} product images ({missing} missing, {failed} unreadable)')
@@ -0,0 +1,347 @@
+"""Bulk product import for Wonderland Toy Store
+
+Supplier catalogs are read as CSV (with a header row) or JSONL, one product
+per row, and upserted on ``sku`` in batches of IMPORT_BATCH_SIZE with a
+single ``INSERT ... ON CONFLICT (sku) DO UPDATE`` per batch. A row only
+updates the fields it has, so a price-only file leaves stock alone:
+
+    sku, name, price        required
+    stock                   whole number, 0 or more
+    category                category name (case-insensitive)
+    description, is_featured (true/false, yes/no, 1/0)
+    image                   path of an image file inside the import images folder
+
+Invalid rows are reported with their line number and skipped; the rest of
+the file is still imported. Images are copied and processed by background
+jobs (see app/images.py), so they do not slow the import down.
+
+The batched writes bypass the ORM events, so category counts, the products
+counter and the catalog caches are refreshed once at the end.
+"""
+import csv
+import json
+import math
+import os
+import time
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import db
+from app.cache import mark_cache_dirty
+from app.catalog import refresh_category_counts
+from app.images import ALLOWED_EXTENSIONS
+from app.jobs import enqueue
+from app.models import Product, Category
+from app.rollups import refresh_product_counter
+
+IMPORT_BATCH_SIZE = 1000
+IMPORT_FORMATS = ('csv', 'jsonl')
+# Errors kept for the report; later ones are only counted
+MAX_REPORTED_ERRORS = 1000
+
+TRUE_VALUES = {'1', 'true', 'yes', 'y'}
+FALSE_VALUES = {'0', 'false', 'no', 'n'}
+
+
+class RowError(ValueError):
+    """Raised for a row that cannot be imported"""
+
+
+class ImportResult:
+    """Counts, row errors and timing of one import"""
+
+    def __init__(self):
+        self.rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.failed = 0
+        self.images_queued = 0
+        self.categories_created = 0
+        self.errors = []
+        self.elapsed = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def add_error(self, line, sku, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, sku, message))
+
+
+def detect_format(filename):
+    """The import format for a file name, from its extension"""
+    extension = filename.rsplit('.', 1)[-1].lower()
+    return 'jsonl' if extension in ('jsonl', 'ndjson', 'json') else 'csv'
+
+
+def read_rows(stream, import_format):
+    """Yield (line number, record) from a text stream; record is a RowError for unparseable lines"""
+    if import_format == 'csv':
+        reader = csv.DictReader(stream)
+        if reader.fieldnames:
+            reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_number, RowError(f'Invalid JSON: {e}')
+            continue
+        if not isinstance(record, dict):
+            yield line_number, RowError('Expected a JSON object')
+            continue
+        yield line_number, {str(key).lower(): value for key, value in record.items()}
+
+
+def _text(record, name, max_length=None, required=False):
+    value = record.get(name)
+    value = '' if value is None else str(value).strip()
+    if not value:
+        if required:
+            raise RowError(f'{name} is required')
+        return None
+    if max_length and len(value) > max_length:
+        raise RowError(f'{name} is longer than {max_length} characters')
+    return value
+
+
+def _number(record, name, cast, required=False):
+    value = _text(record, name, required=required)
+    if value is None:
+        return None
+    try:
+        number = cast(value)
+    except ValueError:
+        raise RowError(f'{name} must be a {"whole " if cast is int else ""}number: {value!r}')
+    if not math.isfinite(number):
+        raise RowError(f'{name} must be a number: {value!r}')
+    if number < 0:
+        raise RowError(f'{name} must not be negative')
+    return number
+
+
+class ProductImporter:
+    """Validates rows and writes them in batched upserts"""
+
+    def __init__(self, images_folder=None, create_categories=False, batch_size=IMPORT_BATCH_SIZE):
+        self.images_folder = os.path.realpath(images_folder) if images_folder else None
+        self.create_categories = create_categories
+        self.batch_size = batch_size
+        self.result = ImportResult()
+        # Lower-cased name -> id, loaded once
+        self.categories = {name.lower(): category_id for category_id, name in
+                           db.session.query(Category.id, Category.name)}
+        self.batch = {}
+
+    def _category_id(self, name):
+        category_id = self.categories.get(name.lower())
+        if category_id is None:
+            if not self.create_categories:
+                raise RowError(f'Unknown category: {name}')
+            category_id = db.session.execute(
+                db.insert(Category).values(name=name, created_at=datetime.utcnow()).returning(Category.id)
+            ).scalar()
+            # Committed on its own so a failed batch cannot roll it back under later rows
+            db.session.commit()
+            self.categories[name.lower()] = category_id
+            self.result.categories_created += 1
+        return category_id
+
+    def _image_path(self, value):
+        if self.images_folder is None:
+            raise RowError('Images cannot be imported without an images folder')
+        path = os.path.realpath(os.path.join(self.images_folder, value))
+        if not path.startswith(self.images_folder + os.sep):
+            raise RowError(f'Image is outside the images folder: {value}')
+        if path.rsplit('.', 1)[-1].lower() not in ALLOWED_EXTENSIONS:
+            raise RowError(f'Image must be one of {", ".join(sorted(ALLOWED_EXTENSIONS))}: {value}')
+        if not os.path.isfile(path):
+            raise RowError(f'Image not found: {value}')
+        return path
+
+    def validate(self, record):
+        """Column values for a record (only the fields it sets) and its image path"""
+        values = {
+            'sku': _text(record, 'sku', max_length=64, required=True),
+            'name': _text(record, 'name', max_length=120, required=True),
+            'price': _number(record, 'price', float, required=True),
+        }
+        stock = _number(record, 'stock', int)
+        if stock is not None:
+            values['stock'] = stock
+        description = _text(record, 'description')
+        if description is not None:
+            values['description'] = description
+        featured = _text(record, 'is_featured')
+        if featured is not None:
+            if featured.lower() not in TRUE_VALUES | FALSE_VALUES:
+                raise RowError(f'is_featured must be true or false: {featured!r}')
+            values['is_featured'] = featured.lower() in TRUE_VALUES
+        category = _text(record, 'category', max_length=120)
+        if category is not None:
+            values['category_id'] = self._category_id(category)
+        image = _text(record, 'image')
+        return values, self._image_path(image) if image else None
+
+    def add(self, line, record):
+        """Validate one record and add it to the current batch"""
+        self.result.rows += 1
+        try:
+            if isinstance(record, RowError):
+                raise record
+            values, image = self.validate(record)
+        except RowError as e:
+            sku = record.get('sku') if isinstance(record, dict) else None
+            self.result.add_error(line, sku, str(e))
+            return
+        # One statement cannot upsert the same key twice
+        if values['sku'] in self.batch:
+            self.flush()
+        self.batch[values['sku']] = (line, values, image)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def _upsert(self, rows):
+        """Upsert rows that set the same fields with one executemany
+
+        Databases without INSERT ... ON CONFLICT get an UPDATE per row, then
+        an INSERT where no row was updated.
+        """
+        dialect = db.engine.dialect.name
+        now = datetime.utcnow()
+        # The Core table rather than the mapped class skips the ORM bulk-insert machinery
+        products = Product.__table__
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            for row in rows:
+                updates = {name: value for name, value in row.items() if name != 'sku'}
+                result = db.session.execute(
+                    products.update().where(products.c.sku == row['sku']).values(**updates, updated_at=now)
+                )
+                if result.rowcount == 0:
+                    db.session.execute(products.insert().values(**row, created_at=now, updated_at=now))
+            return
+        statement = insert(products)
+        statement = statement.on_conflict_do_update(
+            index_elements=[products.c.sku],
+            set_={**{name: statement.excluded[name] for name in rows[0] if name != 'sku'}, 'updated_at': now},
+        )
+        db.session.execute(statement, [{**row, 'created_at': now, 'updated_at': now} for row in rows])
+
+    def _write(self, entries):
+        """Upsert a batch and queue its images; returns (rows updated, images queued)"""
+        skus = [values['sku'] for _, values, _ in entries]
+        existing = db.session.scalar(db.select(db.func.count(Product.id)).where(Product.sku.in_(skus)))
+        # executemany needs the same columns in every row
+        groups = {}
+        for entry in entries:
+            groups.setdefault(tuple(sorted(entry[1])), []).append(entry)
+        for group in groups.values():
+            self._upsert([values for _, values, _ in group])
+        images = {values['sku']: image for _, values, image in entries if image}
+        if images:
+            for product_id, sku in db.session.execute(
+                    db.select(Product.id, Product.sku).where(Product.sku.in_(list(images)))):
+                enqueue('import_product_image', product_id=product_id, path=images[sku])
+        return existing, len(images)
+
+    def flush(self):
+        """Write the current batch in one transaction, falling back to row by row if it fails"""
+        entries = list(self.batch.values())
+        self.batch = {}
+        if not entries:
+            return
+        try:
+            updated, images = self._write(entries)
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            for entry in entries:
+                try:
+                    updated, images = self._write([entry])
+                    db.session.commit()
+                except SQLAlchemyError as e:
+                    db.session.rollback()
+                    self.result.add_error(entry[0], entry[1]['sku'], str(e.orig or e).splitlines()[0])
+                    continue
+                self._count(1, updated, images)
+            return
+        self._count(len(entries), updated, images)
+
+    def _count(self, written, updated, images):
+        self.result.inserted += written - updated
+        self.result.updated += updated
+        self.result.images_queued += images
+
+    def finish(self):
+        """Write the last batch and refresh what the batched writes bypassed"""
+        self.flush()
+        refresh_product_counter()
+        mark_cache_dirty(db.session, 'products', 'facets')
+        refresh_category_counts()
+
+
+def import_products(stream, import_format, images_folder=None, create_categories=False,
+                    batch_size=IMPORT_BATCH_SIZE):
+    """Import products from a text stream of CSV or JSONL; returns an ImportResult"""
+    if import_format not in IMPORT_FORMATS:
+        raise ValueError(f'Unknown import format: {import_format}')
+    start = time.perf_counter()
+    importer = ProductImporter(images_folder, create_categories, batch_size)
+    try:
+        for line, record in read_rows(stream, import_format):
+            importer.add(line, record)
+    except (csv.Error, UnicodeDecodeError) as e:
+        importer.result.add_error(None, None, f'Could not read the file: {e}')
+    finally:
+        importer.finish()
+    importer.result.elapsed = time.perf_counter() - start
+    return importer.result
+
+
+def write_error_report(result, stream):
+    """Write a result's row errors as CSV (line, sku, error); at most MAX_REPORTED_ERRORS are kept"""
+    writer = csv.writer(stream)
+    writer.writerow(['line', 'sku', 'error'])
+    writer.writerows(result.errors)
+
+
+@click.command('import-products')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'import_format', type=click.Choice(IMPORT_FORMATS), help='Default: from the file extension')
+@click.option('--images-dir', type=click.Path(exists=True, file_okay=False),
+              help='Folder the image column is relative to (default: IMPORT_IMAGES_FOLDER)')
+@click.option('--create-categories', is_flag=True, help='Create categories that do not exist yet')
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True)
+@click.option('--errors', 'errors_path', type=click.Path(dir_okay=False), help='Write row errors to this CSV file')
+@with_appcontext
+def import_products_command(path, import_format, images_dir, create_categories, batch_size, errors_path):
+    """Bulk import products from a CSV or JSONL file"""
+    images_dir = images_dir or current_app.config.get('IMPORT_IMAGES_FOLDER')
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        result = import_products(stream, import_format or detect_format(path), images_dir,
+                                 create_categories, batch_size)
+    click.echo(f'✓ Imported {result.rows - result.failed} of {result.rows} rows in {result.elapsed:.1f}s '
+               f'({result.rows_per_second:.0f} rows/s): {result.inserted} new, {result.updated} updated, '
+               f'{result.failed} failed, {result.images_queued} images queued')
+    for line, sku, message in result.errors[:10]:
+        click.echo(f'  line {line} {sku or ""}: {message}')
+    if result.failed > 10 and not errors_path:
+        click.echo(f'Note: {result.failed - 10} more errors; use --errors to write them to a file')
+    if errors_path and result.errors:
+        with open(errors_path, 'w', newline='') as report:
+            write_error_report(result, report)
+        click.echo(f'✓ Row errors written to {errors_path}')
@@ -0,0 +1,141 @@
+"""Atomic stock reservation for Wonderland Toy Store
+
+Stock never goes through a read-modify-write in Python. Every change is a
+single conditional statement over all affected products::
+
+    UPDATE products SET stock = stock - CASE id WHEN ? THEN ? ... END
+    WHERE id IN (...) AND stock >= CASE id WHEN ? THEN ? ... END
+
+If fewer rows match than products were asked for, at least one product is
+short and the caller's transaction must be rolled back; concurrent checkouts
+of the same product therefore can never oversell it.
+
+When a customer moves on to card payment, the cart's stock is held in
+StockReservation rows for RESERVATION_TTL. Placing the order claims the held
+stock (adjusting for any cart changes since); abandoned reservations are
+returned to the products by the next reservation call or by
+``flask release-reservations``.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+
+from app import db
+from app.models import Product, StockReservation
+from app.facets import mark_facets_dirty
+
+RESERVATION_TTL = timedelta(minutes=15)
+
+
+class InsufficientStock(Exception):
+    """Raised when a stock change would take a product below zero"""
+
+    def __init__(self, products):
+        self.products = products
+        names = ', '.join(product.name for product in products)
+        super().__init__(f'Not enough stock left for: {names}')
+
+
+def adjust_stock(deltas):
+    """Take deltas[product_id] units from each product in one conditional UPDATE
+
+    Negative deltas return stock. Raises InsufficientStock if any product
+    would go negative; the other products may already have been updated, so
+    the caller must roll back.
+    """
+    deltas = {product_id: delta for product_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    delta = db.case(deltas, value=Product.id)
+    updated = db.session.execute(
+        db.update(Product)
+        .where(Product.id.in_(deltas), Product.stock >= delta)
+        .values(stock=Product.stock - delta)
+        .returning(Product.id, Product.stock)
+        .execution_options(synchronize_session=False)
+    ).all()
+    if len(updated) != len(deltas):
+        missing = set(deltas) - {product_id for product_id, _ in updated}
+        raise InsufficientStock(Product.query.filter(Product.id.in_(missing)).all())
+    # Products that sold out or came back in stock change the in-stock facet counts
+    if any(stock == 0 or stock == -deltas[product_id] for product_id, stock in updated):
+        mark_facets_dirty(db.session)
+    # Products already loaded in this session would otherwise show the old stock
+    for product in db.session.identity_map.values():
+        if isinstance(product, Product) and db.inspect(product).identity[0] in deltas:
+            db.session.expire(product, ['stock'])
+
+
+def _cart_quantities(cart):
+    quantities = defaultdict(int)
+    for item in cart.items:
+        quantities[item.product_id] += item.quantity
+    return quantities
+
+
+def _take_reservations(*criteria):
+    """Delete matching reservations, returning the units they held per product
+
+    Deleting first (with RETURNING) means two requests racing for the same
+    reservation can never both return its stock.
+    """
+    rows = db.session.execute(
+        db.delete(StockReservation)
+        .where(*criteria)
+        .returning(StockReservation.product_id, StockReservation.quantity)
+        .execution_options(synchronize_session=False)
+    )
+    held = defaultdict(int)
+    for product_id, quantity in rows:
+        held[product_id] += quantity
+    return held
+
+
+def _move_stock(quantities, held):
+    """Take what the cart needs beyond what it held, or return the surplus"""
+    adjust_stock({product_id: quantities.get(product_id, 0) - held.get(product_id, 0)
+                  for product_id in set(quantities) | set(held)})
+
+
+def release_expired_reservations(now=None):
+    """Return the stock of every expired reservation; returns the units released"""
+    held = _take_reservations(StockReservation.expires_at <= (now or datetime.utcnow()))
+    adjust_stock({product_id: -quantity for product_id, quantity in held.items()})
+    return sum(held.values())
+
+
+def reserve_cart(cart):
+    """Hold the stock of every item in the cart for RESERVATION_TTL
+
+    Re-reserving a cart only moves the difference from its previous
+    reservation. Raises InsufficientStock; the caller commits or rolls back.
+    """
+    release_expired_reservations()
+    quantities = _cart_quantities(cart)
+    _move_stock(quantities, _take_reservations(StockReservation.cart_id == cart.id))
+
+    expires_at = datetime.utcnow() + RESERVATION_TTL
+    db.session.execute(db.insert(StockReservation), [
+        {'cart_id': cart.id, 'product_id': product_id, 'quantity': quantity, 'expires_at': expires_at}
+        for product_id, quantity in quantities.items()
+    ])
+
+
+def claim_cart_stock(cart):
+    """Take the stock for an order placed from the cart, using its reservation if any
+
+    Raises InsufficientStock; the caller commits or rolls back.
+    """
+    release_expired_reservations()
+    _move_stock(_cart_quantities(cart), _take_reservations(StockReservation.cart_id == cart.id))
+
+
+@click.command('release-reservations')
+@with_appcontext
+def release_reservations_command():
+    """Return the stock held by expired checkout reservations"""
+    released = release_expired_reservations()
+    db.session.commit()
+    click.echo(f'✓ Released {released} units from expired stock reservations')
@@ -0,0 +1,251 @@
+"""Background jobs for Wonderland Toy Store
+
+Slow work (image transcoding, file cleanup, rollup rebuilds, email) is queued
+with ``enqueue(name, **payload)`` and run outside the request by the function
+registered under that name with ``@task``. Jobs are rows in the ``jobs``
+table written in the caller's transaction, so a job exists exactly when the
+change that asked for it was committed.
+
+Workers claim one job at a time with a single conditional UPDATE, which marks
+it running until ``locked_until`` (now + JOB_VISIBILITY_TIMEOUT). A job whose
+worker dies is claimed again once that passes, so tasks must be safe to run
+more than once. A failed attempt is retried with exponential backoff until
+``max_attempts`` is reached, then left as failed with its error.
+
+JOB_MODE selects who runs the jobs:
+  'thread'  a small thread pool in the web process, woken when a transaction
+            that enqueued jobs commits (development default)
+  'worker'  separate `flask run-worker` processes polling the table
+"""
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app import db
+from app.models import Job
+
+JOB_VISIBILITY_TIMEOUT = 300
+JOB_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 10
+MAX_RETRY_DELAY = 3600
+# Finished jobs are deleted by workers after this long
+JOB_RETENTION = timedelta(days=7)
+
+_tasks = {}
+
+
+def task(name):
+    """Register a function as the handler of jobs with the given name"""
+
+    def register(func):
+        _tasks[name] = func
+        return func
+
+    return register
+
+
+def enqueue(name, max_attempts=JOB_MAX_ATTEMPTS, delay=0, **payload):
+    """Queue a job in the current transaction; it becomes visible to workers on commit"""
+    if name not in _tasks:
+        raise ValueError(f'Unknown job: {name!r}')
+    job = Job(name=name, payload=payload, max_attempts=max_attempts,
+              run_at=datetime.utcnow() + timedelta(seconds=delay))
+    db.session.add(job)
+    db.session.info['jobs_enqueued'] = True
+    return job
+
+
+def retry_delay(attempts):
+    """Seconds to wait before the next attempt after `attempts` failures"""
+    return min(RETRY_BASE_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def claim_job(now=None):
+    """Mark the next runnable job as running and return it, or None if there is none"""
+    now = now or datetime.utcnow()
+    runnable = db.or_(
+        db.and_(Job.status == Job.QUEUED, Job.run_at <= now),
+        db.and_(Job.status == Job.RUNNING, Job.locked_until < now),
+    )
+    # SKIP LOCKED keeps concurrent Postgres workers off each other's rows; SQLite
+    # ignores it and serializes writers instead. The outer condition is checked
+    # again against the row being updated, so a job is never claimed twice.
+    next_job = db.select(Job.id).where(runnable).order_by(Job.run_at, Job.id).limit(1) \
+        .with_for_update(skip_locked=True).scalar_subquery()
+    timeout = current_app.config.get('JOB_VISIBILITY_TIMEOUT', JOB_VISIBILITY_TIMEOUT)
+    row = db.session.execute(
+        db.update(Job)
+        .where(Job.id == next_job, runnable)
+        .values(status=Job.RUNNING, attempts=Job.attempts + 1, locked_until=now + timedelta(seconds=timeout))
+        .returning(Job.id, Job.name, Job.payload, Job.attempts, Job.max_attempts)
+    ).first()
+    db.session.commit()
+    return row
+
+
+def _finish(job, **values):
+    # The attempt number guards against overwriting a later attempt of a job
+    # that outlived its visibility timeout
+    db.session.execute(
+        db.update(Job).where(Job.id == job.id, Job.attempts == job.attempts).values(**values)
+    )
+    db.session.commit()
+
+
+def run_job(job):
+    """Run a claimed job and record the outcome; returns True if it succeeded"""
+    try:
+        handler = _tasks.get(job.name)
+        if handler is None:
+            raise LookupError(f'No handler registered for job {job.name!r}')
+        handler(**job.payload)
+    except Exception:
+        db.session.rollback()
+        error = traceback.format_exc()
+        current_app.logger.warning('Job %s (%s) attempt %s failed:\n%s', job.id, job.name, job.attempts, error)
+        if job.attempts >= job.max_attempts:
+            _finish(job, status=Job.FAILED, last_error=error, locked_until=None, finished_at=datetime.utcnow())
+        else:
+            delay = retry_delay(job.attempts)
+            _finish(job, status=Job.QUEUED, last_error=error, locked_until=None,
+                    run_at=datetime.utcnow() + timedelta(seconds=delay))
+            _schedule_wakeup(delay)
+        return False
+    _finish(job, status=Job.DONE, locked_until=None, finished_at=datetime.utcnow())
+    return True
+
+
+def run_pending_jobs(limit=None):
+    """Run runnable jobs until there are none left (or `limit` have run); returns the number run"""
+    count = 0
+    while limit is None or count < limit:
+        job = claim_job()
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+
+def purge_finished_jobs():
+    """Delete jobs that finished successfully more than JOB_RETENTION ago"""
+    cutoff = datetime.utcnow() - JOB_RETENTION
+    deleted = db.session.execute(
+        db.delete(Job).where(Job.status == Job.DONE, Job.finished_at < cutoff)
+    ).rowcount
+    db.session.commit()
+    return deleted
+
+
+# Thread mode: the web process runs jobs in a small pool of its own
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def _executor(app):
+    with _executors_lock:
+        if app not in _executors:
+            _executors[app] = ThreadPoolExecutor(
+                max_workers=app.config.get('JOB_THREADS', 2), thread_name_prefix='jobs')
+        return _executors[app]
+
+
+def _drain(app):
+    with app.app_context():
+        try:
+            run_pending_jobs()
+        except Exception:
+            app.logger.exception('Background job runner failed')
+
+
+def wake_workers(app):
+    """In thread mode, start running any pending jobs"""
+    if app.config.get('JOB_MODE') == 'thread':
+        _executor(app).submit(_drain, app)
+
+
+def _schedule_wakeup(delay):
+    # Workers poll; the thread pool only wakes on commit, so retries need a timer
+    app = current_app._get_current_object()
+    if app.config.get('JOB_MODE') == 'thread':
+        timer = threading.Timer(delay, wake_workers, args=(app,))
+        timer.daemon = True
+        timer.start()
+
+
+def wait_for_jobs(app, timeout=30):
+    """Block until the thread pool has no queued work (for scripts and benchmarks)"""
+    executor = _executor(app)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        # Jobs run in submission order, so once this no-op runs the earlier drains have finished
+        if executor.submit(lambda: None).result(timeout=max(0, deadline - time.monotonic())) is None:
+            with app.app_context():
+                pending = db.session.query(db.func.count(Job.id)) \
+                    .filter(Job.status.in_([Job.QUEUED, Job.RUNNING]), Job.run_at <= datetime.utcnow()) \
+                    .scalar()
+            if not pending:
+                return True
+            wake_workers(app)
+            time.sleep(0.01)
+    return False
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_after_commit(session):
+    if session.info.pop('jobs_enqueued', False):
+        try:
+            app = current_app._get_current_object()
+        except RuntimeError:
+            return
+        wake_workers(app)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('jobs_enqueued', None)
+
+
+@click.command('run-worker')
+@click.option('--burst', is_flag=True, help='Exit once no job is runnable instead of polling')
+@click.option('--poll-interval', default=1.0, show_default=True, help='Seconds between polls when idle')
+@with_appcontext
+def run_worker_command(burst, poll_interval):
+    """Run background jobs from the jobs table"""
+    click.echo('✓ Worker started' + (' (burst)' if burst else ''))
+    processed = 0
+    last_purge = 0
+    while True:
+        job = claim_job()
+        if job is not None:
+            ok = run_job(job)
+            processed += 1
+            click.echo(f"{'✓' if ok else '✗'} Job {job.id} {job.name} (attempt {job.attempts})")
+            continue
+        if burst:
+            break
+        if time.monotonic() - last_purge > 3600:
+            purge_finished_jobs()
+            last_purge = time.monotonic()
+        time.sleep(poll_interval)
+    click.echo(f'✓ Processed {processed} jobs')
+
+
+@click.command('job-status')
+@with_appcontext
+def job_status_command():
+    """Show job counts by status and the most recent failures"""
+    counts = dict(db.session.query(Job.status, db.func.count(Job.id)).group_by(Job.status).all())
+    click.echo(', '.join(f'{status}: {counts.get(status, 0)}' for status in (Job.QUEUED, Job.RUNNING, Job.DONE, Job.FAILED)))
+    for job in Job.query.filter_by(status=Job.FAILED).order_by(Job.finished_at.desc()).limit(5):
+        last_line = (job.last_error or '').strip().splitlines()[-1:] or ['']
+        click.echo(f'  failed {job.id} {job.name} after {job.attempts} attempts: {last_line[0]}')
@@ -0,0 +1,37 @@
+"""Named eager-loading strategies for Wonderland Toy Store
+
+Relationships on the models default to lazy loading, which issues one SELECT
+per related object the first time it is touched. Views that walk a whole
+object graph apply one of the option sets below instead, so the number of
+statements per request stays fixed however many rows are rendered.
+"""
+from sqlalchemy.orm import selectinload, joinedload
+
+from app.models import Cart, CartItem, Order, OrderLine
+
+# Cart -> items (one SELECT ... IN) -> product (joined into the items query)
+CART_WITH_PRODUCTS = (
+    selectinload(Cart.items).joinedload(CartItem.product),
+)
+
+# Order -> lines (one SELECT ... IN) -> product (joined into the lines query)
+ORDERS_WITH_LINES = (
+    selectinload(Order.lines).joinedload(OrderLine.product),
+)
+
+# Order -> lines -> product in one joined SELECT, for a handful of orders
+# (a LIMITed query is wrapped in a subquery so the limit counts orders, not lines)
+FEW_ORDERS_WITH_LINES = (
+    joinedload(Order.lines).joinedload(OrderLine.product),
+)
+
+# Order -> user, lines and products, for admin order tables
+RECENT_ORDERS = (
+    joinedload(Order.user),
+    selectinload(Order.lines).joinedload(OrderLine.product),
+)
+
+
+def load_user_cart(user_id, options=CART_WITH_PRODUCTS):
+    """Load a user's cart with the given loading strategy, or None"""
+    return Cart.query.options(*options).filter_by(user_id=user_id).first()
@@ -0,0 +1,67 @@
+"""Outgoing email for Wonderland Toy Store
+
+Emails are sent by background jobs (see app/jobs.py) so checkout and password
+resets never wait on the mail server. With MAIL_SERVER unset (development)
+messages are written to the application log instead of being sent.
+"""
+import smtplib
+from email.message import EmailMessage
+
+from flask import current_app
+
+from app import db
+from app.jobs import task
+from app.loading import ORDERS_WITH_LINES
+from app.models import Order, User
+
+
+def send_email(to, subject, body):
+    """Send a plain-text email, or log it when no mail server is configured"""
+    config = current_app.config
+    if not config.get('MAIL_SERVER'):
+        current_app.logger.info('Email to %s: %s\n%s', to, subject, body)
+        return
+    message = EmailMessage()
+    message['From'] = config['MAIL_SENDER']
+    message['To'] = to
+    message['Subject'] = subject
+    message.set_content(body)
+    with smtplib.SMTP(config['MAIL_SERVER'], config['MAIL_PORT'], timeout=30) as smtp:
+        if config.get('MAIL_USE_TLS'):
+            smtp.starttls()
+        if config.get('MAIL_USERNAME'):
+            smtp.login(config['MAIL_USERNAME'], config['MAIL_PASSWORD'])
+        smtp.send_message(message)
+
+
+@task('send_order_confirmation')
+def send_order_confirmation(order_id):
+    """Background job: email the customer a summary of a placed order"""
+    order = db.session.get(Order, order_id, options=ORDERS_WITH_LINES)
+    if order is None:
+        return
+    lines = '\n'.join(f'  {line.quantity} x {line.product.name} ${line.total_price:.2f}' for line in order.lines)
+    body = (
+        f'Hi {order.full_name},\n\n'
+        f'Thank you for your order #{order.id}.\n\n'
+        f'{lines}\n\n'
+        f'Total: ${order.total_price:.2f}\n'
+        f'Shipping to: {order.shipping_address}, {order.city}, {order.state} {order.postal_code}\n\n'
+        'Wonderland Toy Store'
+    )
+    send_email(order.email, f'Your Wonderland Toy Store order #{order.id}', body)
+
+
+@task('send_password_reset')
+def send_password_reset(user_id, link):
+    """Background job: email a password reset link"""
+    user = db.session.get(User, user_id)
+    if user is None:
+        return
+    body = (
+        f'Hi {user.username},\n\n'
+        f'Reset your password here: {link}\n\n'
+        'If you did not ask for a password reset you can ignore this email.\n\n'
+        'Wonderland Toy Store'
+    )
+    send_email(user.email, 'Reset your Wonderland Toy Store password', body)
@@ -0,0 +1,347 @@
+"""Per-request latency and SQL instrumentation
+
+Every request records its wall time, the time spent rendering templates, and
+the number and total time of the SQL statements it ran (SQLAlchemy
+``before/after_cursor_execute`` events on the app's engines). Statements are
+reduced to their shape (whitespace and the length of IN lists ignored); a
+shape that runs more than ``METRICS_N_PLUS_ONE_THRESHOLD`` times in one
+request is reported as a likely N+1 query and logged.
+
+Totals are kept per endpoint and method in this worker process, with a
+latency histogram and a window of recent durations for percentiles. They
+are shown at /admin/metrics and exported in the Prometheus text format at
+/metrics, which needs an admin session or ``Authorization: Bearer
+<METRICS_TOKEN>``.
+
+A streamed response is measured up to the point its body starts streaming.
+
+An admin request carrying the ``X-Profile: 1`` header (``METRICS_PROFILE_HEADER``)
+runs under a profiler: pyinstrument's sampling profiler if it is installed,
+cProfile otherwise. The report is kept in memory and linked from the
+response's ``X-Profile-Url`` header and the metrics page.
+
+``METRICS_ENABLED=0`` turns all of it off.
+"""
+import cProfile
+import io
+import itertools
+import pstats
+import re
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from datetime import datetime
+
+from flask import g, has_request_context, request, template_rendered, before_render_template, url_for
+from flask_login import current_user
+from sqlalchemy import event
+
+from app import db
+
+N_PLUS_ONE_THRESHOLD = 5
+# Upper bounds (seconds) of the request duration histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Recent durations kept per endpoint for percentiles
+LATENCY_WINDOW = 1000
+RECENT_N_PLUS_ONE = 50
+PROFILE_HISTORY = 20
+
+_IN_LIST = re.compile(r'\((?:\s*(?:\?|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%\(\w+\)s|:\w+)\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """Normalize a SQL statement so repeats with different IN list lengths compare equal"""
+    return _IN_LIST.sub('(?...)', _WHITESPACE.sub(' ', statement).strip())
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers, or None if it is empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class RequestStats:
+    """What one request has cost so far"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.shapes = Counter()
+        self.profiler = None
+
+
+class EndpointStats:
+    """Running totals for one endpoint and method"""
+
+    def __init__(self):
+        self.requests = 0
+        self.statuses = Counter()
+        self.wall_time = 0.0
+        self.max_wall_time = 0.0
+        self.template_time = 0.0
+        self.sql_count = 0
+        self.max_sql_count = 0
+        self.sql_time = 0.0
+        self.n_plus_one = 0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.recent = deque(maxlen=LATENCY_WINDOW)
+
+    def add(self, status, wall_time, stats, n_plus_one):
+        self.requests += 1
+        self.statuses[f'{status // 100}xx'] += 1
+        self.wall_time += wall_time
+        self.max_wall_time = max(self.max_wall_time, wall_time)
+        self.template_time += stats.template_time
+        self.sql_count += stats.sql_count
+        self.max_sql_count = max(self.max_sql_count, stats.sql_count)
+        self.sql_time += stats.sql_time
+        self.n_plus_one += bool(n_plus_one)
+        for n, bound in enumerate(LATENCY_BUCKETS):
+            if wall_time <= bound:
+                self.buckets[n] += 1
+                break
+        self.recent.append(wall_time)
+
+    def summary(self):
+        requests = self.requests or 1
+        recent = list(self.recent)
+        return {
+            'requests': self.requests,
+            'errors': self.statuses['5xx'],
+            'statuses': dict(self.statuses),
+            'avg_ms': round(self.wall_time / requests * 1000, 2),
+            'p50_ms': round(percentile(recent, 0.50) * 1000, 2) if recent else None,
+            'p95_ms': round(percentile(recent, 0.95) * 1000, 2) if recent else None,
+            'p99_ms': round(percentile(recent, 0.99) * 1000, 2) if recent else None,
+            'max_ms': round(self.max_wall_time * 1000, 2),
+            'avg_template_ms': round(self.template_time / requests * 1000, 2),
+            'avg_sql_statements': round(self.sql_count / requests, 2),
+            'max_sql_statements': self.max_sql_count,
+            'avg_sql_ms': round(self.sql_time / requests * 1000, 2),
+            'n_plus_one_requests': self.n_plus_one,
+        }
+
+
+class Profile:
+    """A profiler report for one request"""
+
+    def __init__(self, profile_id, method, path, wall_time, sql_count, kind, report):
+        self.id = profile_id
+        self.method = method
+        self.path = path
+        self.wall_time = wall_time
+        self.sql_count = sql_count
+        self.kind = kind
+        self.report = report
+        self.created_at = datetime.utcnow()
+
+
+def _start_profiler():
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    profiler = Profiler(interval=0.001)
+    profiler.start()
+    return profiler
+
+
+def _stop_profiler(profiler):
+    """Stop a profiler from _start_profiler() and return (kind, text report)"""
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(60)
+        return 'cProfile', output.getvalue()
+    profiler.stop()
+    return 'pyinstrument', profiler.output_text(unicode=True, color=False)
+
+
+class RequestMetrics:
+    """Per-endpoint request metrics for the current worker process"""
+
+    def __init__(self, threshold=N_PLUS_ONE_THRESHOLD):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self.started_at = datetime.utcnow()
+        self.endpoints = defaultdict(EndpointStats)
+        self.n_plus_one = deque(maxlen=RECENT_N_PLUS_ONE)
+        self.profiles = deque(maxlen=PROFILE_HISTORY)
+        self._profile_ids = itertools.count(1)
+
+    def record(self, endpoint, method, path, status, stats):
+        # Requests that matched no route (404s, 405s) share one entry
+        endpoint = endpoint or 'none'
+        wall_time = time.perf_counter() - stats.started
+        repeated = [(shape, count) for shape, count in stats.shapes.items() if count > self.threshold]
+        with self._lock:
+            self.endpoints[endpoint, method].add(status, wall_time, stats, repeated)
+            for shape, count in repeated:
+                self.n_plus_one.append({
+                    'endpoint': endpoint,
+                    'path': path,
+                    'count': count,
+                    'statement': shape,
+                    'at': datetime.utcnow(),
+                })
+        return wall_time, repeated
+
+    def add_profile(self, method, path, wall_time, sql_count, kind, report):
+        with self._lock:
+            profile = Profile(next(self._profile_ids), method, path, wall_time, sql_count, kind, report)
+            self.profiles.append(profile)
+        return profile
+
+    def get_profile(self, profile_id):
+        with self._lock:
+            return next((profile for profile in self.profiles if profile.id == profile_id), None)
+
+    def summary(self):
+        """Per-endpoint summaries, slowest total time first"""
+        with self._lock:
+            rows = [dict(endpoint=endpoint, method=method, **stats.summary())
+                    for (endpoint, method), stats in self.endpoints.items()]
+        return sorted(rows, key=lambda row: row['avg_ms'] * row['requests'], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self.started_at = datetime.utcnow()
+            self.endpoints.clear()
+            self.n_plus_one.clear()
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format"""
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            lines = []
+
+            def family(name, kind, help_text):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+
+            def labels(endpoint, method, **extra):
+                pairs = {'endpoint': endpoint, 'method': method, **extra}
+                return ','.join(f'{key}="{value}"' for key, value in pairs.items())
+
+            family('wonderland_requests_total', 'counter', 'Requests handled, by status class')
+            for (endpoint, method), stats in endpoints:
+                for status, count in sorted(stats.statuses.items()):
+                    lines.append(f'wonderland_requests_total{{{labels(endpoint, method, status=status)}}} {count}')
+
+            family('wonderland_request_duration_seconds', 'histogram', 'Request wall time')
+            for (endpoint, method), stats in endpoints:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append(f'wonderland_request_duration_seconds_bucket{{{labels(endpoint, method, le=bound)}}} '
+                                 f'{cumulative}')
+                lines.append(f'wonderland_request_duration_seconds_bucket{{{labels(endpoint, method, le="+Inf")}}} '
+                             f'{stats.requests}')
+                lines.append(f'wonderland_request_duration_seconds_sum{{{labels(endpoint, method)}}} {stats.wall_time}')
+                lines.append(f'wonderland_request_duration_seconds_count{{{labels(endpoint, method)}}} {stats.requests}')
+
+            for name, attribute, help_text in (
+                ('wonderland_template_duration_seconds_total', 'template_time', 'Time spent rendering templates'),
+                ('wonderland_sql_statements_total', 'sql_count', 'SQL statements executed'),
+                ('wonderland_sql_duration_seconds_total', 'sql_time', 'Time spent executing SQL statements'),
+                ('wonderland_n_plus_one_requests_total', 'n_plus_one', 'Requests that repeated a statement shape '
+                                                                        'more than the N+1 threshold'),
+            ):
+                family(name, 'counter', help_text)
+                for (endpoint, method), stats in endpoints:
+                    lines.append(f'{name}{{{labels(endpoint, method)}}} {getattr(stats, attribute)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _current():
+    return g.get('request_stats') if has_request_context() else None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current() is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current()
+    started = conn.info.get('query_started')
+    if stats is None or not started:
+        return
+    stats.sql_time += time.perf_counter() - started.pop()
+    stats.sql_count += 1
+    stats.shapes[statement_shape(statement)] += 1
+
+
+def _before_render(sender, template, context, **extra):
+    if _current() is not None:
+        g.template_started = time.perf_counter()
+
+
+def _after_render(sender, template, context, **extra):
+    stats = _current()
+    started = g.pop('template_started', None)
+    if stats is not None and started is not None:
+        stats.template_time += time.perf_counter() - started
+
+
+def _wants_profile(header):
+    if request.headers.get(header) != '1':
+        return False
+    return current_user.is_authenticated and current_user.is_admin
+
+
+def init_app(app):
+    """Instrument the app's requests, templates and engines"""
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    metrics = RequestMetrics(app.config.get('METRICS_N_PLUS_ONE_THRESHOLD', N_PLUS_ONE_THRESHOLD))
+    app.extensions['metrics'] = metrics
+    profile_header = app.config.get('METRICS_PROFILE_HEADER', 'X-Profile')
+
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_stats = RequestStats()
+        if _wants_profile(profile_header):
+            g.request_stats.profiler = _start_profiler()
+
+    @app.after_request
+    def finish_request_metrics(response):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return response
+        profiler, stats.profiler = stats.profiler, None
+        wall_time, repeated = metrics.record(request.endpoint, request.method, request.path,
+                                             response.status_code, stats)
+        for shape, count in repeated:
+            app.logger.warning('Possible N+1 query in %s: statement ran %d times: %s',
+                               request.endpoint, count, shape[:300])
+        if profiler is not None:
+            kind, report = _stop_profiler(profiler)
+            profile = metrics.add_profile(request.method, request.full_path.rstrip('?'), wall_time,
+                                          stats.sql_count, kind, report)
+            response.headers['X-Profile-Url'] = url_for('main.admin_metrics_profile', profile_id=profile.id)
+        return response
+
+    @app.teardown_request
+    def abandon_request_metrics(exc):
+        # Unhandled exceptions skip after_request; count them as server errors
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return
+        if stats.profiler is not None:
+            _stop_profiler(stats.profiler)
+        metrics.record(request.endpoint, request.method, request.path, 500, stats)
@@ -0,0 +1,298 @@
+"""Versioned schema migrations for Wonderland Toy Store
+
+Every schema or data change is a numbered step in MIGRATIONS. Applied steps
+are recorded in the schema_version table, so an up-to-date database costs a
+single SELECT at startup and each step runs exactly once per database::
+
+    FLASK_APP=run.py flask upgrade-schema
+
+Steps must be safe to run against databases that predate this table (they
+probe for columns and tables before changing them). Add new steps at the end
+of MIGRATIONS and never renumber one that has shipped. A shipped step may
+only be edited so that it also runs where it used to fail -- on another
+database dialect, or next to tables and columns that later models declare --
+and must still do exactly what it did on every database it already ran
+against; anything that changes an already migrated database is a new step.
+Steps 4, 5 and 10 and _create_indexes() have had such edits.
+"""
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.schema import CreateIndex
+
+from app import db
+from app.models import Order, OrderLine, OrderStatusChange
+
+schema_versions = db.Table(
+    'schema_version',
+    db.metadata,
+    db.Column('version', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('description', db.String(200), nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False),
+)
+
+# Legacy rows written by one checkout share these fields...
+LEGACY_ORDER_KEY = (
+    'user_id', 'status', 'full_name', 'email', 'phone', 'shipping_address', 'city', 'state',
+    'postal_code', 'payment_method', 'payment_status', 'promo_code', 'discount_percentage',
+)
+# ...and were created within moments of each other
+LEGACY_ORDER_WINDOW = timedelta(seconds=5)
+
+
+def fold_order_lines(connection):
+    """Fold the legacy one-row-per-item orders table into order headers and lines
+
+    Rows are grouped per checkout (same customer, shipping, payment and status,
+    created within LEGACY_ORDER_WINDOW); each group becomes one Order keeping
+    the id of its first row, with one OrderLine per original row. Returns
+    (legacy rows, orders written), or None if the table is already migrated.
+    """
+    inspector = inspect(connection)
+    if 'product_id' not in {col['name'] for col in inspector.get_columns('orders')}:
+        return None
+
+    # Tables referencing orders may already exist (empty) from create_all(); rebuild them against the new orders table
+    connection.execute(text('DROP TABLE IF EXISTS order_lines'))
+    connection.execute(text('DROP TABLE IF EXISTS order_status_changes'))
+    for index in inspector.get_indexes('orders'):
+        connection.execute(text(f'DROP INDEX IF EXISTS {index["name"]}'))
+    connection.execute(text('ALTER TABLE orders RENAME TO orders_legacy'))
+    Order.__table__.create(connection)
+    OrderLine.__table__.create(connection)
+    OrderStatusChange.__table__.create(connection)
+
+    legacy = db.Table('orders_legacy', db.MetaData(), autoload_with=connection)
+    rows = connection.execute(
+        db.select(legacy).order_by(legacy.c.user_id, legacy.c.created_at, legacy.c.id)
+    ).mappings().all()
+
+    headers, lines = [], []
+    current = None
+    for row in rows:
+        key = tuple(row[name] for name in LEGACY_ORDER_KEY)
+        if (current is None or key != current['key'] or row['created_at'] is None
+                or current['created_at'] is None
+                or row['created_at'] - current['created_at'] > LEGACY_ORDER_WINDOW):
+            current = {
+                'key': key,
+                'id': row['id'],
+                'total_price': 0,
+                'discount_amount': 0,
+                'transaction_id': row['transaction_id'],
+                'tracking_number': row['tracking_number'],
+                'created_at': row['created_at'],
+                'updated_at': row['updated_at'],
+                **{name: row[name] for name in LEGACY_ORDER_KEY},
+            }
+            headers.append(current)
+
+        discount_amount = row['discount_amount'] or 0
+        current['total_price'] += row['total_price']
+        current['discount_amount'] += discount_amount
+        if row['updated_at'] and (current['updated_at'] is None or row['updated_at'] > current['updated_at']):
+            current['updated_at'] = row['updated_at']
+        lines.append({
+            'order_id': current['id'],
+            'product_id': row['product_id'],
+            'quantity': row['quantity'],
+            'unit_price': (row['total_price'] + discount_amount) / row['quantity'] if row['quantity'] else row['total_price'],
+            'discount_amount': discount_amount,
+            'total_price': row['total_price'],
+        })
+
+    for header in headers:
+        del header['key']
+    if headers:
+        connection.execute(Order.__table__.insert(), headers)
+        connection.execute(OrderLine.__table__.insert(), lines)
+    connection.execute(text('DROP TABLE orders_legacy'))
+    return len(rows), len(headers)
+
+
+def _columns(connection, table):
+    return {col['name'] for col in inspect(connection).get_columns(table)}
+
+
+def _add_columns(connection, table, columns):
+    """ALTER TABLE ... ADD COLUMN for each (name, type) the table does not have yet"""
+    existing = _columns(connection, table)
+    for column_name, column_type in columns:
+        if column_name not in existing:
+            connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column_name} {column_type}'))
+
+
+def _create_tables(connection):
+    db.metadata.create_all(connection)
+
+
+def _add_product_columns(connection):
+    _add_columns(connection, 'products', [
+        ('category_id', 'INTEGER'),
+        ('image_filename', 'VARCHAR(255)'),
+    ])
+
+
+def _add_order_columns(connection):
+    _add_columns(connection, 'orders', [
+        ('full_name', 'VARCHAR(200)'),
+        ('email', 'VARCHAR(120)'),
+        ('phone', 'VARCHAR(20)'),
+        ('shipping_address', 'TEXT'),
+        ('city', 'VARCHAR(100)'),
+        ('state', 'VARCHAR(100)'),
+        ('postal_code', 'VARCHAR(20)'),
+        ('payment_method', "VARCHAR(50) DEFAULT 'cash_on_delivery'"),
+        ('payment_status', "VARCHAR(20) DEFAULT 'pending'"),
+        ('transaction_id', 'VARCHAR(100)'),
+        ('promo_code', 'VARCHAR(50)'),
+        ('discount_percentage', 'FLOAT DEFAULT 0'),
+        ('discount_amount', 'FLOAT DEFAULT 0'),
+        ('tracking_number', 'VARCHAR(100)'),
+    ])
+
+
+def _clear_empty_reset_token_expiry(connection):
+    # Only SQLite ever stored '' in a DATETIME column; other databases reject the comparison
+    if connection.dialect.name != 'sqlite':
+        return
+    connection.execute(text("UPDATE users SET reset_token_expires = NULL WHERE reset_token_expires = ''"))
+
+
+def _fold_order_lines(connection):
+    result = fold_order_lines(connection)
+    if result:
+        print(f"✓ Folded {result[0]} order rows into {result[1]} orders with line items")
+
+
+def _add_category_product_count(connection):
+    if 'product_count' not in _columns(connection, 'categories'):
+        connection.execute(text('ALTER TABLE categories ADD COLUMN product_count INTEGER NOT NULL DEFAULT 0'))
+    from app.catalog import refresh_category_counts
+    refresh_category_counts()
+
+
+def _add_user_order_stats(connection):
+    _add_columns(connection, 'users', [
+        ('order_count', 'INTEGER NOT NULL DEFAULT 0'),
+        ('lifetime_spend', 'FLOAT NOT NULL DEFAULT 0'),
+        ('last_order_at', 'TIMESTAMP'),
+    ])
+    from app.admin_reports import refresh_user_order_stats
+    refresh_user_order_stats()
+    _create_indexes(connection)
+
+
+def _create_indexes(connection):
+    """Create indexes declared on models that older databases are missing
+
+    Indexes on columns that a later step adds are left for that step to create.
+    """
+    for table in db.metadata.sorted_tables:
+        existing = _columns(connection, table.name)
+        for index in table.indexes:
+            if all(column.name in existing for column in index.columns):
+                # IF NOT EXISTS rather than checkfirst, which cannot see expression indexes
+                connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+def _build_rollups(connection):
+    from app.rollups import rebuild_rollups
+    rebuild_rollups()
+
+
+def _add_catalog_sort_indexes(connection):
+    # Keyset pagination compares is_featured as part of the sort key, so it must not be NULL
+    # (FALSE rather than 0 so PostgreSQL accepts it; SQLite stores the same value)
+    connection.execute(text('UPDATE products SET is_featured = FALSE WHERE is_featured IS NULL'))
+    _create_indexes(connection)
+
+
+def _add_product_image_variants(connection):
+    # Filled in by `flask process-images`
+    _add_columns(connection, 'products', [('image_variants', 'JSON')])
+
+
+def _add_product_sku(connection):
+    _add_columns(connection, 'products', [('sku', 'VARCHAR(64)')])
+    _create_indexes(connection)
+
+
+def _create_search_index(connection):
+    from app.search import create_search_index
+    create_search_index(connection)
+
+
+MIGRATIONS = [
+    (1, 'Create tables', _create_tables),
+    (2, 'Add product category and image columns', _add_product_columns),
+    (3, 'Add order shipping, payment and discount columns', _add_order_columns),
+    (4, 'Clear empty password reset expiry dates', _clear_empty_reset_token_expiry),
+    (5, 'Fold order rows into order headers and lines', _fold_order_lines),
+    (6, 'Add denormalized category product counts', _add_category_product_count),
+    (7, 'Create model indexes', _create_indexes),
+    (8, 'Build sales rollups', _build_rollups),
+    (9, 'Create full-text product search index', _create_search_index),
+    (10, 'Add catalog sort and facet indexes', _add_catalog_sort_indexes),
+    (11, 'Add product image variants column', _add_product_image_variants),
+    (12, 'Create background jobs table', _create_tables),
+    (13, 'Add product SKU column', _add_product_sku),
+    (14, 'Add admin order listing indexes', _create_indexes),
+    (15, 'Create order status audit log', _create_tables),
+    (16, 'Add cart item lookup index', _create_indexes),
+    (17, 'Add denormalized user order aggregates', _add_user_order_stats),
+    (18, 'Add admin user search indexes', _create_indexes),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version():
+    """Return the version of the connected database, 0 if it has never been migrated"""
+    try:
+        with db.engine.connect() as connection:
+            return connection.execute(db.select(db.func.max(schema_versions.c.version))).scalar() or 0
+    except (OperationalError, ProgrammingError):
+        # schema_version table does not exist yet
+        return 0
+
+
+def upgrade_schema():
+    """Apply pending migrations in order, each in its own transaction; returns the versions applied"""
+    version = schema_version()
+    applied = []
+    for number, description, migrate in MIGRATIONS:
+        if number <= version:
+            continue
+        connection = db.session.connection()
+        schema_versions.create(connection, checkfirst=True)
+        migrate(connection)
+        db.session.execute(schema_versions.insert().values(
+            version=number, description=description, applied_at=datetime.utcnow()
+        ))
+        db.session.commit()
+        print(f"✓ Applied migration {number}: {description}")
+        applied.append(number)
+    return applied
+
+
+@click.command('upgrade-schema')
+@with_appcontext
+def upgrade_schema_command():
+    """Apply pending database migrations"""
+    applied = upgrade_schema()
+    click.echo(f'✓ Database schema at version {LATEST_VERSION}' + ('' if applied else ' (already up to date)'))
+
+
+@click.command('schema-version')
+@with_appcontext
+def schema_version_command():
+    """Show the database schema version"""
+    version = schema_version()
+    pending = [f'{number}: {description}' for number, description, _ in MIGRATIONS if number > version]
+    click.echo(f'Database schema version {version} of {LATEST_VERSION}')
+    for line in pending:
+        click.echo(f'  pending {line}')
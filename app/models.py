@@ -1,5 +1,6 @@
 """Database models for Wonderland Toy Store"""
 from app import db
+from sqlalchemy import event
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
@@ -12,6 +13,8 @@ class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=True, nullable=False)
     description = db.Column(db.Text)
+    # Denormalized count kept in sync by the Product mapper events below
+    product_count = db.Column(db.Integer, default=0, nullable=False, server_default='0')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     products = db.relationship('Product', backref='category', lazy=True)
@@ -31,11 +34,24 @@ class User(UserMixin, db.Model):
     reset_token_expires = db.Column(db.DateTime, nullable=True)
     is_admin = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Denormalized order aggregates kept in sync by the Order mapper events below
+    order_count = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    lifetime_spend = db.Column(db.Float, default=0, nullable=False, server_default='0')
+    last_order_at = db.Column(db.DateTime, nullable=True)
     
     cart = db.relationship('Cart', backref='user', lazy=True, uselist=False)
     orders = db.relationship('Order', backref='user', lazy=True)
     wishlist_items = db.relationship('Wishlist', backref='user', lazy=True, cascade='all, delete-orphan')
     
+    # Admin user listing sorts and prefix search (see app/admin_reports.py)
+    __table_args__ = (
+        db.Index('ix_users_lifetime_spend_id', 'lifetime_spend', 'id'),
+        db.Index('ix_users_order_count_id', 'order_count', 'id'),
+        db.Index('ix_users_last_order_at_id', 'last_order_at', 'id'),
+        db.Index('ix_users_username_lower', db.func.lower(username)),
+        db.Index('ix_users_email_lower', db.func.lower(email)),
+    )
+    
     def set_password(self, password):
         """Hash and set password"""
         self.password_hash = generate_password_hash(password)
@@ -71,20 +87,37 @@ class Product(db.Model):
     __tablename__ = 'products'
     
     id = db.Column(db.Integer, primary_key=True)
+    # Supplier stock-keeping unit; bulk imports (app/imports.py) upsert on it
+    sku = db.Column(db.String(64), nullable=True)
     name = db.Column(db.String(120), nullable=False)
     price = db.Column(db.Float, nullable=False)
     description = db.Column(db.Text)
     stock = db.Column(db.Integer, default=0)
-    category_id = db.Column(db.Integer, db.ForeignKey('categories.id'), nullable=True)
+    # active_history keeps the previous value available to the recategorize event
+    category_id = db.column_property(db.Column(db.Integer, db.ForeignKey('categories.id'), nullable=True), active_history=True)
     image_filename = db.Column(db.String(255), nullable=True)
+    # Resized/re-encoded variants of the image and its placeholder (see app/images.py)
+    image_variants = db.Column(db.JSON(none_as_null=True), nullable=True)
     is_featured = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    orders = db.relationship('Order', backref='product', lazy=True)
+    order_lines = db.relationship('OrderLine', backref='product', lazy=True)
     cart_items = db.relationship('CartItem', backref='product', lazy=True)
     wishlist_items = db.relationship('Wishlist', backref='product', lazy=True, cascade='all, delete-orphan')
     
+    # Composite indexes backing keyset pagination of the catalog sorts (see app/catalog.py)
+    # and the facet counts query (see app/facets.py)
+    __table_args__ = (
+        db.Index('ix_products_category_created_id', 'category_id', 'created_at', 'id'),
+        db.Index('ix_products_created_id', 'created_at', 'id'),
+        db.Index('ix_products_category_price_id', 'category_id', 'price', 'id'),
+        db.Index('ix_products_price_id', 'price', 'id'),
+        db.Index('ix_products_featured_created_id', 'is_featured', 'created_at', 'id'),
+        db.Index('ix_products_facets', 'category_id', 'price', 'stock', 'is_featured'),
+        db.Index('ix_products_sku', 'sku', unique=True),
+    )
+    
     def is_in_stock(self):
         """Check if product is in stock"""
         return self.stock > 0
@@ -92,6 +125,35 @@ class Product(db.Model):
     def __repr__(self):
         return f'<Product {self.name}>'
 
+def _adjust_category_count(connection, category_id, delta):
+    """Add delta to a category's denormalized product_count"""
+    if category_id is None:
+        return
+    categories = Category.__table__
+    connection.execute(
+        categories.update()
+        .where(categories.c.id == category_id)
+        .values(product_count=categories.c.product_count + delta)
+    )
+
+@event.listens_for(Product, 'after_insert')
+def _product_inserted(mapper, connection, product):
+    _adjust_category_count(connection, product.category_id, 1)
+
+@event.listens_for(Product, 'after_delete')
+def _product_deleted(mapper, connection, product):
+    _adjust_category_count(connection, product.category_id, -1)
+
+@event.listens_for(Product, 'after_update')
+def _product_recategorized(mapper, connection, product):
+    history = db.inspect(product).attrs.category_id.history
+    if not history.has_changes():
+        return
+    old_category_id = history.deleted[0] if history.deleted else None
+    if old_category_id != product.category_id:
+        _adjust_category_count(connection, old_category_id, -1)
+        _adjust_category_count(connection, product.category_id, 1)
+
 class Cart(db.Model):
     """Shopping cart model"""
     __tablename__ = 'carts'
@@ -113,6 +175,10 @@ class Cart(db.Model):
 class CartItem(db.Model):
     """Shopping cart item model"""
     __tablename__ = 'cart_items'
+    __table_args__ = (
+        # Loading a cart's lines and finding a product already in the cart
+        db.Index('ix_cart_items_cart_product', 'cart_id', 'product_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     cart_id = db.Column(db.Integer, db.ForeignKey('carts.id'), nullable=False)
@@ -123,6 +189,19 @@ class CartItem(db.Model):
     def __repr__(self):
         return f'<CartItem {self.product_id} x{self.quantity}>'
 
+class StockReservation(db.Model):
+    """Stock held for a cart during checkout; returned to the product when it expires"""
+    __tablename__ = 'stock_reservations'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    cart_id = db.Column(db.Integer, db.ForeignKey('carts.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<StockReservation cart {self.cart_id}: {self.product_id} x{self.quantity}>'
+
 class Wishlist(db.Model):
     """Wishlist model"""
     __tablename__ = 'wishlist'
@@ -138,7 +217,7 @@ class Wishlist(db.Model):
         return f'<Wishlist {self.user_id}-{self.product_id}>'
 
 class Order(db.Model):
-    """Order model with status tracking"""
+    """Order header with status tracking; the purchased items are OrderLines"""
     __tablename__ = 'orders'
     
     # Order status constants
@@ -159,11 +238,11 @@ class Order(db.Model):
     PAYMENT_FAILED = 'failed'
     
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
-    quantity = db.Column(db.Integer, default=1, nullable=False)
+    # active_history keeps the previous owner available to the user order aggregate events
+    user_id = db.column_property(db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False), active_history=True)
     total_price = db.Column(db.Float, nullable=False)
-    status = db.Column(db.String(20), default=STATUS_PENDING)
+    # active_history keeps the previous status available to the sales rollup events
+    status = db.column_property(db.Column(db.String(20), default=STATUS_PENDING), active_history=True)
     
     # Shipping details
     full_name = db.Column(db.String(200), nullable=True)
@@ -188,5 +267,179 @@ class Order(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    lines = db.relationship('OrderLine', backref='order', lazy=True, cascade='all, delete-orphan', order_by='OrderLine.id')
+    
+    # Covers per-user order aggregates (count, spend, last order) and history lookups,
+    # and the admin orders listing (newest first, optionally by status; see app/admin_reports.py)
+    __table_args__ = (
+        db.Index('ix_orders_user_created_total', 'user_id', 'created_at', 'total_price'),
+        db.Index('ix_orders_status_created', 'status', 'created_at'),
+        db.Index('ix_orders_created', 'created_at'),
+    )
+    
+    @property
+    def item_count(self):
+        """Total units across all lines"""
+        return sum(line.quantity for line in self.lines)
+    
     def __repr__(self):
         return f'<Order {self.id} - {self.status}>'
+
+def user_order_stats():
+    """Column values recomputing a user's denormalized order aggregates from the orders table"""
+    orders = Order.__table__
+    users = User.__table__
+    aggregate = lambda column: db.select(column).where(orders.c.user_id == users.c.id).scalar_subquery()
+    return {
+        'order_count': aggregate(db.func.count(orders.c.id)),
+        'lifetime_spend': aggregate(db.func.coalesce(db.func.sum(orders.c.total_price), 0)),
+        'last_order_at': aggregate(db.func.max(orders.c.created_at)),
+    }
+
+def _recount_user_orders(connection, user_id):
+    users = User.__table__
+    connection.execute(users.update().where(users.c.id == user_id).values(user_order_stats()))
+
+@event.listens_for(Order, 'after_insert')
+def _order_inserted(mapper, connection, order):
+    users = User.__table__
+    created_at = order.created_at
+    connection.execute(
+        users.update()
+        .where(users.c.id == order.user_id)
+        .values(
+            order_count=users.c.order_count + 1,
+            lifetime_spend=users.c.lifetime_spend + order.total_price,
+            last_order_at=db.case(
+                (db.or_(users.c.last_order_at.is_(None), users.c.last_order_at < created_at), created_at),
+                else_=users.c.last_order_at,
+            ),
+        )
+    )
+
+@event.listens_for(Order, 'after_delete')
+def _order_deleted(mapper, connection, order):
+    _recount_user_orders(connection, order.user_id)
+
+@event.listens_for(Order, 'after_update')
+def _order_changed(mapper, connection, order):
+    # Status changes leave the aggregates alone: they count every order, cancelled or not
+    state = db.inspect(order)
+    user_history = state.attrs.user_id.history
+    if user_history.has_changes():
+        for old_user_id in user_history.deleted:
+            if old_user_id is not None:
+                _recount_user_orders(connection, old_user_id)
+    if user_history.has_changes() or any(state.attrs[name].history.has_changes()
+                                         for name in ('total_price', 'created_at')):
+        _recount_user_orders(connection, order.user_id)
+
+class OrderLine(db.Model):
+    """One purchased product within an order"""
+    __tablename__ = 'order_lines'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False, index=True)
+    quantity = db.Column(db.Integer, default=1, nullable=False)
+    unit_price = db.Column(db.Float, nullable=False)
+    discount_amount = db.Column(db.Float, default=0)
+    total_price = db.Column(db.Float, nullable=False)
+    
+    def __repr__(self):
+        return f'<OrderLine {self.order_id}: {self.product_id} x{self.quantity}>'
+
+class OrderStatusChange(db.Model):
+    """Audit log entry for one order status change (see app/order_status.py)"""
+    __tablename__ = 'order_status_changes'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False, index=True)
+    old_status = db.Column(db.String(20), nullable=True)
+    new_status = db.Column(db.String(20), nullable=False)
+    # The admin who made the change; None for changes made from the command line
+    changed_by_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    def __repr__(self):
+        return f'<OrderStatusChange {self.order_id}: {self.old_status} -> {self.new_status}>'
+
+class SalesDaily(db.Model):
+    """Sales rollup per calendar day (UTC), excluding cancelled orders"""
+    __tablename__ = 'sales_daily'
+    
+    day = db.Column(db.Date, primary_key=True)
+    order_count = db.Column(db.Integer, default=0, nullable=False)
+    units_sold = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f'<SalesDaily {self.day}>'
+
+class SalesHourly(db.Model):
+    """Sales rollup per hour (UTC), excluding cancelled orders"""
+    __tablename__ = 'sales_hourly'
+    
+    hour = db.Column(db.DateTime, primary_key=True)
+    order_count = db.Column(db.Integer, default=0, nullable=False)
+    units_sold = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f'<SalesHourly {self.hour}>'
+
+class ProductSales(db.Model):
+    """Lifetime sales rollup per product, excluding cancelled orders"""
+    __tablename__ = 'product_sales'
+    
+    product_id = db.Column(db.Integer, primary_key=True)
+    units_sold = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<ProductSales {self.product_id}>'
+
+class StoreCounter(db.Model):
+    """Store-wide running totals read by the admin dashboard"""
+    __tablename__ = 'store_counters'
+    
+    USERS = 'users'
+    PRODUCTS = 'products'
+    ORDERS = 'orders'
+    REVENUE = 'revenue'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Float, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f'<StoreCounter {self.name}={self.value}>'
+
+class Job(db.Model):
+    """Background job waiting for, or handled by, a worker (see app/jobs.py)"""
+    __tablename__ = 'jobs'
+    
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+    status = db.Column(db.String(20), nullable=False, default=QUEUED)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    # Earliest time the job may run; pushed back after a failed attempt
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # A running job whose worker has not finished by then is handed to another worker
+    locked_until = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+    
+    def __repr__(self):
+        return f'<Job {self.id} {self.name} {self.status}>'
@@ -0,0 +1,142 @@
+"""Order status state machine and bulk status transitions
+
+Orders move forward through fulfilment one step at a time::
+
+    pending -> processing -> shipped -> delivered
+
+Pending and processing orders can be cancelled, which returns their stock;
+a cancelled order can be restored to pending, which takes the stock again.
+Shipped and delivered orders can no longer be cancelled.
+
+transition_orders() moves a batch of orders to a new status with one SELECT
+of their current statuses, one guarded UPDATE of the orders and one INSERT
+into the OrderStatusChange audit log. Cancellations and restorations add one
+grouped SELECT of the units per product and one UPDATE of the products'
+stock (see app/inventory.py), and adjust the sales rollups once per
+affected day, hour and product rather than once per order. The customers'
+cached dashboard stats, and the product and facet caches when stock moved,
+are dropped when the caller commits.
+"""
+from datetime import datetime
+
+from app import db
+from app.cache import mark_cache_dirty
+from app.inventory import adjust_stock
+from app.models import Order, OrderLine, OrderStatusChange
+from app.rollups import apply_order_changes
+from app.user_stats import mark_user_stats_dirty
+
+TRANSITIONS = {
+    Order.STATUS_PENDING: (Order.STATUS_PROCESSING, Order.STATUS_CANCELLED),
+    Order.STATUS_PROCESSING: (Order.STATUS_SHIPPED, Order.STATUS_CANCELLED),
+    Order.STATUS_SHIPPED: (Order.STATUS_DELIVERED,),
+    Order.STATUS_DELIVERED: (),
+    Order.STATUS_CANCELLED: (Order.STATUS_PENDING,),
+}
+
+# Largest number of orders one call may change; keeps the IN lists well under
+# the database's bound parameter limit
+MAX_BULK_ORDERS = 1000
+
+
+class TransitionError(ValueError):
+    """Raised for an unknown target status or too many orders"""
+
+
+class TransitionResult:
+    """Orders moved to the new status, and why the others were not"""
+
+    def __init__(self, status, updated, rejected):
+        self.status = status
+        self.updated = updated
+        # {order_id: reason}
+        self.rejected = rejected
+
+
+def allowed_transitions(status):
+    """Return the statuses an order in the given status may move to"""
+    return TRANSITIONS.get(status, ())
+
+
+def _units_per_product(order_ids):
+    return dict(
+        db.session.query(OrderLine.product_id, db.func.sum(OrderLine.quantity))
+        .filter(OrderLine.order_id.in_(order_ids))
+        .group_by(OrderLine.product_id)
+    )
+
+
+def transition_orders(order_ids, new_status, changed_by_id=None):
+    """Move orders to new_status where the state machine allows it
+
+    Orders that do not exist, are already in new_status or may not move to it
+    are left alone and reported in the result's rejected map. Raises
+    TransitionError for an unknown status or more than MAX_BULK_ORDERS orders,
+    and InsufficientStock if restoring cancelled orders needs more stock than
+    is left; the caller must then roll back. The caller commits.
+    """
+    if new_status not in TRANSITIONS:
+        raise TransitionError(f'Unknown order status: {new_status}')
+    order_ids = list(dict.fromkeys(order_ids))
+    if len(order_ids) > MAX_BULK_ORDERS:
+        raise TransitionError(f'At most {MAX_BULK_ORDERS} orders can be changed at once')
+
+    current = dict(db.session.query(Order.id, Order.status).filter(Order.id.in_(order_ids))) if order_ids else {}
+    rejected = {}
+    old_statuses = {}
+    for order_id in order_ids:
+        if order_id not in current:
+            rejected[order_id] = 'Order not found'
+        elif current[order_id] == new_status:
+            rejected[order_id] = f'Already {new_status}'
+        elif new_status not in allowed_transitions(current[order_id]):
+            rejected[order_id] = f'Cannot change a {current[order_id]} order to {new_status}'
+        else:
+            old_statuses[order_id] = current[order_id]
+    if not old_statuses:
+        return TransitionResult(new_status, [], rejected)
+
+    # Only orders still in the status they were read with are changed, so a
+    # concurrent change cannot be overwritten or logged with the wrong old status
+    now = datetime.utcnow()
+    updated = [order_id for order_id, in db.session.execute(
+        db.update(Order)
+        .where(Order.id.in_(old_statuses), Order.status == db.case(old_statuses, value=Order.id))
+        .values(status=new_status, updated_at=now)
+        .returning(Order.id)
+        .execution_options(synchronize_session=False)
+    )]
+    for order_id in set(old_statuses) - set(updated):
+        rejected[order_id] = 'Changed by someone else in the meantime'
+    if not updated:
+        return TransitionResult(new_status, [], rejected)
+
+    # The Core UPDATE skips the Order events that drop the customers' cached dashboard stats
+    mark_user_stats_dirty(db.session, *(user_id for user_id, in db.session.query(Order.user_id.distinct())
+                                        .filter(Order.id.in_(updated))))
+
+    if new_status == Order.STATUS_CANCELLED:
+        adjust_stock({product_id: -units for product_id, units in _units_per_product(updated).items()})
+        apply_order_changes(updated, -1)
+        mark_cache_dirty(db.session, 'products', 'facets')
+    elif old_statuses[updated[0]] == Order.STATUS_CANCELLED:
+        # Only cancelled orders can move to pending, so these are all restorations
+        adjust_stock(_units_per_product(updated))
+        apply_order_changes(updated, 1)
+        mark_cache_dirty(db.session, 'products', 'facets')
+
+    db.session.execute(db.insert(OrderStatusChange), [{
+        'order_id': order_id,
+        'old_status': old_statuses[order_id],
+        'new_status': new_status,
+        'changed_by_id': changed_by_id,
+        'created_at': now,
+    } for order_id in updated])
+
+    # Orders already loaded in this session would otherwise show the old status
+    changed = set(updated)
+    for order in db.session.identity_map.values():
+        if isinstance(order, Order) and db.inspect(order).identity[0] in changed:
+            db.session.expire(order, ['status', 'updated_at'])
+
+    return TransitionResult(new_status, updated, rejected)
@@ -0,0 +1,146 @@
+"""Response and fragment caching for catalog pages
+
+``@cache_page`` stores the rendered HTML of anonymous GET requests in the
+"pages" cache namespace, keyed on the catalog version, path and query string,
+together with gzip (and, if the brotli package is installed, brotli) encoded
+copies. Responses carry a strong ETag per encoding and conditional requests
+are answered with 304 Not Modified. Requests from logged-in users, or with
+flashed messages waiting to be shown, are rendered normally.
+
+``{% cache 'name', key... %}...{% endcache %}`` caches a piece of a template
+in the "fragments" namespace, so category and product cards are rendered once
+and reused by anonymous and logged-in pages alike. Anything that depends on
+the user must stay outside the block.
+
+The catalog version is a random token stored in the cache and replaced after
+every committed Product or Category write (the "pages" and "fragments"
+namespaces are cleared at the same time). Keys include it, so a page rendered
+from old data by another worker while the catalog changed is never served.
+"""
+import gzip
+import hashlib
+import secrets
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import current_app, g, request, session, Response
+from flask_login import current_user
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from app.cache import cache, invalidate_on
+from app.models import Product, Category
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 500
+
+
+class _Uncacheable(Exception):
+    """Raised from a page loader to hand back a response that must not be cached"""
+
+    def __init__(self, response):
+        self.response = response
+
+
+def catalog_version():
+    """Token identifying the current state of the catalog, read once per request"""
+    if 'catalog_version' not in g:
+        g.catalog_version = cache.get_or_load('catalog', 'version', lambda: secrets.token_hex(8))
+    return g.catalog_version
+
+
+def _page_key():
+    args = urlencode(sorted(request.args.items(multi=True)))
+    return f'{catalog_version()}:{request.path}?{args}'
+
+
+def _cacheable_request():
+    return (current_app.config.get('PAGE_CACHE', True)
+            and request.method in ('GET', 'HEAD')
+            and not current_user.is_authenticated
+            and '_flashes' not in session)
+
+
+def _page_entry(response):
+    """The cached form of a response: its body in every encoding, with their ETags"""
+    if response.status_code != 200 or response.mimetype != 'text/html' or response.is_streamed:
+        raise _Uncacheable(response)
+    body = response.get_data()
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    bodies = {'identity': body}
+    if len(body) >= MIN_COMPRESS_SIZE:
+        bodies['gzip'] = gzip.compress(body, compresslevel=6, mtime=0)
+        if brotli is not None:
+            bodies['br'] = brotli.compress(body)
+    return {
+        'content_type': response.content_type,
+        'bodies': bodies,
+        # Strong validators must differ between encodings of the same page
+        'etags': {encoding: f'{digest}-{encoding}' for encoding in bodies},
+    }
+
+
+def _respond(entry):
+    encoding = request.accept_encodings.best_match([e for e in ('br', 'gzip') if e in entry['bodies']]) \
+        or 'identity'
+    etag = entry['etags'][encoding]
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry['bodies'][encoding], content_type=entry['content_type'])
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    # Browsers revalidate every time; the page differs for logged-in users
+    response.cache_control.no_cache = True
+    response.vary.update(['Accept-Encoding', 'Cookie'])
+    return response
+
+
+def cache_page(view):
+    """Serve a view's anonymous responses from the page cache"""
+
+    @wraps(view)
+    def cached_view(*args, **kwargs):
+        if not _cacheable_request():
+            return view(*args, **kwargs)
+
+        def render():
+            return _page_entry(current_app.make_response(view(*args, **kwargs)))
+
+        try:
+            entry = cache.get_or_load('pages', _page_key(), render)
+        except _Uncacheable as uncacheable:
+            return uncacheable.response
+        return _respond(entry)
+
+    return cached_view
+
+
+class FragmentCacheExtension(Extension):
+    """Jinja tag caching the rendered output of its body: {% cache 'name', key... %}"""
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        keys = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            keys.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method('_cached_fragment', [nodes.Const(parser.name), nodes.List(keys)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _cached_fragment(self, template_name, keys, caller):
+        key = ':'.join([catalog_version(), template_name or ''] + [str(key) for key in keys])
+        return Markup(cache.get_or_load('fragments', key, lambda: str(caller())))
+
+
+invalidate_on(Category, 'catalog', 'pages', 'fragments')
+invalidate_on(Product, 'catalog', 'pages', 'fragments')
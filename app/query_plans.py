@@ -0,0 +1,159 @@
+"""EXPLAIN QUERY PLAN over captured SQL, flagging full-table scans
+
+QueryCapture records every statement an engine runs, one example per
+statement shape (IN lists of any length count as one) with its parameters,
+how often it ran and the endpoints that ran it, and saves them as JSON lines.
+benchmarks/journeys.py --capture-sql writes such a file from a load test.
+
+`flask explain-queries FILE` runs EXPLAIN QUERY PLAN for each captured
+statement against the app's SQLite database and reports the ones whose plan
+reads a whole table ("SCAN <table>" without an index). Scans of an index
+(for ORDER BY or COUNT) and of full-text tables are not flagged; sorts in a
+temporary B-tree are listed as notes. Exits non-zero if a scan is found, so
+it can gate a benchmark run; --ignore accepts tables that are meant to be
+read whole (e.g. the short categories list).
+"""
+import json
+import re
+import threading
+
+import click
+from flask import has_request_context, request
+from flask.cli import with_appcontext
+from sqlalchemy import event
+
+from app import db
+from app.metrics import statement_shape
+
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+# Characters of each statement shown in the report
+STATEMENT_PREVIEW = 300
+
+_FULL_SCAN = re.compile(r'^SCAN (\S+)$')
+_ALIAS = re.compile(r'"?(\w+)"? AS "?(\w+)"?')
+
+
+class QueryCapture:
+    """Statements run on an engine, one example per shape"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = {}
+
+    def listen(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if executemany and parameters and isinstance(parameters[0], (list, tuple, dict)):
+            # One row of the batch is enough to explain it
+            parameters = parameters[0]
+        endpoint = request.endpoint if has_request_context() else None
+        shape = statement_shape(statement)
+        with self._lock:
+            query = self.queries.get(shape)
+            if query is None:
+                query = self.queries[shape] = {'statement': statement, 'parameters': parameters,
+                                               'count': 0, 'endpoints': []}
+            query['count'] += 1
+            if endpoint and endpoint not in query['endpoints']:
+                query['endpoints'].append(endpoint)
+
+    def save(self, path):
+        """Write the captured statements as JSON lines; returns how many"""
+        with self._lock, open(path, 'w') as output:
+            for query in self.queries.values():
+                output.write(json.dumps(query, default=str) + '\n')
+            return len(self.queries)
+
+
+def load_queries(path):
+    with open(path) as stream:
+        return [json.loads(line) for line in stream if line.strip()]
+
+
+def explain(connection, statement, parameters):
+    """The detail lines of SQLite's query plan for a statement"""
+    if isinstance(parameters, list):
+        parameters = tuple(parameters)
+    rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters or ())
+    return [detail for _, _, _, detail in rows]
+
+
+def full_scans(statement, plan, tables):
+    """Tables a plan reads in full; aliases are resolved through the statement's "table AS alias" pairs"""
+    aliases = {alias: table for table, alias in _ALIAS.findall(statement) if table in tables}
+    scanned = []
+    for detail in plan:
+        match = _FULL_SCAN.match(detail.strip())
+        if not match:
+            continue
+        name = match.group(1)
+        table = name if name in tables else aliases.get(name)
+        if table and table not in scanned:
+            scanned.append(table)
+    return scanned
+
+
+def check_queries(queries, ignore=()):
+    """Explain captured queries; returns (findings, notes, statements explained)
+
+    Findings are (tables scanned, query, plan), most frequently run first.
+    Notes are (plan line, query) for sorts and groupings in a temporary B-tree.
+    """
+    findings, notes, explained = [], [], 0
+    with db.engine.connect() as connection:
+        tables = {name for name, in connection.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")}
+        # Full-text tables are searched through their own index
+        tables -= {name for name, in connection.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE sql LIKE 'CREATE VIRTUAL TABLE%'")}
+        for query in queries:
+            statement = query['statement']
+            if not statement.lstrip().upper().startswith(EXPLAINABLE):
+                continue
+            plan = explain(connection, statement, query['parameters'])
+            explained += 1
+            scanned = [table for table in full_scans(statement, plan, tables) if table not in ignore]
+            if scanned:
+                findings.append((scanned, query, plan))
+            notes += [(detail, query) for detail in plan if 'TEMP B-TREE' in detail]
+        connection.rollback()
+    findings.sort(key=lambda finding: -finding[1]['count'])
+    return findings, notes, explained
+
+
+def _describe(query):
+    endpoints = ', '.join(query['endpoints']) or 'outside a request'
+    statement = ' '.join(query['statement'].split())
+    if len(statement) > STATEMENT_PREVIEW:
+        statement = statement[:STATEMENT_PREVIEW] + '...'
+    return f'ran {query["count"]}x in {endpoints}', statement
+
+
+@click.command('explain-queries')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--ignore', multiple=True, metavar='TABLE', help='Table that may be scanned in full (repeatable)')
+@click.option('--notes/--no-notes', default=False, help='Also list sorts and groupings done in a temporary B-tree')
+@with_appcontext
+def explain_queries_command(path, ignore, notes):
+    """Run EXPLAIN QUERY PLAN over captured SQL and flag full-table scans"""
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('explain-queries reads SQLite query plans; point DATABASE_URL at an SQLite copy')
+    findings, sorts, explained = check_queries(load_queries(path), set(ignore))
+
+    for scanned, query, plan in findings:
+        where, statement = _describe(query)
+        click.echo(f'✗ Full scan of {", ".join(scanned)} ({where})')
+        click.echo(f'    {statement}')
+        for detail in plan:
+            click.echo(f'      {detail}')
+    if notes:
+        for detail, query in sorts:
+            where, statement = _describe(query)
+            click.echo(f'Note: {detail} ({where})')
+            click.echo(f'    {statement}')
+
+    if findings:
+        click.echo(f'{len(findings)} of {explained} statements scan a whole table')
+        raise SystemExit(1)
+    click.echo(f'✓ {explained} statements explained, no full-table scans')
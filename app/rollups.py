@@ -0,0 +1,304 @@
+"""Materialized sales rollups for the admin dashboard
+
+Order, user and product writes update small summary tables (sales per day,
+per hour and per product, plus store-wide counters) from mapper events in the
+same transaction, so the dashboard reads a handful of rows instead of
+aggregating the orders table on every page view.
+
+Cancelled orders are excluded from sales figures; the orders counter still
+counts every order. ``flask rebuild-rollups`` recomputes everything from
+scratch, e.g. after bulk imports that bypass the ORM; with ``--queue`` it
+leaves the rebuild to a background job.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event
+
+from app import db
+from app.jobs import enqueue, task
+from app.models import User, Product, Order, OrderLine, SalesDaily, SalesHourly, ProductSales, StoreCounter
+
+
+def _increment(connection, table, key, deltas):
+    """Add deltas to the rollup row identified by key, creating the row if missing
+
+    One INSERT ... ON CONFLICT DO UPDATE, so concurrent transactions creating
+    the same row cannot both try to insert it. Databases without it fall
+    back to UPDATE, then INSERT if no row was updated.
+    """
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        where = [table.c[name] == value for name, value in key.items()]
+        values = {name: table.c[name] + delta for name, delta in deltas.items()}
+        result = connection.execute(table.update().where(*where).values(values))
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(**key, **deltas))
+        return
+    statement = insert(table).values(**key, **deltas)
+    connection.execute(statement.on_conflict_do_update(
+        index_elements=list(key),
+        set_={name: table.c[name] + statement.excluded[name] for name in deltas},
+    ))
+
+
+def _increment_counter(connection, name, delta):
+    _increment(connection, StoreCounter.__table__, {'name': name}, {'value': delta})
+
+
+def _is_sale(status):
+    return status != Order.STATUS_CANCELLED
+
+
+def _bucket_keys(created_at):
+    """Return the day and the hour a timestamp is rolled up under"""
+    created_at = created_at or datetime.utcnow()
+    return created_at.date(), created_at.replace(minute=0, second=0, microsecond=0)
+
+
+def _time_buckets(created_at):
+    """Return the (table, key) pairs of the daily and hourly rows for a timestamp"""
+    day, hour = _bucket_keys(created_at)
+    return (
+        (SalesDaily.__table__, {'day': day}),
+        (SalesHourly.__table__, {'hour': hour}),
+    )
+
+
+def _apply_order(connection, order, sign):
+    """Add (sign=1) or remove (sign=-1) an order header's count and revenue"""
+    for table, key in _time_buckets(order.created_at):
+        _increment(connection, table, key, {'order_count': sign, 'revenue': sign * order.total_price})
+    _increment_counter(connection, StoreCounter.REVENUE, sign * order.total_price)
+
+
+def _apply_line(connection, created_at, product_id, quantity, total_price, sign):
+    """Add (sign=1) or remove (sign=-1) an order line's units and product sales"""
+    for table, key in _time_buckets(created_at):
+        _increment(connection, table, key, {'units_sold': sign * quantity})
+    _increment(connection, ProductSales.__table__, {'product_id': product_id},
+               {'units_sold': sign * quantity, 'revenue': sign * total_price})
+
+
+@event.listens_for(Order, 'after_insert')
+def _order_created(mapper, connection, order):
+    _increment_counter(connection, StoreCounter.ORDERS, 1)
+    if _is_sale(order.status):
+        _apply_order(connection, order, 1)
+
+
+@event.listens_for(Order, 'after_delete')
+def _order_deleted(mapper, connection, order):
+    _increment_counter(connection, StoreCounter.ORDERS, -1)
+    if _is_sale(order.status):
+        _apply_order(connection, order, -1)
+
+
+@event.listens_for(Order, 'after_update')
+def _order_status_changed(mapper, connection, order):
+    history = db.inspect(order).attrs.status.history
+    if not history.has_changes():
+        return
+    old_status = history.deleted[0] if history.deleted else None
+    if _is_sale(old_status) == _is_sale(order.status):
+        return
+    sign = 1 if _is_sale(order.status) else -1
+    _apply_order(connection, order, sign)
+    lines = connection.execute(
+        db.select(OrderLine.product_id, OrderLine.quantity, OrderLine.total_price)
+        .where(OrderLine.order_id == order.id)
+    )
+    for product_id, quantity, total_price in lines:
+        _apply_line(connection, order.created_at, product_id, quantity, total_price, sign)
+
+
+@event.listens_for(OrderLine, 'after_insert')
+def _order_line_created(mapper, connection, line):
+    if _is_sale(line.order.status):
+        _apply_line(connection, line.order.created_at, line.product_id, line.quantity, line.total_price, 1)
+
+
+@event.listens_for(OrderLine, 'after_delete')
+def _order_line_deleted(mapper, connection, line):
+    if _is_sale(line.order.status):
+        _apply_line(connection, line.order.created_at, line.product_id, line.quantity, line.total_price, -1)
+
+
+@event.listens_for(User, 'after_insert')
+def _user_created(mapper, connection, user):
+    _increment_counter(connection, StoreCounter.USERS, 1)
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, user):
+    _increment_counter(connection, StoreCounter.USERS, -1)
+
+
+@event.listens_for(Product, 'after_insert')
+def _product_created(mapper, connection, product):
+    _increment_counter(connection, StoreCounter.PRODUCTS, 1)
+
+
+@event.listens_for(Product, 'after_delete')
+def _product_deleted(mapper, connection, product):
+    _increment_counter(connection, StoreCounter.PRODUCTS, -1)
+
+
+@task('rebuild_rollups')
+def rebuild_rollups():
+    """Recompute every rollup table from orders, users and products"""
+    daily = defaultdict(lambda: [0, 0, 0.0])
+    hourly = defaultdict(lambda: [0, 0, 0.0])
+    per_product = defaultdict(lambda: [0, 0.0])
+    revenue = 0.0
+
+    not_cancelled = db.or_(Order.status.is_(None), Order.status != Order.STATUS_CANCELLED)
+
+    orders = db.session.query(Order.created_at, Order.total_price).filter(not_cancelled).yield_per(10000)
+    for created_at, total_price in orders:
+        if created_at is not None:
+            for bucket in (daily[created_at.date()], hourly[created_at.replace(minute=0, second=0, microsecond=0)]):
+                bucket[0] += 1
+                bucket[2] += total_price
+        revenue += total_price
+
+    lines = db.session.query(Order.created_at, OrderLine.product_id, OrderLine.quantity, OrderLine.total_price) \
+        .join(Order, Order.id == OrderLine.order_id) \
+        .filter(not_cancelled) \
+        .yield_per(10000)
+    for created_at, product_id, quantity, total_price in lines:
+        if created_at is not None:
+            for bucket in (daily[created_at.date()], hourly[created_at.replace(minute=0, second=0, microsecond=0)]):
+                bucket[1] += quantity
+        per_product[product_id][0] += quantity
+        per_product[product_id][1] += total_price
+
+    # Count ids rather than entities: this also runs as a migration step, before
+    # later steps have added the models' newer columns
+    counters = {
+        StoreCounter.USERS: db.session.query(db.func.count(User.id)).scalar(),
+        StoreCounter.PRODUCTS: db.session.query(db.func.count(Product.id)).scalar(),
+        StoreCounter.ORDERS: db.session.query(db.func.count(Order.id)).scalar(),
+        StoreCounter.REVENUE: revenue,
+    }
+
+    for model in (SalesDaily, SalesHourly, ProductSales, StoreCounter):
+        db.session.query(model).delete()
+    if daily:
+        db.session.execute(db.insert(SalesDaily), [
+            {'day': day, 'order_count': c, 'units_sold': u, 'revenue': r} for day, (c, u, r) in daily.items()
+        ])
+    if hourly:
+        db.session.execute(db.insert(SalesHourly), [
+            {'hour': hour, 'order_count': c, 'units_sold': u, 'revenue': r} for hour, (c, u, r) in hourly.items()
+        ])
+    if per_product:
+        db.session.execute(db.insert(ProductSales), [
+            {'product_id': product_id, 'units_sold': u, 'revenue': r} for product_id, (u, r) in per_product.items()
+        ])
+    db.session.execute(db.insert(StoreCounter), [{'name': name, 'value': value} for name, value in counters.items()])
+    db.session.commit()
+
+
+def refresh_product_counter():
+    """Recount the products counter, after writes that bypass the ORM events"""
+    counters = StoreCounter.__table__
+    count = db.select(db.func.count(Product.id)).scalar_subquery()
+    result = db.session.execute(
+        counters.update().where(counters.c.name == StoreCounter.PRODUCTS).values(value=count)
+    )
+    if result.rowcount == 0:
+        db.session.execute(counters.insert().values(name=StoreCounter.PRODUCTS, value=count))
+
+
+def apply_order_changes(order_ids, sign):
+    """Add (sign=1) or remove (sign=-1) orders' sales, after bulk status UPDATEs that bypass the ORM events
+
+    Aggregates per day, hour and product first, so the cost grows with the
+    number of distinct buckets rather than with the number of orders.
+    """
+    if not order_ids:
+        return
+    daily = defaultdict(lambda: [0, 0, 0.0])
+    hourly = defaultdict(lambda: [0, 0, 0.0])
+    per_product = defaultdict(lambda: [0, 0.0])
+    revenue = 0.0
+
+    orders = db.session.query(Order.created_at, Order.total_price).filter(Order.id.in_(order_ids))
+    for created_at, total_price in orders:
+        day, hour = _bucket_keys(created_at)
+        for bucket in (daily[day], hourly[hour]):
+            bucket[0] += 1
+            bucket[2] += total_price
+        revenue += total_price
+
+    lines = db.session.query(Order.created_at, OrderLine.product_id, OrderLine.quantity, OrderLine.total_price) \
+        .join(Order, Order.id == OrderLine.order_id) \
+        .filter(Order.id.in_(order_ids))
+    for created_at, product_id, quantity, total_price in lines:
+        day, hour = _bucket_keys(created_at)
+        for bucket in (daily[day], hourly[hour]):
+            bucket[1] += quantity
+        per_product[product_id][0] += quantity
+        per_product[product_id][1] += total_price
+
+    connection = db.session.connection()
+    for table, key, buckets in ((SalesDaily.__table__, 'day', daily), (SalesHourly.__table__, 'hour', hourly)):
+        for value, (count, units, total) in buckets.items():
+            _increment(connection, table, {key: value},
+                       {'order_count': sign * count, 'units_sold': sign * units, 'revenue': sign * total})
+    for product_id, (units, total) in per_product.items():
+        _increment(connection, ProductSales.__table__, {'product_id': product_id},
+                   {'units_sold': sign * units, 'revenue': sign * total})
+    _increment_counter(connection, StoreCounter.REVENUE, sign * revenue)
+
+
+@click.command('rebuild-rollups')
+@click.option('--queue', is_flag=True, help='Queue the rebuild as a background job instead of running it now')
+@with_appcontext
+def rebuild_rollups_command(queue):
+    """Recompute the admin dashboard sales rollups from scratch"""
+    if queue:
+        enqueue('rebuild_rollups')
+        db.session.commit()
+        click.echo('✓ Sales rollup rebuild queued')
+        return
+    rebuild_rollups()
+    click.echo('✓ Sales rollups rebuilt')
+
+
+def store_totals():
+    """Return the store-wide counters as a dict"""
+    counters = {counter.name: counter.value for counter in StoreCounter.query.all()}
+    return {
+        'total_users': int(counters.get(StoreCounter.USERS, 0)),
+        'total_products': int(counters.get(StoreCounter.PRODUCTS, 0)),
+        'total_orders': int(counters.get(StoreCounter.ORDERS, 0)),
+        'total_revenue': counters.get(StoreCounter.REVENUE, 0),
+    }
+
+
+def revenue_by_day(days=14):
+    """Return SalesDaily rows for the last `days` days, filling days without sales"""
+    today = datetime.utcnow().date()
+    start = today - timedelta(days=days - 1)
+    rows = {row.day: row for row in SalesDaily.query.filter(SalesDaily.day >= start).all()}
+    return [
+        rows.get(start + timedelta(days=offset)) or SalesDaily(day=start + timedelta(days=offset), order_count=0, units_sold=0, revenue=0)
+        for offset in range(days)
+    ]
+
+
+def top_products(limit=5):
+    """Return (ProductSales, product name) pairs for the best-selling products by revenue"""
+    return db.session.query(ProductSales, Product.name) \
+        .outerjoin(Product, Product.id == ProductSales.product_id) \
+        .order_by(ProductSales.revenue.desc()) \
+        .limit(limit) \
+        .all()
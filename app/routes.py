@@ -1,48 +1,134 @@
-from flask import Blueprint, render_template, jsonify, request, redirect, url_for, flash, session
+from flask import Blueprint, render_template, jsonify, request, redirect, url_for, flash, session, abort, Response, stream_with_context, current_app
 from flask_login import login_user, logout_user, login_required, current_user
-from app.models import Product, Order, User, Cart, CartItem, Wishlist, Category
+from app.models import Product, Order, OrderLine, User, Cart, CartItem, Wishlist
 from app import db
-from werkzeug.utils import secure_filename
+from app.loading import load_user_cart, RECENT_ORDERS, ORDERS_WITH_LINES
+from app.admin_reports import user_listing, user_role_counts, USER_SORTS, order_listing, serialize_order, OrderFilters, ORDER_STATUSES, PAYMENT_METHODS, PAYMENT_STATUSES, ADMIN_PAGE_SIZE
+from app.rollups import store_totals, revenue_by_day, top_products
+from app.user_stats import get_user_stats
+from app.cache import cache
+from app.page_cache import cache_page
+from app.database import use_replica
+from app.catalog import paginate_products, serialize_product, category_summaries, cached_categories, cached_category, cached_featured_products, CATALOG_PAGE_SIZE, CatalogFilters, CATALOG_SORTS, DEFAULT_SORT, PRICE_BUCKETS
+from app.facets import facet_counts
+from app.search import search_products, SEARCH_PAGE_SIZE
+from app.inventory import claim_cart_stock, reserve_cart, InsufficientStock
+from app.writes import write_transaction, DatabaseBusy
+from app.order_status import transition_orders, TransitionError, TRANSITIONS
+from app.images import store_upload, ALLOWED_EXTENSIONS
+from app.jobs import enqueue
+from app.exports import EXPORTS, EXPORT_FORMATS, STREAMERS, ExportError, export_query, iter_batches
+from app.imports import import_products, detect_format, IMPORT_FORMATS
 from functools import wraps
-import os
+import hmac
+import io
 import secrets
 from datetime import datetime
 
 # File upload configuration
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def save_product_image(file, product_id):
-    """Save product image and return filename"""
+def save_product_image(file):
+    """Save an uploaded product image and return its filename, or None if it is not valid
+    
+    The resized variants are generated by a background job (see queue_image_processing).
+    """
     if not file or file.filename == '':
         return None
     
     if not allowed_file(file.filename):
         return None
     
-    # Create uploads directory if it doesn't exist
-    upload_folder = os.path.join(os.path.dirname(__file__), 'static', 'images', 'products')
-    os.makedirs(upload_folder, exist_ok=True)
+    return store_upload(file)
+
+def queue_image_processing(product, image_filename):
+    """Point a product at a newly uploaded image and queue its variants, cleaning up the old image"""
+    if product.image_filename and product.image_filename != image_filename:
+        enqueue('remove_product_image', filename=product.image_filename,
+                manifest=product.image_variants, product_id=product.id)
+    if product.image_filename != image_filename:
+        product.image_filename = image_filename
+        product.image_variants = None
+        enqueue('process_product_image', product_id=product.id, filename=image_filename)
+
+def build_order(cart, user_id, shipping, payment_method, payment_status, promo_code, promo_discount_percent):
+    """Build one order with a line per cart item and take its stock
+    
+    Raises InsufficientStock if the cart's products are no longer available.
+    """
+    claim_cart_stock(cart)
+    
+    order = Order(
+        user_id=user_id,
+        total_price=0,
+        full_name=shipping['full_name'],
+        email=shipping['email'],
+        phone=shipping['phone'],
+        shipping_address=shipping['shipping_address'],
+        city=shipping['city'],
+        state=shipping['state'],
+        postal_code=shipping['postal_code'],
+        payment_method=payment_method,
+        payment_status=payment_status,
+        # Generate random tracking number
+        tracking_number=f"WTS{datetime.utcnow().strftime('%Y%m%d')}{secrets.token_hex(4).upper()}",
+        # Generate unique transaction ID
+        transaction_id=f"TXN{datetime.utcnow().strftime('%Y%m%d%H%M%S')}{secrets.token_hex(6).upper()}",
+        promo_code=promo_code if promo_code else None,
+        discount_percentage=promo_discount_percent,
+        discount_amount=0
+    )
+    
+    for item in cart.items:
+        # Calculate discount for this item
+        item_subtotal = item.product.price * item.quantity
+        item_discount_amount = (item_subtotal * promo_discount_percent) / 100
+        item_total_after_discount = item_subtotal - item_discount_amount
+        
+        order.lines.append(OrderLine(
+            product_id=item.product_id,
+            quantity=item.quantity,
+            unit_price=item.product.price,
+            discount_amount=item_discount_amount,
+            total_price=item_total_after_discount
+        ))
+        order.total_price += item_total_after_discount
+        order.discount_amount += item_discount_amount
+    
+    return order
+
+def place_order(user_id, shipping, payment_method, payment_status, promo_code, promo_discount_percent):
+    """Place an order from the user's cart and empty the cart; run with write_transaction()
     
-    # Create unique filename
-    ext = secure_filename(file.filename).rsplit('.', 1)[1].lower()
-    filename = f'product_{product_id}_{int(datetime.utcnow().timestamp())}.{ext}'
-    filepath = os.path.join(upload_folder, filename)
+    Returns the order, or None if the cart is empty by now. Raises
+    InsufficientStock if the cart's products are no longer available.
+    """
+    cart = load_user_cart(user_id)
+    if not cart or not cart.items:
+        return None
     
-    # Save file
-    file.save(filepath)
-    return filename
+    # Create one order with a line per cart item
+    order = build_order(cart, user_id, shipping, payment_method, payment_status, promo_code, promo_discount_percent)
+    db.session.add(order)
+    db.session.flush()
+    enqueue('send_order_confirmation', order_id=order.id)
+    
+    # Clear cart
+    CartItem.query.filter_by(cart_id=cart.id).delete()
+    return order
 
 main_bp = Blueprint('main', __name__)
 
 @main_bp.route('/')
+@cache_page
+@use_replica
 def index():
     """Homepage"""
-    categories = Category.query.all()
-    featured_products = Product.query.filter_by(is_featured=True).all()
+    categories = cached_categories()
+    featured_products = cached_featured_products()
     return render_template('index.html', title='Wonderland Toy Store', categories=categories, featured_products=featured_products)
 
 @main_bp.route('/register', methods=['GET', 'POST'])
@@ -129,14 +215,13 @@ def forgot_password():
         user = User.query.filter_by(email=email).first()
         
         if user:
-            # Generate reset token
+            # Generate reset token and email the link from a background job
             reset_token = user.generate_reset_token()
-            db.session.commit()
-            
-            # In a real app, you would send this via email
-            # For now, we'll show it in a flash message (for demo purposes)
             reset_link = url_for('main.reset_password', token=reset_token, _external=True)
+            enqueue('send_password_reset', user_id=user.id, link=reset_link)
+            db.session.commit()
             
+            # Also shown in a flash message (for demo purposes)
             flash(f'Password reset link: {reset_link}', 'info')
             flash('If an account exists with this email, a password reset link will be sent.', 'success')
         else:
@@ -186,43 +271,157 @@ def reset_password(token):
     return render_template('reset_password.html', title='Reset Password', token=token)
 
 @main_bp.route('/products')
+@cache_page
+@use_replica
 def products():
     """Products page - shows categories"""
-    categories = Category.query.all()
+    categories = category_summaries()
     return render_template('products.html', title='Our Products', categories=categories, view_mode='categories')
 
+def catalog_sort():
+    """Read the catalog sort order from the query string"""
+    sort = request.args.get('sort', DEFAULT_SORT)
+    return sort if sort in CATALOG_SORTS else DEFAULT_SORT
+
+def render_catalog(title, filters, view_mode, category=None):
+    """Render one page of a filtered, sorted catalog listing with its facet counts"""
+    cursor = request.args.get('cursor')
+    sort = catalog_sort()
+    page = paginate_products(cursor=cursor, sort=sort, filters=filters)
+    categories = cached_categories()
+    # Query string reproducing the filters and sort, for pagination and facet links
+    catalog_args = filters.query_args(sort=sort if sort != DEFAULT_SORT else None)
+    return render_template('products.html', title=title, category=category, products=page.products, page=page,
+                           cursor=cursor, categories=categories, view_mode=view_mode,
+                           filters=filters, facets=facet_counts(filters), sort=sort, sorts=CATALOG_SORTS,
+                           price_buckets=PRICE_BUCKETS, catalog_args=catalog_args)
+
 @main_bp.route('/products/all')
+@use_replica
 def all_products():
-    """View all products"""
-    products = Product.query.all()
-    categories = Category.query.all()
-    return render_template('products.html', title='All Products', products=products, categories=categories, view_mode='all')
+    """View all products, one keyset-paginated page at a time"""
+    try:
+        return render_catalog('All Products', CatalogFilters.from_args(request.args), 'all')
+    except ValueError:
+        flash('Invalid page link', 'error')
+        return redirect(url_for('main.all_products'))
 
 @main_bp.route('/products/category/<int:category_id>')
+@use_replica
 def category_products(category_id):
-    """View all products in a specific category"""
-    category = Category.query.get_or_404(category_id)
-    products = Product.query.filter_by(category_id=category_id).all()
-    categories = Category.query.all()
-    return render_template('products.html', title=category.name, category=category, products=products, categories=categories, view_mode='category')
+    """View products in a specific category, one keyset-paginated page at a time"""
+    category = cached_category(category_id)
+    if category is None:
+        abort(404)
+    try:
+        filters = CatalogFilters.from_args(request.args, category_id=category_id)
+        return render_catalog(category.name, filters, 'category', category=category)
+    except ValueError:
+        flash('Invalid page link', 'error')
+        return redirect(url_for('main.category_products', category_id=category_id))
+
+@main_bp.route('/api/products')
+@use_replica
+def api_products():
+    """Catalog JSON API with cursor pagination, filters and sorting"""
+    filters = CatalogFilters.from_args(request.args, category_id=request.args.get('category_id', type=int))
+    try:
+        page = paginate_products(
+            cursor=request.args.get('cursor'),
+            per_page=request.args.get('per_page', CATALOG_PAGE_SIZE, type=int),
+            sort=catalog_sort(),
+            filters=filters
+        )
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid cursor'}), 400
+    
+    response = {
+        'success': True,
+        'products': [serialize_product(product) for product in page.products],
+        'next_cursor': page.next_cursor
+    }
+    if request.args.get('facets') == '1':
+        facets = facet_counts(filters)
+        response['facets'] = {
+            'total': facets.total,
+            'categories': facets.categories,
+            'prices': facets.prices,
+            'in_stock': facets.in_stock,
+            'featured': facets.featured
+        }
+    return jsonify(response)
+
+def search_filters():
+    """Read the search filters from the query string"""
+    return {
+        'category_id': request.args.get('category_id', type=int),
+        'min_price': request.args.get('min_price', type=float),
+        'max_price': request.args.get('max_price', type=float),
+        'in_stock': request.args.get('in_stock') in ('1', 'on', 'true'),
+    }
+
+@main_bp.route('/search')
+@use_replica
+def search():
+    """Full-text product search"""
+    query = request.args.get('q', '').strip()
+    filters = search_filters()
+    page = search_products(query, page=request.args.get('page', 1, type=int),
+                           boundary=request.args.get('boundary', type=int), **filters)
+    categories = cached_categories()
+    # Query string without the page number, for the pagination links; every page ranks the same window
+    search_args = request.args.to_dict()
+    search_args.pop('page', None)
+    search_args.pop('boundary', None)
+    if page.boundary is not None:
+        search_args['boundary'] = page.boundary
+    return render_template('products.html', title=f'Search: {query}' if query else 'Search', products=page.products,
+                           search_page=page, search_args=search_args, query=query, filters=filters,
+                           categories=categories, view_mode='search')
+
+@main_bp.route('/api/search')
+@use_replica
+def api_search():
+    """Full-text product search JSON API"""
+    page = search_products(
+        request.args.get('q', '').strip(),
+        page=request.args.get('page', 1, type=int),
+        per_page=request.args.get('per_page', SEARCH_PAGE_SIZE, type=int),
+        boundary=request.args.get('boundary', type=int),
+        **search_filters()
+    )
+    return jsonify({
+        'success': True,
+        'products': [serialize_product(product) for product in page.products],
+        'page': page.page,
+        'has_next': page.has_next,
+        'corrected_query': page.corrected_query,
+        # Pass back with the next pages so they rank the same products
+        'boundary': page.boundary
+    })
 
 @main_bp.route('/categories')
+@cache_page
+@use_replica
 def all_categories():
     """View all product categories"""
-    categories = Category.query.all()
+    categories = category_summaries()
     return render_template('category.html', title='All Categories', categories=categories)
 
 @main_bp.route('/about')
+@cache_page
 def about():
     """About page"""
     return render_template('about.html', title='About Us')
 
 @main_bp.route('/contact')
+@cache_page
 def contact():
     """Contact page"""
     return render_template('contact.html', title='Contact Us')
 
 @main_bp.route('/refund-return-policy')
+@cache_page
 def refund_return_policy():
     """Refund and return policy page"""
     return render_template('refund_return_policy.html', title='Refund & Return Policy')
@@ -234,14 +433,13 @@ def view_cart():
         flash('Please login to view your cart', 'warning')
         return redirect(url_for('main.login', next=url_for('main.view_cart')))
     
-    cart = current_user.cart or Cart(user_id=current_user.id)
+    cart = load_user_cart(current_user.id) or Cart(user_id=current_user.id)
     return render_template('cart.html', title='Shopping Cart', cart=cart)
 
 @main_bp.route('/cart/add/<int:product_id>', methods=['POST'])
 @login_required
 def add_to_cart(product_id):
     """Add product to cart"""
-    product = Product.query.get_or_404(product_id)
     quantity = request.form.get('quantity', 1, type=int)
     
     # Validate quantity is positive
@@ -249,39 +447,49 @@ def add_to_cart(product_id):
         flash('Quantity must be greater than 0', 'error')
         return redirect(request.referrer or url_for('main.products'))
     
-    # Check stock availability
-    if quantity > product.stock:
-        flash(f'Only {product.stock} units of {product.name} in stock. Cannot add {quantity} to cart.', 'error')
-        return redirect(request.referrer or url_for('main.products'))
+    user_id = current_user.id
     
-    # Get or create cart
-    cart = current_user.cart
-    if not cart:
-        cart = Cart(user_id=current_user.id)
-        db.session.add(cart)
-        db.session.flush()
-    
-    # Check if item already in cart
-    cart_item = CartItem.query.filter_by(cart_id=cart.id, product_id=product_id).first()
-    
-    # Validate total quantity won't exceed stock
-    if cart_item:
-        total_quantity = cart_item.quantity + quantity
-        if total_quantity > product.stock:
-            flash(f'Cannot add {quantity} more units. Only {product.stock - cart_item.quantity} units available to add.', 'error')
-            return redirect(request.referrer or url_for('main.products'))
-        cart_item.quantity += quantity
-    else:
-        cart_item = CartItem(cart_id=cart.id, product_id=product_id, quantity=quantity)
-        db.session.add(cart_item)
-    
-    # Remove from wishlist if it exists
-    wishlist_item = Wishlist.query.filter_by(user_id=current_user.id, product_id=product_id).first()
-    if wishlist_item:
-        db.session.delete(wishlist_item)
+    def add_item():
+        """Returns the flash message and category; stock is checked inside the write transaction"""
+        product = db.session.get(Product, product_id)
+        if product is None:
+            abort(404)
+        
+        # Get or create cart
+        cart = Cart.query.filter_by(user_id=user_id).first()
+        if not cart:
+            cart = Cart(user_id=user_id)
+            db.session.add(cart)
+            db.session.flush()
+        
+        # Check if item already in cart
+        cart_item = CartItem.query.filter_by(cart_id=cart.id, product_id=product_id).first()
+        
+        # Validate total quantity won't exceed stock
+        if cart_item:
+            total_quantity = cart_item.quantity + quantity
+            if total_quantity > product.stock:
+                return f'Cannot add {quantity} more units. Only {product.stock - cart_item.quantity} units available to add.', 'error'
+            cart_item.quantity += quantity
+        elif quantity > product.stock:
+            return f'Only {product.stock} units of {product.name} in stock. Cannot add {quantity} to cart.', 'error'
+        else:
+            db.session.add(CartItem(cart_id=cart.id, product_id=product_id, quantity=quantity))
+        
+        # Remove from wishlist if it exists
+        wishlist_item = Wishlist.query.filter_by(user_id=user_id, product_id=product_id).first()
+        if wishlist_item:
+            db.session.delete(wishlist_item)
+        return f'{product.name} added to cart!', 'success'
     
-    db.session.commit()
-    flash(f'{product.name} added to cart!', 'success')
+    try:
+        message, category = write_transaction(add_item)
+    except DatabaseBusy:
+        flash('The store is very busy right now. Please try adding the item again.', 'error')
+        return redirect(request.referrer or url_for('main.products'))
+    flash(message, category)
+    if category == 'error':
+        return redirect(request.referrer or url_for('main.products'))
     return redirect(request.referrer or url_for('main.view_cart'))
 
 @main_bp.route('/cart/remove/<int:item_id>')
@@ -348,7 +556,7 @@ def empty_cart():
 @login_required
 def checkout():
     """Checkout and place order"""
-    cart = current_user.cart
+    cart = load_user_cart(current_user.id)
     
     if not cart or not cart.items:
         flash('Your cart is empty', 'warning')
@@ -396,76 +604,64 @@ def checkout():
                 flash('Invalid promo code', 'error')
                 return redirect(url_for('main.checkout'))
         
-        # For card payment, redirect to payment page
+        shipping = {
+            'full_name': full_name,
+            'email': email,
+            'phone': phone,
+            'shipping_address': shipping_address,
+            'city': city,
+            'state': state,
+            'postal_code': postal_code
+        }
+        
+        user_id = current_user.id
+        
+        # For card payment, hold the stock while the customer pays, then redirect to payment page
         if payment_method == Order.PAYMENT_CARD:
+            def hold_stock():
+                cart = load_user_cart(user_id)
+                if cart and cart.items:
+                    reserve_cart(cart)
+            
+            try:
+                write_transaction(hold_stock)
+            except InsufficientStock as e:
+                flash(str(e), 'error')
+                return redirect(url_for('main.view_cart'))
+            except DatabaseBusy:
+                flash('The store is very busy right now. Please try again.', 'error')
+                return redirect(url_for('main.checkout'))
             session['checkout_data'] = {
-                'full_name': full_name,
-                'email': email,
-                'phone': phone,
-                'shipping_address': shipping_address,
-                'city': city,
-                'state': state,
-                'postal_code': postal_code,
+                **shipping,
                 'payment_method': payment_method,
                 'promo_code': promo_code,
                 'promo_discount_percent': promo_discount_percent
             }
             return redirect(url_for('main.payment_card'))
         
-        # For non-card payments, create orders directly
+        # For non-card payments, create the order directly
         try:
-            cart_total = cart.get_total()
-            
-            # Create orders for each item in cart
-            for item in cart.items:
-                # Calculate discount for this item
-                item_subtotal = item.product.price * item.quantity
-                item_discount_amount = (item_subtotal * promo_discount_percent) / 100
-                item_total_after_discount = item_subtotal - item_discount_amount
-                
-                # Generate random tracking number
-                tracking_number = f"WTS{datetime.utcnow().strftime('%Y%m%d')}{secrets.token_hex(4).upper()}"
-                # Generate unique transaction ID
-                transaction_id = f"TXN{datetime.utcnow().strftime('%Y%m%d%H%M%S')}{secrets.token_hex(6).upper()}"
-                
-                order = Order(
-                    user_id=current_user.id,
-                    product_id=item.product_id,
-                    quantity=item.quantity,
-                    total_price=item_total_after_discount,
-                    full_name=full_name,
-                    email=email,
-                    phone=phone,
-                    shipping_address=shipping_address,
-                    city=city,
-                    state=state,
-                    postal_code=postal_code,
-                    payment_method=payment_method,
-                    payment_status=Order.PAYMENT_COMPLETED if payment_method == Order.PAYMENT_PAYPAL else Order.PAYMENT_PENDING,
-                    tracking_number=tracking_number,
-                    transaction_id=transaction_id,
-                    promo_code=promo_code if promo_code else None,
-                    discount_percentage=promo_discount_percent,
-                    discount_amount=item_discount_amount
-                )
-                db.session.add(order)
-                
-                # Deduct stock from product when order is created
-                product = item.product
-                product.stock -= item.quantity
-                if product.stock < 0:
-                    product.stock = 0
-            
-            # Clear cart
-            CartItem.query.filter_by(cart_id=cart.id).delete()
-            db.session.commit()
-            
-            flash('Order placed successfully! Check your email for confirmation.', 'success')
-            return redirect(url_for('main.orders'))
-        except Exception as e:
-            db.session.rollback()
-            flash('An error occurred while placing your order. Please try again.', 'error')
+            order = write_transaction(
+                place_order,
+                user_id,
+                shipping=shipping,
+                payment_method=payment_method,
+                payment_status=Order.PAYMENT_COMPLETED if payment_method == Order.PAYMENT_PAYPAL else Order.PAYMENT_PENDING,
+                promo_code=promo_code,
+                promo_discount_percent=promo_discount_percent
+            )
+        except InsufficientStock as e:
+            flash(str(e), 'error')
+            return redirect(url_for('main.view_cart'))
+        except DatabaseBusy:
+            flash('The store is very busy right now, so your order was not placed. Please try again.', 'error')
             return redirect(url_for('main.checkout'))
+        
+        if order is None:
+            flash('Your cart is empty', 'warning')
+            return redirect(url_for('main.view_cart'))
+        flash('Order placed successfully! Check your email for confirmation.', 'success')
+        return redirect(url_for('main.orders'))
     
     return render_template('checkout.html', title='Checkout', cart=cart, user=current_user)
 
@@ -479,7 +675,7 @@ def payment_card():
         flash('Invalid payment session. Please start checkout again.', 'error')
         return redirect(url_for('main.checkout'))
     
-    cart = current_user.cart
+    cart = load_user_cart(current_user.id)
     
     if not cart or not cart.items:
         flash('Your cart is empty', 'warning')
@@ -516,69 +712,34 @@ def payment_card():
             flash('CVV must contain only digits', 'error')
             return redirect(url_for('main.payment_card'))
         
+        # Process payment (simulated)
+        # In a real app, this would call a payment gateway like Stripe or PayPal
         try:
-            # Process payment (simulated)
-            # In a real app, this would call a payment gateway like Stripe or PayPal
-            
-            # Get promo details from checkout_data
-            promo_code = checkout_data.get('promo_code')
-            promo_discount_percent = checkout_data.get('promo_discount_percent', 0)
-            
-            # Create orders for each item in cart
-            for item in cart.items:
-                # Calculate discount for this item
-                item_subtotal = item.product.price * item.quantity
-                item_discount_amount = (item_subtotal * promo_discount_percent) / 100
-                item_total_after_discount = item_subtotal - item_discount_amount
-                
-                # Generate random tracking number
-                tracking_number = f"WTS{datetime.utcnow().strftime('%Y%m%d')}{secrets.token_hex(4).upper()}"
-                # Generate unique transaction ID
-                transaction_id = f"TXN{datetime.utcnow().strftime('%Y%m%d%H%M%S')}{secrets.token_hex(6).upper()}"
-                
-                order = Order(
-                    user_id=current_user.id,
-                    product_id=item.product_id,
-                    quantity=item.quantity,
-                    total_price=item_total_after_discount,
-                    full_name=checkout_data['full_name'],
-                    email=checkout_data['email'],
-                    phone=checkout_data['phone'],
-                    shipping_address=checkout_data['shipping_address'],
-                    city=checkout_data['city'],
-                    state=checkout_data['state'],
-                    postal_code=checkout_data['postal_code'],
-                    payment_method=Order.PAYMENT_CARD,
-                    payment_status=Order.PAYMENT_COMPLETED,
-                    tracking_number=tracking_number,
-                    transaction_id=transaction_id,
-                    promo_code=promo_code if promo_code else None,
-                    discount_percentage=promo_discount_percent,
-                    discount_amount=item_discount_amount
-                )
-                db.session.add(order)
-                
-                # Deduct stock from product when order is created
-                product = item.product
-                product.stock -= item.quantity
-                if product.stock < 0:
-                    product.stock = 0
-            
-            # Clear cart
-            CartItem.query.filter_by(cart_id=cart.id).delete()
-            db.session.commit()
-            
-            # Clear session data
-            if 'checkout_data' in session:
-                session.pop('checkout_data')
-            
-            flash('Payment successful! Your order has been confirmed.', 'success')
-            return redirect(url_for('main.orders'))
-        
-        except Exception as e:
-            db.session.rollback()
-            flash('Payment processing failed. Please try again.', 'error')
+            order = write_transaction(
+                place_order,
+                current_user.id,
+                shipping=checkout_data,
+                payment_method=Order.PAYMENT_CARD,
+                payment_status=Order.PAYMENT_COMPLETED,
+                promo_code=checkout_data.get('promo_code'),
+                promo_discount_percent=checkout_data.get('promo_discount_percent', 0)
+            )
+        except InsufficientStock as e:
+            flash(str(e), 'error')
+            return redirect(url_for('main.view_cart'))
+        except DatabaseBusy:
+            flash('The store is very busy right now, so your payment was not taken. Please try again.', 'error')
             return redirect(url_for('main.payment_card'))
+        
+        if order is None:
+            flash('Your cart is empty', 'warning')
+            return redirect(url_for('main.view_cart'))
+        
+        # Clear session data
+        session.pop('checkout_data', None)
+        
+        flash('Payment successful! Your order has been confirmed.', 'success')
+        return redirect(url_for('main.orders'))
     
     return render_template('payment_card.html', title='Card Payment', checkout_data=checkout_data, cart=cart, user=current_user)
 
@@ -586,7 +747,8 @@ def payment_card():
 @login_required
 def orders():
     """View user orders"""
-    orders = Order.query.filter_by(user_id=current_user.id).order_by(Order.created_at.desc()).all()
+    orders = Order.query.options(*ORDERS_WITH_LINES) \
+        .filter_by(user_id=current_user.id).order_by(Order.created_at.desc()).all()
     return render_template('orders.html', title='My Orders', orders=orders)
 
 # Admin decorator
@@ -646,38 +808,108 @@ def remove_from_wishlist(item_id):
 # User dashboard
 @main_bp.route('/dashboard')
 @login_required
+@use_replica
 def dashboard():
     """User dashboard"""
-    user_orders = Order.query.filter_by(user_id=current_user.id).order_by(Order.created_at.desc()).limit(5).all()
-    wishlist_count = Wishlist.query.filter_by(user_id=current_user.id).count()
-    total_spent = db.session.query(db.func.sum(Order.total_price)).filter_by(user_id=current_user.id).scalar() or 0
-    orders_count = Order.query.filter_by(user_id=current_user.id).count()
+    stats = get_user_stats(current_user.id)
     
     return render_template('dashboard.html', 
                          title='My Dashboard',
-                         user_orders=user_orders,
-                         wishlist_count=wishlist_count,
-                         total_spent=total_spent,
-                         orders_count=orders_count)
+                         user_orders=stats.recent_orders,
+                         wishlist_count=stats.wishlist_count,
+                         total_spent=stats.total_spent,
+                         orders_count=stats.orders_count)
 
 # Admin dashboard routes
 @main_bp.route('/admin')
 @admin_required
+@use_replica
 def admin_dashboard():
-    """Admin dashboard"""
-    total_users = User.query.count()
-    total_products = Product.query.count()
-    total_orders = Order.query.count()
-    total_revenue = db.session.query(db.func.sum(Order.total_price)).scalar() or 0
-    recent_orders = Order.query.order_by(Order.created_at.desc()).limit(10).all()
+    """Admin dashboard, served from the sales rollups"""
+    recent_orders = Order.query.options(*RECENT_ORDERS) \
+        .order_by(Order.created_at.desc()).limit(10).all()
     
     return render_template('admin/dashboard.html',
                          title='Admin Dashboard',
-                         total_users=total_users,
-                         total_products=total_products,
-                         total_orders=total_orders,
-                         total_revenue=total_revenue,
-                         recent_orders=recent_orders)
+                         recent_orders=recent_orders,
+                         daily_sales=revenue_by_day(),
+                         top_products=top_products(),
+                         **store_totals())
+
+@main_bp.route('/admin/cache')
+@admin_required
+def admin_cache_stats():
+    """Catalog cache hit/miss counts for this worker process"""
+    return jsonify({
+        'success': True,
+        'backend': type(cache.backend).__name__,
+        'namespaces': cache.stats()
+    })
+
+def request_metrics():
+    """The app's request metrics, or 404 if METRICS_ENABLED is off"""
+    metrics = current_app.extensions.get('metrics')
+    if metrics is None:
+        abort(404)
+    return metrics
+
+@main_bp.route('/admin/metrics')
+@admin_required
+def admin_metrics():
+    """Per-route latency, SQL and N+1 metrics for this worker process"""
+    metrics = request_metrics()
+    endpoints = metrics.summary()
+    writes = current_app.extensions.get('writes')
+    write_stats = writes.stats.summary() if writes else None
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'success': True,
+            'since': metrics.started_at.isoformat(),
+            'n_plus_one_threshold': metrics.threshold,
+            'endpoints': endpoints,
+            'n_plus_one': [dict(entry, at=entry['at'].isoformat()) for entry in metrics.n_plus_one],
+            'profiles': [{'id': profile.id, 'path': profile.path, 'kind': profile.kind,
+                          'url': url_for('main.admin_metrics_profile', profile_id=profile.id)}
+                         for profile in metrics.profiles],
+            'sqlite_writes': write_stats
+        })
+    
+    return render_template('admin/metrics.html', title='Metrics', metrics=metrics, endpoints=endpoints,
+                           n_plus_one=list(reversed(metrics.n_plus_one)), profiles=list(reversed(metrics.profiles)),
+                           write_stats=write_stats, profile_header=current_app.config.get('METRICS_PROFILE_HEADER', 'X-Profile'))
+
+@main_bp.route('/admin/metrics/reset', methods=['POST'])
+@admin_required
+def admin_metrics_reset():
+    """Clear the collected request and write metrics (profiles are kept)"""
+    request_metrics().reset()
+    if 'writes' in current_app.extensions:
+        current_app.extensions['writes'].stats.reset()
+    flash('Metrics reset', 'success')
+    return redirect(url_for('main.admin_metrics'))
+
+@main_bp.route('/admin/metrics/profiles/<int:profile_id>')
+@admin_required
+def admin_metrics_profile(profile_id):
+    """Profiler report of one request made with the profile header"""
+    profile = request_metrics().get_profile(profile_id)
+    if profile is None:
+        abort(404)
+    header = f'{profile.method} {profile.path} - {profile.wall_time * 1000:.1f} ms, {profile.sql_count} SQL statements ({profile.kind})\n\n'
+    return Response(header + profile.report, mimetype='text/plain')
+
+@main_bp.route('/metrics')
+def prometheus_metrics():
+    """Request metrics in the Prometheus text format, for admins or a bearer token"""
+    metrics = request_metrics()
+    token = current_app.config.get('METRICS_TOKEN')
+    authorized = bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not authorized and not (current_user.is_authenticated and current_user.is_admin):
+        abort(403)
+    text = metrics.prometheus()
+    if 'writes' in current_app.extensions:
+        text += current_app.extensions['writes'].stats.prometheus()
+    return Response(text, mimetype='text/plain; version=0.0.4')
 
 @main_bp.route('/admin/products')
 @admin_required
@@ -708,9 +940,9 @@ def admin_add_product():
         # Handle image upload
         if 'image' in request.files:
             file = request.files['image']
-            image_filename = save_product_image(file, product.id)
+            image_filename = save_product_image(file)
             if image_filename:
-                product.image_filename = image_filename
+                queue_image_processing(product, image_filename)
             elif file.filename != '':
                 flash('Invalid file type. Only PNG, JPG, JPEG, and GIF are allowed.', 'error')
                 db.session.rollback()
@@ -720,9 +952,32 @@ def admin_add_product():
         flash('Product added successfully!', 'success')
         return redirect(url_for('main.admin_products'))
     
-    categories = Category.query.all()
+    categories = cached_categories()
     return render_template('admin/add_product.html', title='Add Product', categories=categories)
 
+@main_bp.route('/admin/products/import', methods=['GET', 'POST'])
+@admin_required
+def admin_import_products():
+    """Bulk import products from an uploaded CSV or JSONL file"""
+    result = None
+    if request.method == 'POST':
+        file = request.files.get('file')
+        if not file or file.filename == '':
+            flash('Choose a CSV or JSONL file to import', 'error')
+            return redirect(url_for('main.admin_import_products'))
+        
+        import_format = request.form.get('format') or detect_format(file.filename)
+        if import_format not in IMPORT_FORMATS:
+            flash('Format must be CSV or JSONL', 'error')
+            return redirect(url_for('main.admin_import_products'))
+        
+        # Parse the upload as it is read instead of loading it into memory
+        stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline='')
+        result = import_products(stream, import_format, current_app.config['IMPORT_IMAGES_FOLDER'],
+                                 create_categories=request.form.get('create_categories') == 'on')
+    
+    return render_template('admin/import_products.html', title='Import Products', result=result)
+
 @main_bp.route('/admin/products/edit/<int:product_id>', methods=['GET', 'POST'])
 @admin_required
 def admin_edit_product(product_id):
@@ -740,14 +995,10 @@ def admin_edit_product(product_id):
         if 'image' in request.files:
             file = request.files['image']
             if file.filename != '':
-                image_filename = save_product_image(file, product.id)
+                image_filename = save_product_image(file)
                 if image_filename:
-                    # Delete old image if exists
-                    if product.image_filename:
-                        old_image_path = os.path.join(os.path.dirname(__file__), 'static', 'images', 'products', product.image_filename)
-                        if os.path.exists(old_image_path):
-                            os.remove(old_image_path)
-                    product.image_filename = image_filename
+                    # The old image is deleted by a background job once this commits
+                    queue_image_processing(product, image_filename)
                 else:
                     flash('Invalid file type. Only PNG, JPG, JPEG, and GIF are allowed.', 'error')
                     return redirect(url_for('main.admin_edit_product', product_id=product.id))
@@ -756,7 +1007,7 @@ def admin_edit_product(product_id):
         flash('Product updated successfully!', 'success')
         return redirect(url_for('main.admin_products'))
     
-    categories = Category.query.all()
+    categories = cached_categories()
     return render_template('admin/edit_product.html', title='Edit Product', product=product, categories=categories)
 
 @main_bp.route('/admin/products/delete/<int:product_id>')
@@ -787,47 +1038,164 @@ def admin_toggle_product_feature(product_id):
 @main_bp.route('/admin/orders')
 @admin_required
 def admin_orders():
-    """Admin orders management"""
-    orders = Order.query.order_by(Order.created_at.desc()).all()
-    return render_template('admin/orders.html', title='Manage Orders', orders=orders)
+    """Admin orders management, newest first, filtered and paginated with a cursor"""
+    filters = OrderFilters.from_args(request.args)
+    cursor = request.args.get('cursor')
+    try:
+        page = order_listing(filters, cursor=cursor)
+    except ValueError:
+        flash('That page link is no longer valid', 'error')
+        return redirect(url_for('main.admin_orders', **filters.query_args()))
+    
+    return render_template('admin/orders.html', title='Manage Orders', orders=page.orders, page=page,
+                           cursor=cursor, filters=filters, statuses=ORDER_STATUSES,
+                           payment_methods=PAYMENT_METHODS, payment_statuses=PAYMENT_STATUSES,
+                           transitions=TRANSITIONS)
+
+@main_bp.route('/api/admin/orders')
+@admin_required
+def api_admin_orders():
+    """Admin orders JSON API with the same filters and cursor pagination as the orders page"""
+    try:
+        page = order_listing(
+            OrderFilters.from_args(request.args),
+            cursor=request.args.get('cursor'),
+            per_page=request.args.get('per_page', ADMIN_PAGE_SIZE, type=int)
+        )
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid cursor'}), 400
+    
+    return jsonify({
+        'success': True,
+        'orders': [serialize_order(order) for order in page.orders],
+        'next_cursor': page.next_cursor
+    })
 
 @main_bp.route('/admin/orders/<int:order_id>/status/<new_status>')
 @admin_required
 def admin_update_order_status(order_id, new_status):
     """Update order status"""
-    order = Order.query.get_or_404(order_id)
-    valid_statuses = ['pending', 'processing', 'shipped', 'delivered', 'cancelled']
-    
-    if new_status not in valid_statuses:
+    try:
+        result = transition_orders([order_id], new_status, changed_by_id=current_user.id)
+    except TransitionError:
         flash('Invalid status', 'error')
         return redirect(url_for('main.admin_orders'))
+    except InsufficientStock as e:
+        db.session.rollback()
+        flash(f'Cannot restore order: {e}', 'error')
+        return redirect(url_for('main.admin_orders'))
     
-    old_status = order.status
-    order.status = new_status
-    
-    # Handle stock restoration if order is cancelled
-    if new_status == 'cancelled' and old_status != 'cancelled':
-        product = order.product
-        product.stock += order.quantity
-    
-    # Handle stock deduction if order is restored from cancelled
-    if old_status == 'cancelled' and new_status != 'cancelled':
-        product = order.product
-        product.stock -= order.quantity
-        if product.stock < 0:
-            product.stock = 0
+    if result.rejected.get(order_id) == 'Order not found':
+        abort(404)
+    if not result.updated:
+        flash(result.rejected[order_id], 'error')
+        return redirect(url_for('main.admin_orders'))
     
     db.session.commit()
     
     flash(f'Order status updated to {new_status}', 'success')
     return redirect(url_for('main.admin_orders'))
 
+@main_bp.route('/admin/orders/status', methods=['POST'])
+@admin_required
+def admin_bulk_order_status():
+    """Move the selected orders to a new status"""
+    new_status = request.form.get('new_status', '')
+    back = url_for('main.admin_orders', **OrderFilters.from_args(request.form).query_args())
+    try:
+        result = transition_orders(request.form.getlist('order_ids', type=int), new_status,
+                                   changed_by_id=current_user.id)
+    except TransitionError as e:
+        flash(str(e), 'error')
+        return redirect(back)
+    except InsufficientStock as e:
+        db.session.rollback()
+        flash(f'Cannot restore orders: {e}', 'error')
+        return redirect(back)
+    
+    db.session.commit()
+    
+    if result.updated:
+        flash(f'{len(result.updated)} order(s) updated to {new_status}', 'success')
+    if result.rejected:
+        flash(f'{len(result.rejected)} order(s) left unchanged: '
+              + '; '.join(f'#{order_id}: {reason}' for order_id, reason in sorted(result.rejected.items())[:10]),
+              'error')
+    return redirect(back)
+
+@main_bp.route('/api/admin/orders/status', methods=['POST'])
+@admin_required
+def api_admin_order_status():
+    """Bulk order status JSON API: {"order_ids": [...], "status": "shipped"}"""
+    data = request.get_json(silent=True) or {}
+    order_ids = data.get('order_ids')
+    if not isinstance(order_ids, list) or not all(isinstance(order_id, int) for order_id in order_ids):
+        return jsonify({'success': False, 'error': 'order_ids must be a list of order ids'}), 400
+    try:
+        result = transition_orders(order_ids, data.get('status'), changed_by_id=current_user.id)
+    except TransitionError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except InsufficientStock as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 409
+    
+    db.session.commit()
+    
+    return jsonify({
+        'success': True,
+        'status': result.status,
+        'updated': result.updated,
+        'rejected': [{'id': order_id, 'error': reason} for order_id, reason in result.rejected.items()]
+    })
+
+@main_bp.route('/admin/export/<name>')
+@admin_required
+def admin_export(name):
+    """Stream orders, users or products as CSV or JSONL
+    
+    Filters: start and end (inclusive YYYY-MM-DD on created_at) and status
+    (comma-separated; order statuses, admin/customer, or in_stock/out_of_stock/featured).
+    """
+    if name not in EXPORTS:
+        abort(404)
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'success': False, 'error': 'format must be csv or jsonl'}), 400
+    try:
+        export, query = export_query(name, start=request.args.get('start'), end=request.args.get('end'),
+                                     status=request.args.get('status'))
+    except ExportError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    # The export reads on its own connections; don't keep the session's open while it streams
+    db.session.close()
+    chunks = STREAMERS[export_format](export.fields, iter_batches(export, query))
+    filename = f'{name}-{datetime.utcnow():%Y%m%d-%H%M%S}.{export_format}'
+    return Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[export_format], headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Cache-Control': 'no-store',
+        # Ask proxies such as nginx to pass chunks through instead of buffering the whole export
+        'X-Accel-Buffering': 'no',
+    })
+
 @main_bp.route('/admin/users')
 @admin_required
 def admin_users():
     """Admin users management"""
-    users = User.query.all()
-    return render_template('admin/users.html', title='Manage Users', users=users)
+    search = request.args.get('q', '').strip()
+    sort = request.args.get('sort', 'newest')
+    if sort not in USER_SORTS:
+        sort = 'newest'
+    cursor = request.args.get('cursor')
+    try:
+        page = user_listing(search=search, sort=sort, cursor=cursor)
+    except ValueError:
+        flash('That page link is no longer valid', 'error')
+        return redirect(url_for('main.admin_users', q=search or None, sort=sort))
+    total_users, admin_users = user_role_counts()
+    return render_template('admin/users.html', title='Manage Users', users=page.users, page=page,
+                           cursor=cursor, search=search, sort=sort, sorts=USER_SORTS,
+                           total_users=total_users, admin_users=admin_users)
 
 @main_bp.route('/admin/users/<int:user_id>/make-admin')
 @admin_required
@@ -0,0 +1,282 @@
+"""Full-text product search for Wonderland Toy Store
+
+On SQLite, products are indexed in the ``product_search`` FTS5 virtual table
+(product name, description and category name, keyed by product id). Triggers
+on ``products`` and ``categories`` keep it in sync for every write, including
+bulk statements that bypass the ORM; ``create_search_index()`` (migration 9)
+creates the table and triggers and indexes existing products.
+
+Every query term is matched as a prefix, results are ranked with BM25 (name
+matches weigh most, then category, then description; broad queries rank
+their newest RANKING_WINDOW matches and list the older ones after them,
+newest first) and can be filtered by category, price range and stock. When
+nothing matches, misspelt terms are replaced by the closest indexed words
+and the search is retried once.
+
+Other databases fall back to ``LIKE '%term%'`` over name, description and
+category name.
+"""
+import bisect
+import difflib
+import re
+
+from sqlalchemy import text
+
+from app import db
+from app.cache import cache
+from app.models import Product, Category
+
+SEARCH_PAGE_SIZE = 24
+MAX_SEARCH_PAGE_SIZE = 100
+# BM25 column weights: name, description, category
+SEARCH_WEIGHTS = (10.0, 1.0, 5.0)
+# Broad queries rank only this many of their newest matches (see _fts_search)
+RANKING_WINDOW = 1000
+# Terms shorter than this are never spell-corrected
+MIN_CORRECTION_LENGTH = 4
+
+_TERM = re.compile(r'\w+', re.UNICODE)
+
+SEARCH_INDEX_DDL = [
+    # Prefix indexes make 'ter*' queries as cheap as whole-term ones for short prefixes
+    """CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5(
+        name, description, category,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3 4'
+    )""",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS product_search_vocab USING fts5vocab(product_search, row)",
+    f"INSERT INTO product_search(product_search, rank) VALUES ('rank', 'bm25({', '.join(map(str, SEARCH_WEIGHTS))})')",
+    """CREATE TRIGGER IF NOT EXISTS product_search_insert AFTER INSERT ON products BEGIN
+        INSERT INTO product_search(rowid, name, description, category)
+        VALUES (new.id, new.name, coalesce(new.description, ''),
+                coalesce((SELECT name FROM categories WHERE id = new.category_id), ''));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_search_update AFTER UPDATE OF name, description, category_id ON products BEGIN
+        UPDATE product_search
+        SET name = new.name, description = coalesce(new.description, ''),
+            category = coalesce((SELECT name FROM categories WHERE id = new.category_id), '')
+        WHERE rowid = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_search_delete AFTER DELETE ON products BEGIN
+        DELETE FROM product_search WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS category_search_rename AFTER UPDATE OF name ON categories BEGIN
+        UPDATE product_search SET category = new.name
+        WHERE rowid IN (SELECT id FROM products WHERE category_id = new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS category_search_delete AFTER DELETE ON categories BEGIN
+        UPDATE product_search SET category = ''
+        WHERE rowid IN (SELECT id FROM products WHERE category_id = old.id);
+    END""",
+]
+
+
+class SearchPage:
+    """One page of search results"""
+
+    def __init__(self, products, page, has_next, corrected_query=None, boundary=None):
+        self.products = products
+        self.page = page
+        self.has_next = has_next
+        # Set when no product matched the query as typed and a spelling correction was used
+        self.corrected_query = corrected_query
+        # Ranking boundary to pass back with the other pages of the query
+        self.boundary = boundary
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+
+def create_search_index(connection):
+    """Create the FTS5 table and sync triggers and index all products (SQLite only)"""
+    if connection.dialect.name != 'sqlite':
+        return
+    for statement in SEARCH_INDEX_DDL:
+        connection.execute(text(statement))
+    connection.execute(text('DELETE FROM product_search'))
+    connection.execute(text("""
+        INSERT INTO product_search(rowid, name, description, category)
+        SELECT products.id, products.name, coalesce(products.description, ''), coalesce(categories.name, '')
+        FROM products LEFT JOIN categories ON categories.id = products.category_id
+    """))
+
+
+def search_terms(query):
+    """Split a free-text query into lowercase search terms"""
+    return [term.lower() for term in _TERM.findall(query or '')]
+
+
+def _match_expression(terms):
+    # Quote every term so FTS5 syntax in user input is never interpreted; '*' makes it a prefix query
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def _filters(category_id, min_price, max_price, in_stock):
+    criteria = []
+    if category_id is not None:
+        criteria.append(Product.category_id == category_id)
+    if min_price is not None:
+        criteria.append(Product.price >= min_price)
+    if max_price is not None:
+        criteria.append(Product.price <= max_price)
+    if in_stock:
+        criteria.append(Product.stock > 0)
+    return criteria
+
+
+def _fts_matches(ranked, bound=None):
+    """Subquery of product ids matching :match, optionally with their rank and only on one side of rowid :boundary
+
+    bound is '>=' for the newest matches, the ranking window, or '<' for the older ones.
+    """
+    columns = [db.literal_column('rowid').label('product_id')]
+    if ranked:
+        columns.append(db.literal_column('rank').label('rank'))
+    condition = 'product_search MATCH :match' + (f' AND rowid {bound} :boundary' if bound else '')
+    return db.select(*columns).select_from(text('product_search')).where(text(condition)).subquery()
+
+
+def ranking_boundary(terms):
+    """Lowest product id in the ranking window of a query, or None if every match is ranked
+
+    Broad queries rank only their newest RANKING_WINDOW matches. The
+    boundary is fixed when the first page is searched and carried in the
+    page links, so every page of a query orders the same candidates.
+    """
+    return db.session.execute(
+        text('SELECT rowid FROM product_search WHERE product_search MATCH :match '
+             'ORDER BY rowid DESC LIMIT 1 OFFSET :skip'),
+        {'match': _match_expression(terms), 'skip': RANKING_WINDOW - 1}
+    ).scalar()
+
+
+def _fts_search(terms, criteria, limit, offset, boundary=None):
+    """Return products matching all terms, best match first
+
+    BM25 has to be computed for every row it orders, which dominates the cost
+    of broad queries. With a boundary (see ranking_boundary) only the matches
+    from the boundary up are ranked; the older matches follow them, newest
+    first, so a filter that leaves few products in the window still finds
+    the rest. Without one, every match is ranked.
+    """
+    params = {'match': _match_expression(terms), 'boundary': boundary}
+    if boundary is None:
+        matches = _fts_matches(ranked=True)
+        return Product.query.join(matches, matches.c.product_id == Product.id) \
+            .filter(*criteria) \
+            .order_by(matches.c.rank, Product.id) \
+            .limit(limit) \
+            .offset(offset) \
+            .params(params) \
+            .all()
+
+    window = _fts_matches(ranked=True, bound='>=')
+    rows = Product.query.join(window, window.c.product_id == Product.id) \
+        .filter(*criteria) \
+        .order_by(window.c.rank, Product.id) \
+        .limit(limit) \
+        .offset(offset) \
+        .params(params) \
+        .all()
+    if len(rows) == limit:
+        return rows
+
+    if rows or offset == 0:
+        in_window = offset + len(rows)
+    else:
+        # The page starts past the window; count what the filters leave in it
+        in_window = Product.query.join(window, window.c.product_id == Product.id) \
+            .filter(*criteria) \
+            .params(params) \
+            .count()
+    older = _fts_matches(ranked=False, bound='<')
+    return rows + Product.query.join(older, older.c.product_id == Product.id) \
+        .filter(*criteria) \
+        .order_by(Product.id.desc()) \
+        .limit(limit - len(rows)) \
+        .offset(max(0, offset - in_window)) \
+        .params(params) \
+        .all()
+
+
+def _like_search(terms, criteria, limit, offset):
+    """Fallback for databases without FTS5: every term must appear in the name, description or category name"""
+    for term in terms:
+        pattern = f'%{term}%'
+        criteria.append(db.or_(Product.name.ilike(pattern), Product.description.ilike(pattern),
+                               Category.name.ilike(pattern)))
+    return Product.query.outerjoin(Category, Category.id == Product.category_id) \
+        .filter(*criteria) \
+        .order_by(Product.created_at.desc(), Product.id.desc()) \
+        .limit(limit) \
+        .offset(offset) \
+        .all()
+
+
+def _vocabulary(letter):
+    """Sorted indexed words starting with a letter, read through the catalog cache
+
+    fts5vocab counts the postings of every word it returns, which costs more
+    than the rest of a search; the word list only changes with the products.
+    """
+    return cache.get_or_load('products', f'search-vocabulary:{letter}', lambda: db.session.execute(
+        text('SELECT term FROM product_search_vocab WHERE term >= :start AND term < :end ORDER BY term'),
+        {'start': letter, 'end': letter + '\U0010ffff'}
+    ).scalars().all())
+
+
+def _correct_terms(terms):
+    """Replace terms that match no indexed word with the closest indexed word, if any"""
+    corrected = []
+    for term in terms:
+        if len(term) < MIN_CORRECTION_LENGTH:
+            corrected.append(term)
+            continue
+        # Only words sharing the first letter are considered, which keeps the candidate list short
+        candidates = _vocabulary(term[0])
+        position = bisect.bisect_left(candidates, term)
+        if position < len(candidates) and candidates[position].startswith(term):
+            corrected.append(term)
+            continue
+        closest = difflib.get_close_matches(term, candidates, n=1, cutoff=0.75)
+        corrected.append(closest[0] if closest else term)
+    return corrected
+
+
+def _uses_fts():
+    return db.engine.dialect.name == 'sqlite'
+
+
+def search_products(query, category_id=None, min_price=None, max_price=None, in_stock=False,
+                    page=1, per_page=SEARCH_PAGE_SIZE, boundary=None):
+    """Return a SearchPage of products matching a free-text query
+
+    boundary is the ranking boundary of an earlier page of the same query
+    (SearchPage.boundary); it is computed when not given.
+    """
+    page = max(1, page)
+    per_page = max(1, min(per_page, MAX_SEARCH_PAGE_SIZE))
+    terms = search_terms(query)
+    if not terms:
+        return SearchPage([], page, False)
+
+    criteria = _filters(category_id, min_price, max_price, in_stock)
+    offset = (page - 1) * per_page
+    if not _uses_fts():
+        rows = _like_search(terms, list(criteria), per_page + 1, offset)
+        return SearchPage(rows[:per_page], page, len(rows) > per_page)
+
+    if boundary is None:
+        boundary = ranking_boundary(terms)
+    rows = _fts_search(terms, list(criteria), per_page + 1, offset, boundary)
+
+    corrected_query = None
+    if not rows and page == 1:
+        corrected = _correct_terms(terms)
+        if corrected != terms:
+            boundary = ranking_boundary(corrected)
+            rows = _fts_search(corrected, list(criteria), per_page + 1, offset, boundary)
+            corrected_query = ' '.join(corrected)
+
+    return SearchPage(rows[:per_page], page, len(rows) > per_page, corrected_query, boundary)
@@ -0,0 +1,104 @@
+"""Per-user dashboard statistics for Wonderland Toy Store
+
+``get_user_stats()`` returns everything the customer dashboard shows: order
+count, total spent, wishlist size and the most recent orders. Results are
+read through the shared cache (app/cache.py, namespace 'user_stats', one key
+per user) and that user's key is dropped after any committed order or
+wishlist write, so a steady-state dashboard view does not touch the
+database at all and, with the redis backend, every worker sees the change.
+A miss costs two statements: one reads the order count and total spent
+(denormalized onto users, see app/models.py) with the wishlist count, the
+other the recent orders joined to their lines and products.
+
+Writes that bypass the ORM events call ``mark_user_stats_dirty()``.
+"""
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from app import db
+from app.cache import cache
+from app.models import User, Order, Wishlist
+from app.loading import FEW_ORDERS_WITH_LINES
+
+USER_STATS_TTL = 300
+RECENT_ORDERS_LIMIT = 5
+
+
+class RecentOrder:
+    """Snapshot of an order as shown on the customer dashboard"""
+
+    def __init__(self, order):
+        names = [line.product.name for line in order.lines]
+        self.id = order.id
+        self.product_name = names[0] + (f' + {len(names) - 1} more' if len(names) > 1 else '') if names else 'Order'
+        self.quantity = order.item_count
+        self.total_price = order.total_price
+        self.status = order.status
+        self.created_at = order.created_at
+
+
+class UserStats:
+    """Dashboard statistics for one user"""
+
+    def __init__(self, orders_count, total_spent, wishlist_count, recent_orders):
+        self.orders_count = orders_count
+        self.total_spent = total_spent
+        self.wishlist_count = wishlist_count
+        self.recent_orders = recent_orders
+
+
+def _load_user_stats(user_id):
+    """Load stats from the database: the counters in one statement, recent orders with their lines in another"""
+    orders_count, total_spent, wishlist_count = db.session.execute(
+        db.select(
+            User.order_count,
+            User.lifetime_spend,
+            db.select(db.func.count(Wishlist.id)).where(Wishlist.user_id == user_id).scalar_subquery(),
+        ).where(User.id == user_id)
+    ).one()
+
+    recent_orders = Order.query.options(*FEW_ORDERS_WITH_LINES) \
+        .filter_by(user_id=user_id) \
+        .order_by(Order.created_at.desc()) \
+        .limit(RECENT_ORDERS_LIMIT) \
+        .all()
+    return UserStats(orders_count, total_spent, wishlist_count, [RecentOrder(order) for order in recent_orders])
+
+
+def get_user_stats(user_id):
+    """Return UserStats for a user, from the cache when possible"""
+    return cache.get_or_load('user_stats', str(user_id), lambda: _load_user_stats(user_id), ttl=USER_STATS_TTL)
+
+
+def invalidate_user_stats(*user_ids):
+    """Drop the cached stats of users"""
+    cache.invalidate_keys('user_stats', *(str(user_id) for user_id in user_ids))
+
+
+def mark_user_stats_dirty(session, *user_ids):
+    """Drop the users' cached stats once the session's transaction commits"""
+    session.info.setdefault('user_stats_dirty', set()).update(user_ids)
+
+
+def _mark_dirty(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        mark_user_stats_dirty(session, target.user_id)
+
+
+for _model in (Order, Wishlist):
+    for _event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _event_name, _mark_dirty)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    user_ids = session.info.pop('user_stats_dirty', None)
+    if user_ids and has_app_context() and 'cache' in current_app.extensions:
+        invalidate_user_stats(*user_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('user_stats_dirty', None)
@@ -0,0 +1,267 @@
+"""Write coordinator for SQLite deployments
+
+SQLite lets one connection write at a time. pysqlite only sends BEGIN just
+before a transaction's first INSERT/UPDATE/DELETE, so a request's earlier
+SELECTs (the cart, the stock) run outside the transaction and may be stale
+by the time it gets the write lock. Writers waiting for that lock poll it
+with growing sleeps, so under load the lock goes to whoever polls at the
+right moment, and after the busy timeout the request fails with "database
+is locked".
+
+write_transaction(work) runs a unit of work as one short write transaction:
+
+- writers in the same process take turns on a lock, queueing instead of
+  polling the database lock against each other;
+- the transaction opens with BEGIN IMMEDIATE, which takes the write lock up
+  front (waiting up to the busy timeout for other processes), so every read
+  inside the work sees the data its writes will be based on;
+- if SQLite still reports SQLITE_BUSY, the work is rolled back and run again
+  after an exponentially growing, jittered pause, up to SQLITE_WRITE_RETRIES
+  times, and then DatabaseBusy is raised.
+
+The work must do all of the request's writes and read what it needs itself:
+the session is rolled back before it starts, which expires loaded objects.
+
+Lock waits, retries and failures are counted per process (WriteStats) and
+shown on /admin/metrics and /metrics. A background thread runs a PASSIVE WAL
+checkpoint every SQLITE_CHECKPOINT_INTERVAL seconds, which never blocks
+readers or writers and leaves little work for the commit that crosses
+SQLite's wal_autocheckpoint threshold.
+
+On other databases, or with SQLITE_WRITE_COORDINATOR off, write_transaction()
+just runs the work and commits.
+"""
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from app import db
+from app.metrics import percentile
+
+SQLITE_WRITE_RETRIES = 5
+# Pause before the first retry, in seconds; doubled for every further retry
+SQLITE_RETRY_BACKOFF = 0.05
+MAX_RETRY_BACKOFF = 2.0
+SQLITE_CHECKPOINT_INTERVAL = 30
+# Lock waits kept per process for the percentiles
+RECENT_WAITS = 1000
+
+_immediate = ContextVar('sqlite_begin_immediate', default=False)
+
+
+class DatabaseBusy(Exception):
+    """Raised when a write transaction still finds the database locked after every retry"""
+
+
+def is_busy(error):
+    """Whether an OperationalError is SQLite's SQLITE_BUSY ("database is locked")"""
+    orig = getattr(error, 'orig', error)
+    code = getattr(orig, 'sqlite_errorcode', None)
+    if code is not None:
+        # Extended codes such as SQLITE_BUSY_SNAPSHOT keep the primary code in the low byte
+        return code & 0xff == sqlite3.SQLITE_BUSY
+    return 'database is locked' in str(orig)
+
+
+class WriteStats:
+    """Lock wait, retry and checkpoint counts for one process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.transactions = 0
+            self.busy_errors = 0
+            self.failures = 0
+            self.lock_wait = 0.0
+            self.max_lock_wait = 0.0
+            self.recent_waits = deque(maxlen=RECENT_WAITS)
+            self.checkpoints = 0
+            self.checkpoint_time = 0.0
+            # (busy, WAL pages, pages checkpointed) from the last checkpoint
+            self.last_checkpoint = None
+
+    def add_wait(self, seconds, busy=False):
+        with self._lock:
+            self.lock_wait += seconds
+            self.max_lock_wait = max(self.max_lock_wait, seconds)
+            self.recent_waits.append(seconds)
+            if busy:
+                self.busy_errors += 1
+            else:
+                self.transactions += 1
+
+    def add_failure(self):
+        with self._lock:
+            self.failures += 1
+
+    def add_checkpoint(self, seconds, result):
+        with self._lock:
+            self.checkpoints += 1
+            self.checkpoint_time += seconds
+            self.last_checkpoint = tuple(result)
+
+    def summary(self):
+        with self._lock:
+            waits = list(self.recent_waits)
+            attempts = self.transactions + self.busy_errors
+            return {
+                'transactions': self.transactions,
+                'busy_errors': self.busy_errors,
+                'failures': self.failures,
+                'avg_lock_wait_ms': round(self.lock_wait / attempts * 1000, 2) if attempts else 0,
+                'p95_lock_wait_ms': round(percentile(waits, 0.95) * 1000, 2) if waits else None,
+                'max_lock_wait_ms': round(self.max_lock_wait * 1000, 2),
+                'checkpoints': self.checkpoints,
+                'avg_checkpoint_ms': round(self.checkpoint_time / self.checkpoints * 1000, 2) if self.checkpoints else 0,
+                'wal_pages': self.last_checkpoint[1] if self.last_checkpoint else None,
+            }
+
+    def prometheus(self):
+        """The counters in the Prometheus text exposition format"""
+        with self._lock:
+            counters = (
+                ('wonderland_sqlite_write_transactions_total', 'Write transactions committed', self.transactions),
+                ('wonderland_sqlite_busy_errors_total', 'Write attempts that found the database locked',
+                 self.busy_errors),
+                ('wonderland_sqlite_write_failures_total', 'Write transactions given up after every retry',
+                 self.failures),
+                ('wonderland_sqlite_lock_wait_seconds_total', 'Time spent waiting for the write locks', self.lock_wait),
+                ('wonderland_sqlite_checkpoints_total', 'Background WAL checkpoints run', self.checkpoints),
+            )
+        lines = []
+        for name, help_text, value in counters:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+class WriteCoordinator:
+    """The writer lock, retry settings, stats and WAL checkpointer of one app"""
+
+    def __init__(self, retries, backoff, checkpoint_interval):
+        self.retries = retries
+        self.backoff = backoff
+        self.checkpoint_interval = checkpoint_interval
+        self.stats = WriteStats()
+        self._start_lock = threading.Lock()
+        self._reset_process()
+
+    def _reset_process(self):
+        # Locks and threads do not survive a fork; every worker process gets its own
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.checkpointer = None
+
+    def run(self, work, *args, **kwargs):
+        if self.pid != os.getpid():
+            with self._start_lock:
+                if self.pid != os.getpid():
+                    self._reset_process()
+                    self.stats.reset()
+        if self.checkpointer is None and self.checkpoint_interval:
+            self._start_checkpointer()
+
+        for attempt in range(self.retries + 1):
+            db.session.rollback()
+            started = time.perf_counter()
+            with self.lock:
+                token = _immediate.set(True)
+                try:
+                    # BEGIN IMMEDIATE: waits here until no other connection is writing
+                    db.session.connection()
+                    waited = time.perf_counter() - started
+                    result = work(*args, **kwargs)
+                    db.session.commit()
+                except OperationalError as error:
+                    db.session.rollback()
+                    if not is_busy(error):
+                        raise
+                    self.stats.add_wait(time.perf_counter() - started, busy=True)
+                except BaseException:
+                    db.session.rollback()
+                    raise
+                else:
+                    self.stats.add_wait(waited)
+                    return result
+                finally:
+                    _immediate.reset(token)
+            if attempt < self.retries:
+                pause = min(self.backoff * 2 ** attempt, MAX_RETRY_BACKOFF)
+                time.sleep(pause * random.uniform(0.5, 1.5))
+
+        self.stats.add_failure()
+        current_app.logger.warning('Write transaction %s gave up after %d attempts: database is locked',
+                                   getattr(work, '__name__', work), self.retries + 1)
+        raise DatabaseBusy('The database is busy; please try again')
+
+    def _start_checkpointer(self):
+        with self._start_lock:
+            if self.checkpointer is not None:
+                return
+            self.checkpointer = threading.Thread(target=self._checkpoint_loop, args=(current_app._get_current_object(),),
+                                                 name='sqlite-checkpoint', daemon=True)
+            self.checkpointer.start()
+
+    def _checkpoint_loop(self, app):
+        while True:
+            time.sleep(self.checkpoint_interval)
+            try:
+                with app.app_context():
+                    started = time.perf_counter()
+                    with db.engine.connect() as connection:
+                        result = connection.exec_driver_sql('PRAGMA wal_checkpoint(PASSIVE)').one()
+                    self.stats.add_checkpoint(time.perf_counter() - started, result)
+            except Exception:
+                app.logger.exception('WAL checkpoint failed')
+
+
+def write_transaction(work, *args, **kwargs):
+    """Run work(*args, **kwargs) as one write transaction and commit it; returns its result
+
+    Exceptions raised by the work roll the transaction back and propagate.
+    Raises DatabaseBusy if SQLite stayed locked through every retry.
+    """
+    coordinator = current_app.extensions.get('writes')
+    if _immediate.get():
+        # Already inside a write transaction: the outer one commits
+        return work(*args, **kwargs)
+    if coordinator is not None:
+        return coordinator.run(work, *args, **kwargs)
+    try:
+        result = work(*args, **kwargs)
+        db.session.commit()
+        return result
+    except BaseException:
+        db.session.rollback()
+        raise
+
+
+def _begin_immediate(connection):
+    if _immediate.get():
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+
+def init_app(app):
+    """Coordinate writes to an SQLite primary database"""
+    if not app.config.get('SQLITE_WRITE_COORDINATOR', True):
+        return
+    with app.app_context():
+        engine = db.engine
+        if engine.dialect.name != 'sqlite':
+            return
+        event.listen(engine, 'begin', _begin_immediate)
+    app.extensions['writes'] = WriteCoordinator(
+        app.config.get('SQLITE_WRITE_RETRIES', SQLITE_WRITE_RETRIES),
+        app.config.get('SQLITE_RETRY_BACKOFF', SQLITE_RETRY_BACKOFF),
+        app.config.get('SQLITE_CHECKPOINT_INTERVAL', SQLITE_CHECKPOINT_INTERVAL),
+    )
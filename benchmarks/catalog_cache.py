@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""Benchmark catalog pages with and without the read-through and page caches
+
+Seeds a throwaway database with a synthetic catalog and times anonymous
+requests to the homepage and category pages with: no cache, the data cache
+only (in-process LRU), the data and page caches, and both over RedisCache
+with the in-memory FakeRedis (which measures the pickling cost of the Redis
+backend, not network time). With the page cache, gzip-encoded requests and
+conditional requests (If-None-Match, answered 304) are timed too. Prints
+latency percentiles, SQL statements per request and hit ratios.
+
+Usage: python benchmarks/catalog_cache.py [--products 5000] [--categories 40] [--requests 300]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db
+from app.cache import cache, RedisCache, FakeRedis
+from app.catalog import refresh_category_counts
+from app.models import Product, Category
+from benchmarks.query_counts import count_queries
+
+URLS = ['/', '/products', '/categories', '/about']
+
+CONFIGS = [
+    ('no cache', lambda: {'CACHE_BACKEND': 'none', 'PAGE_CACHE': False}),
+    ('data', lambda: {'CACHE_BACKEND': 'local', 'PAGE_CACHE': False}),
+    ('data+page', lambda: {'CACHE_BACKEND': 'local'}),
+    ('fake redis', lambda: {'CACHE_BACKEND': RedisCache(FakeRedis())}),
+]
+
+
+def seed_catalog(products, categories):
+    rng = random.Random(7)
+    db.session.add_all(Category(name=f'Category {i}', description=f'Toys of kind {i}') for i in range(categories))
+    db.session.commit()
+    category_ids = [category.id for category in Category.query.all()]
+    db.session.execute(db.insert(Product), [{
+        'name': f'Toy {i}',
+        'description': 'A synthetic toy for the cache benchmark',
+        'price': round(rng.uniform(3, 150), 2),
+        'stock': rng.randint(0, 40),
+        'category_id': rng.choice(category_ids),
+        'is_featured': i % 250 == 0,
+    } for i in range(products)])
+    db.session.commit()
+    refresh_category_counts()
+
+
+def percentile(timings, pct):
+    return timings[min(len(timings) - 1, int(round(pct / 100 * (len(timings) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--categories', type=int, default=40)
+    parser.add_argument('--requests', type=int, default=300)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        uri = f'sqlite:///{os.path.join(tmp, "cache.db")}'
+        with create_app({'SQLALCHEMY_DATABASE_URI': uri}).app_context():
+            seed_catalog(args.products, args.categories)
+
+        print(f'{"cache":<12}{"request":<22}{"p50 ms":>8}{"p95 ms":>8}{"SQL/req":>9}{"hit ratio":>11}')
+        for label, config in CONFIGS:
+            app = create_app({'SQLALCHEMY_DATABASE_URI': uri, **config()})
+            client = app.test_client()
+            with app.app_context():
+                engine = db.engine
+            requests = [(url, {}) for url in URLS]
+            if app.config['PAGE_CACHE']:
+                etag = client.get('/', headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+                requests += [('/ gzip', {'Accept-Encoding': 'gzip'}),
+                             ('/ If-None-Match', {'Accept-Encoding': 'gzip', 'If-None-Match': etag})]
+            for name, headers in requests:
+                url = name.split()[0]
+                client.get(url, headers=headers)  # warm up
+                before = cache.stats()
+                timings = []
+                with count_queries(engine) as statements:
+                    for _ in range(args.requests):
+                        start = time.perf_counter()
+                        client.get(url, headers=headers)
+                        timings.append((time.perf_counter() - start) * 1000)
+                hits = lookups = 0
+                for namespace, counts in cache.stats().items():
+                    previous = before.get(namespace, {'hits': 0, 'misses': 0})
+                    hits += counts['hits'] - previous['hits']
+                    lookups += counts['hits'] + counts['misses'] - previous['hits'] - previous['misses']
+                timings.sort()
+                print(f'{label:<12}{name:<22}{statistics.median(timings):>8.2f}{percentile(timings, 95):>8.2f}'
+                      f'{len(statements) / args.requests:>9.1f}{hits / lookups if lookups else 0:>11.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""Benchmark keyset pagination of the catalog listing
+
+Seeds a throwaway SQLite database with a large catalog and compares request
+latency for page 1 and a deep page of /products/all and
+/products/category/<id>. With keyset pagination both should be flat.
+
+Usage: python benchmarks/catalog_pagination.py [--products 100000] [--page 1000]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db
+from app.catalog import CATALOG_PAGE_SIZE, encode_cursor, refresh_category_counts
+from app.models import Product, Category
+
+
+def seed_products(count):
+    """Bulk insert synthetic products spread across all categories"""
+    if Category.query.first() is None:
+        for i in range(10):
+            db.session.add(Category(name=f'Benchmark Category {i}'))
+        db.session.commit()
+    category_ids = [category.id for category in Category.query.all()]
+    start = datetime.utcnow() - timedelta(days=365)
+    batch = []
+    for i in range(count):
+        batch.append({
+            'name': f'Benchmark Toy {i}',
+            'price': round(5 + (i % 200) * 0.5, 2),
+            'description': 'Synthetic product for pagination benchmarks',
+            'stock': i % 50,
+            'category_id': category_ids[i % len(category_ids)],
+            'created_at': start + timedelta(seconds=i),
+            'updated_at': start + timedelta(seconds=i),
+        })
+        if len(batch) == 10000:
+            db.session.execute(db.insert(Product), batch)
+            batch = []
+    if batch:
+        db.session.execute(db.insert(Product), batch)
+    db.session.commit()
+    # Bulk inserts bypass the ORM events that maintain the counts
+    refresh_category_counts()
+
+
+def cursor_for_page(page_number, category_id=None):
+    """Find the cursor that opens the given page (untimed setup)"""
+    if page_number <= 1:
+        return None
+    query = Product.query
+    if category_id is not None:
+        query = query.filter(Product.category_id == category_id)
+    boundary = query.order_by(Product.created_at.desc(), Product.id.desc()) \
+        .offset((page_number - 1) * CATALOG_PAGE_SIZE - 1).first()
+    return encode_cursor(boundary) if boundary else None
+
+
+def time_requests(client, url, repeat):
+    """Return sorted request latencies in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(url)
+        timings.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200, f'{url} returned {response.status_code}'
+    return sorted(timings)
+
+
+def percentile(timings, pct):
+    return timings[min(len(timings) - 1, int(round(pct / 100 * (len(timings) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=100000)
+    parser.add_argument('--page', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.db')
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{db_path}'})
+
+        with app.app_context():
+            print(f'Seeding {args.products} products...')
+            seed_products(args.products)
+            category_id = Category.query.first().id
+            # Keep the deep page inside the category listing as well
+            category_page = min(args.page, max(1, Product.query.filter_by(category_id=category_id).count() // CATALOG_PAGE_SIZE))
+            targets = [
+                ('/products/all', 1, None),
+                ('/products/all', args.page, None),
+                (f'/products/category/{category_id}', 1, category_id),
+                (f'/products/category/{category_id}', category_page, category_id),
+            ]
+            urls = []
+            for path, page_number, cat_id in targets:
+                cursor = cursor_for_page(page_number, cat_id)
+                urls.append((path, page_number, f'{path}?cursor={cursor}' if cursor else path))
+
+        client = app.test_client()
+        print(f'\n{"route":<28} {"page":>6} {"p50 ms":>9} {"p95 ms":>9}')
+        for path, page_number, url in urls:
+            client.get(url)  # warm up
+            timings = time_requests(client, url, args.repeat)
+            print(f'{path:<28} {page_number:>6} {statistics.median(timings):>9.2f} {percentile(timings, 95):>9.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Measure application cold-start time, as paid by every new worker process
+
+Each run starts a fresh interpreter that imports the app package and calls
+create_app() against an already-initialised database, reporting the import
+time, the create_app() time and the number of SQL statements issued during
+startup. The first (bootstrap) run is not counted.
+
+Pass --root to benchmark another checkout of the repository, e.g. a git
+worktree of an older commit, for before/after comparisons.
+
+Usage: python benchmarks/cold_start.py [--runs 15] [--root PATH]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import sys, time
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+statements = []
+event.listen(Engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+from app import create_app
+imported = time.perf_counter()
+create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + sys.argv[2]})
+done = time.perf_counter()
+print('RESULT', imported - started, done - imported, len(statements))
+'''
+
+
+def start_once(root, db_path):
+    """Start the app in a new interpreter; return (import s, create_app s, statements)"""
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD, root, db_path],
+        capture_output=True, text=True, check=True, cwd=root,
+    ).stdout
+    result = [line for line in output.splitlines() if line.startswith('RESULT ')][-1].split()
+    return float(result[1]), float(result[2]), int(result[3])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=15)
+    parser.add_argument('--root', default=REPO_ROOT, help='repository checkout to benchmark')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'cold_start.db')
+        start_once(args.root, db_path)
+        runs = [start_once(args.root, db_path) for _ in range(args.runs)]
+
+    imports, startups, statements = zip(*runs)
+    print(f'{args.runs} cold starts of {args.root}')
+    print(f'{"":<22}{"median":>10}{"min":>10}{"max":>10}')
+    for label, values in (('import app (ms)', imports), ('create_app() (ms)', startups)):
+        values = [value * 1000 for value in values]
+        print(f'{label:<22}{statistics.median(values):>10.1f}{min(values):>10.1f}{max(values):>10.1f}')
+    print(f'{"SQL statements":<22}{statistics.median(statements):>10.0f}{min(statements):>10}{max(statements):>10}')
+
+
+if __name__ == '__main__':
+    main()
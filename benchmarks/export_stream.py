@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""Measure memory and write blocking while streaming a large order export
+
+Copies the checked-in database to a throwaway directory, bulk-inserts
+synthetic orders, and downloads /admin/export/orders as CSV and JSONL,
+reading the response chunk by chunk. Reports rows per second and the peak
+Python heap (tracemalloc) during the export, next to the peak for loading the
+same orders with ``Order.query.all()`` the way the admin orders page does.
+
+While each export runs, a second thread keeps inserting orders; its slowest
+commit shows whether the export held up writers.
+
+Usage: python benchmarks/export_stream.py [--orders 200000]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from app import create_app, db
+from app.models import User, Order
+
+STATUSES = ['pending', 'processing', 'shipped', 'delivered', 'cancelled']
+
+
+def seed_orders(count, user_id):
+    """Insert orders directly (bypassing the rollup events) in large batches"""
+    rng = random.Random(7)
+    start = datetime.utcnow() - timedelta(days=365)
+    table = Order.__table__
+    for offset in range(0, count, 20000):
+        db.session.execute(table.insert(), [{
+            'user_id': user_id,
+            'total_price': round(rng.uniform(5, 500), 2),
+            'status': rng.choice(STATUSES),
+            'full_name': f'Customer {n}',
+            'email': f'customer{n}@example.com',
+            'shipping_address': f'{n} Main Street',
+            'city': 'Springfield',
+            'state': 'CA',
+            'postal_code': '90210',
+            'payment_method': 'card',
+            'payment_status': 'completed',
+            'created_at': start + timedelta(seconds=n * 365 * 86400 // count),
+        } for n in range(offset, min(offset + 20000, count))])
+        db.session.commit()
+
+
+class Writer(threading.Thread):
+    """Inserts one order per loop and records how long each commit took"""
+
+    def __init__(self, app, user_id):
+        super().__init__(daemon=True)
+        self.app = app
+        self.user_id = user_id
+        self.stop = threading.Event()
+        self.latencies = []
+
+    def run(self):
+        with self.app.app_context():
+            while not self.stop.is_set():
+                start = time.perf_counter()
+                db.session.execute(Order.__table__.insert().values(
+                    user_id=self.user_id, total_price=1.0, status='pending', created_at=datetime.utcnow()))
+                db.session.commit()
+                self.latencies.append((time.perf_counter() - start) * 1000)
+                time.sleep(0.005)
+
+
+def export(app, client, user_id, url):
+    writer = Writer(app, user_id)
+    writer.start()
+    tracemalloc.start()
+    start = time.perf_counter()
+    response = client.get(url)
+    size = lines = 0
+    for chunk in response.iter_encoded():
+        size += len(chunk)
+        lines += chunk.count(b'\n')
+    response.close()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    writer.stop.set()
+    writer.join()
+    return lines, size, elapsed, peak, max(writer.latencies, default=0), len(writer.latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=200000, help='synthetic orders to add')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy(os.path.join(REPO_ROOT, 'instance', 'store.db'), os.path.join(tmp, 'store.db'))
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(tmp, "store.db")}'})
+        with app.app_context():
+            admin_id = User.query.filter_by(is_admin=True).first().id
+            seed_orders(args.orders, admin_id)
+            total = db.session.query(db.func.count(Order.id)).scalar()
+        print(f'{total} orders')
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(admin_id)
+            session['_fresh'] = True
+
+        print(f'{"":<28}{"rows":>9}{"MB":>8}{"s":>7}{"rows/s":>9}{"peak MB":>9}{"max write ms":>14}{"writes":>8}')
+        for label, url in [
+            ('CSV, all orders', '/admin/export/orders?format=csv'),
+            ('JSONL, all orders', '/admin/export/orders?format=jsonl'),
+            ('CSV, shipped, one month', '/admin/export/orders?status=shipped&start='
+             f'{(datetime.utcnow() - timedelta(days=60)):%Y-%m-%d}&end={(datetime.utcnow() - timedelta(days=30)):%Y-%m-%d}'),
+        ]:
+            lines, size, elapsed, peak, max_write, writes = export(app, client, admin_id, url)
+            rows = lines - (1 if 'jsonl' not in url else 0)
+            print(f'{label:<28}{rows:>9}{size / 1e6:>8.1f}{elapsed:>7.1f}{rows / elapsed:>9.0f}'
+                  f'{peak / 1e6:>9.1f}{max_write:>14.1f}{writes:>8}')
+
+        with app.app_context():
+            tracemalloc.start()
+            start = time.perf_counter()
+            orders = Order.query.order_by(Order.created_at.desc()).all()
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f'{"Order.query.all()":<28}{len(orders):>9}{"":>8}{elapsed:>7.1f}{len(orders) / elapsed:>9.0f}'
+                  f'{peak / 1e6:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
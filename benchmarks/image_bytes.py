@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Measure the bytes a browser downloads for a catalog page, before and after image variants
+
+Copies the checked-in database and product images to a throwaway directory,
+renders the first page of /products/all, and adds up the HTML (gzip) and the
+image bytes a browser would fetch: the original uploads before running
+`flask process-images`, and afterwards the srcset candidate it would pick
+for each format it supports (the smallest variant at least as wide as the
+rendered image times the device pixel ratio).
+
+Usage: python benchmarks/image_bytes.py [--css-width 300]
+"""
+import argparse
+import gzip
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from app import create_app
+
+IMG = re.compile(r'<img src="([^"]+)"')
+SOURCE = re.compile(r'<source type="([^"]+)" srcset="([^"]+)"')
+PICTURE = re.compile(r'<picture.*?</picture>', re.S)
+
+# (label, formats the browser decodes, device pixel ratio)
+BROWSERS = [
+    ('JPEG only, 1x', {'image/jpeg'}, 1),
+    ('WebP, 2x', {'image/webp', 'image/jpeg'}, 2),
+    ('AVIF, 1x', {'image/avif', 'image/webp', 'image/jpeg'}, 1),
+    ('AVIF, 2x', {'image/avif', 'image/webp', 'image/jpeg'}, 2),
+]
+
+
+def file_size(static_folder, url):
+    return os.path.getsize(os.path.join(static_folder, url[len('/static/'):]))
+
+
+def chosen_candidate(picture, formats, needed_width):
+    """The URL a browser picks from a <picture>: first supported source, smallest sufficient width"""
+    for mime_type, srcset in SOURCE.findall(picture):
+        if mime_type not in formats:
+            continue
+        candidates = sorted((int(width.rstrip('w')), url) for url, width in
+                            (candidate.strip().split() for candidate in srcset.split(',')))
+        return next((url for width, url in candidates if width >= needed_width), candidates[-1][1])
+    return IMG.search(picture).group(1)
+
+
+def page(client):
+    """The page HTML and its gzip-compressed size"""
+    html = client.get('/products/all').get_data()
+    return len(gzip.compress(html)), html.decode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--css-width', type=int, default=300, help='rendered width of a product card image')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy(os.path.join(REPO_ROOT, 'instance', 'store.db'), os.path.join(tmp, 'store.db'))
+        static_folder = os.path.join(tmp, 'static')
+        shutil.copytree(os.path.join(REPO_ROOT, 'app', 'static'), static_folder)
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(tmp, "store.db")}'})
+        app.static_folder = static_folder
+        client = app.test_client()
+
+        compressed_size, html = page(client)
+        originals = sum(file_size(static_folder, url) for url in IMG.findall(html))
+        print(f'{"":<18}{"images":>8}{"HTML gz KB":>12}{"images KB":>11}{"total KB":>10}')
+        print(f'{"before":<18}{len(IMG.findall(html)):>8}{compressed_size / 1024:>12.1f}'
+              f'{originals / 1024:>11.1f}{(compressed_size + originals) / 1024:>10.1f}')
+
+        result = app.test_cli_runner().invoke(args=['process-images'])
+        print(result.output.strip())
+        compressed_size, html = page(client)
+        pictures = PICTURE.findall(html)
+        for label, formats, ratio in BROWSERS:
+            images = sum(file_size(static_folder, chosen_candidate(picture, formats, args.css_width * ratio))
+                         for picture in pictures)
+            total = compressed_size + images
+            print(f'{label:<18}{len(pictures):>8}{compressed_size / 1024:>12.1f}'
+                  f'{images / 1024:>11.1f}{total / 1024:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+"""Load-test the storefront's hot paths with scripted shopper journeys
+
+Generates a synthetic database (benchmarks/synthetic_data.py) in a
+throwaway directory, or copies one given with --database, then runs
+--journeys shopper journeys spread over --concurrency virtual users. Each
+virtual user logs in once as its own bench_user; every journey then goes
+
+    browse (home, catalog, a category, search, the products API)
+    -> add to cart (one to three products) -> cart
+    -> checkout (form, then cash-on-delivery order) -> orders -> dashboard
+
+Requests go through the Flask test client (--server testclient, the default)
+or over HTTP to gunicorn started on the generated database (--server
+gunicorn, with gunicorn.conf.py and --workers). Latency is measured by the
+client per route; SQL statement counts come from the server's
+/admin/metrics (with gunicorn, from whichever worker answers that request).
+
+Results are printed and, with --output, written as JSON together with the
+commit and dataset they were measured on. --compare OLD.json prints the
+change in p95 latency and SQL statements per route against an earlier run
+and exits non-zero if any route regressed by more than --tolerance.
+--capture-sql FILE records every statement the app ran for
+`flask explain-queries FILE`, which flags the ones scanning a whole table.
+
+Usage: python benchmarks/journeys.py [--scale small] [--journeys 200] [--concurrency 4]
+                                     [--server testclient|gunicorn] [--workers 4]
+                                     [--output results.json] [--compare old.json]
+                                     [--capture-sql queries.jsonl]
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import sqlalchemy
+
+from app import create_app, db
+from app.metrics import percentile
+from app.models import User, Product, Category
+from app.query_plans import QueryCapture
+from synthetic_data import ADMIN_USERNAME, PASSWORD, add_scale_arguments, counts_from_args, create_database
+
+CHECKOUT_FORM = {
+    'full_name': 'Load Test',
+    'email': 'loadtest@example.com',
+    'phone': '5550100',
+    'shipping_address': '1 Benchmark Way',
+    'city': 'Wonderland',
+    'state': 'WL',
+    'postal_code': '00000',
+    'payment_method': 'cash_on_delivery',
+    'promo_code': '',
+}
+SEARCH_TERMS = ['dragon', 'castle', 'robot', 'unicorn', 'train', 'teddy', 'puzzle', 'glow']
+
+
+class TestClientSession:
+    """One virtual user's cookie session on the Flask test client"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        response.get_data()
+        return response.status_code
+
+    def get_json(self, path):
+        return self.client.get(path).get_json()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class HttpSession:
+    """One virtual user's cookie session against a server over HTTP; redirects are not followed"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect)
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(request, timeout=60) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+    def get_json(self, path):
+        with self.opener.open(self.base_url + path, timeout=60) as response:
+            return json.load(response)
+
+
+class Recorder:
+    """Latencies and failures per route label, shared by the virtual users"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def call(self, session, label, method, path, data=None, expect=(200,)):
+        start = time.perf_counter()
+        status = session.request(method, path, data)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies[label].append(elapsed)
+            if status not in expect:
+                self.errors[label] += 1
+        return status
+
+
+def journey(session, recorder, rng, data):
+    """One shopper journey; returns whether the order was placed"""
+    call = recorder.call
+    call(session, 'GET /', 'GET', '/')
+    call(session, 'GET /products/all', 'GET', f'/products/all?sort={rng.choice(["newest", "price_asc", "price_desc"])}')
+    call(session, 'GET /products/category/<id>', 'GET', f'/products/category/{rng.choice(data["categories"])}')
+    call(session, 'GET /search', 'GET', f'/search?q={rng.choice(SEARCH_TERMS)}')
+    call(session, 'GET /api/products', 'GET', f'/api/products?per_page=24&category_id={rng.choice(data["categories"])}')
+    for product_id in rng.sample(data['products'], rng.randint(1, 3)):
+        call(session, 'POST /cart/add/<id>', 'POST', f'/cart/add/{product_id}', {'quantity': 1}, expect=(302,))
+    call(session, 'GET /cart', 'GET', '/cart')
+    call(session, 'GET /checkout', 'GET', '/checkout')
+    placed = call(session, 'POST /checkout', 'POST', '/checkout', CHECKOUT_FORM, expect=(302,)) == 302
+    call(session, 'GET /orders', 'GET', '/orders')
+    call(session, 'GET /dashboard', 'GET', '/dashboard')
+    return placed
+
+
+def virtual_user(make_session, username, recorder, data, remaining, seed):
+    rng = random.Random(seed)
+    session = make_session()
+    recorder.call(session, 'POST /login', 'POST', '/login', {'username': username, 'password': PASSWORD},
+                  expect=(302,))
+    while True:
+        with remaining['lock']:
+            if remaining['count'] <= 0:
+                return
+            remaining['count'] -= 1
+        journey(session, recorder, rng, data)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(database, workers):
+    """Start gunicorn (with gunicorn.conf.py) on the database; returns (process, base URL)"""
+    port = free_port()
+    target = f"app:create_app({{'SQLALCHEMY_DATABASE_URI': 'sqlite:///{database}'}})"
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}', target],
+        cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f'gunicorn exited:\n{process.stderr.read().decode()}')
+        try:
+            urllib.request.urlopen(base_url + '/about', timeout=5).read()
+            return process, base_url
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    sys.exit('gunicorn did not start within 60s')
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_ROOT,
+                                    capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def route_results(recorder, elapsed):
+    routes = {}
+    for label, latencies in sorted(recorder.latencies.items()):
+        routes[label] = {
+            'requests': len(latencies),
+            'errors': recorder.errors[label],
+            'per_second': round(len(latencies) / elapsed, 1),
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'max_ms': round(max(latencies) * 1000, 2),
+        }
+    return routes
+
+
+def server_results(admin_session):
+    """Per-endpoint SQL figures from the server's /admin/metrics"""
+    endpoints = admin_session.get_json('/admin/metrics?format=json')['endpoints']
+    return {f'{row["method"]} {row["endpoint"]}': {
+        'requests': row['requests'],
+        'avg_sql_statements': row['avg_sql_statements'],
+        'max_sql_statements': row['max_sql_statements'],
+        'avg_sql_ms': row['avg_sql_ms'],
+        'avg_template_ms': row['avg_template_ms'],
+        'n_plus_one_requests': row['n_plus_one_requests'],
+    } for row in endpoints if not row['endpoint'].startswith('main.admin_metrics')}
+
+
+def print_results(results):
+    print(f'\n{"route":<30}{"requests":>9}{"errors":>7}{"req/s":>8}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"max ms":>9}')
+    for label, row in results['routes'].items():
+        print(f'{label:<30}{row["requests"]:>9}{row["errors"]:>7}{row["per_second"]:>8}{row["p50_ms"]:>9}'
+              f'{row["p95_ms"]:>9}{row["p99_ms"]:>9}{row["max_ms"]:>9}')
+    print(f'\n{"endpoint (server)":<36}{"requests":>9}{"SQL avg":>9}{"SQL max":>9}{"SQL ms":>8}{"tpl ms":>8}{"N+1":>5}')
+    for endpoint, row in results['server'].items():
+        print(f'{endpoint:<36}{row["requests"]:>9}{row["avg_sql_statements"]:>9}{row["max_sql_statements"]:>9}'
+              f'{row["avg_sql_ms"]:>8}{row["avg_template_ms"]:>8}{row["n_plus_one_requests"]:>5}')
+    summary = results['summary']
+    print(f'\n{summary["journeys"]} journeys ({summary["orders_placed"]} orders placed) in {summary["seconds"]}s: '
+          f'{summary["journeys_per_second"]} journeys/s, {summary["requests_per_second"]} requests/s, '
+          f'{summary["errors"]} errors')
+
+
+def compare(results, previous, tolerance):
+    """Print per-route changes against an earlier run; returns the regressions"""
+    regressions = []
+    print(f'\nAgainst {previous["meta"].get("commit") or "previous run"} ({previous["meta"].get("timestamp")}):')
+    for setting in ('server', 'workers', 'concurrency', 'dataset'):
+        if previous['meta'].get(setting) != results['meta'][setting]:
+            print(f'  warning: {setting} differs ({previous["meta"].get(setting)} vs {results["meta"][setting]})')
+    print(f'{"route":<36}{"p95 before":>11}{"p95 after":>11}{"change":>9}')
+    for label, row in results['routes'].items():
+        before = previous['routes'].get(label)
+        if before is None:
+            continue
+        change = (row['p95_ms'] - before['p95_ms']) / before['p95_ms'] if before['p95_ms'] else 0
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(f'{label}: p95 {before["p95_ms"]} -> {row["p95_ms"]} ms')
+        print(f'{label:<36}{before["p95_ms"]:>11}{row["p95_ms"]:>11}{change:>+9.0%}{flag}')
+    print(f'{"endpoint (server)":<36}{"SQL before":>11}{"SQL after":>11}')
+    for endpoint, row in results['server'].items():
+        before = previous['server'].get(endpoint)
+        if before is None:
+            continue
+        flag = ''
+        if row['max_sql_statements'] > before['max_sql_statements']:
+            flag = '  REGRESSION'
+            regressions.append(f'{endpoint}: up to {before["max_sql_statements"]} -> '
+                               f'{row["max_sql_statements"]} SQL statements')
+        print(f'{endpoint:<36}{before["avg_sql_statements"]:>11}{row["avg_sql_statements"]:>11}{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_scale_arguments(parser)
+    parser.add_argument('--database', help='copy this existing database instead of generating one')
+    parser.add_argument('--journeys', type=int, default=200, help='journeys to run in total')
+    parser.add_argument('--concurrency', type=int, default=4, help='virtual users running journeys in parallel')
+    parser.add_argument('--server', choices=['testclient', 'gunicorn'], default='testclient')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare with the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='p95 growth counted as a regression')
+    parser.add_argument('--capture-sql', help='write every statement run to this file for flask explain-queries '
+                                              '(test client only)')
+    args = parser.parse_args()
+    if args.capture_sql and args.server != 'testclient':
+        parser.error('--capture-sql needs --server testclient')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, 'store.db')
+        if args.database:
+            shutil.copy(args.database, database)
+            app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{database}'})
+            dataset = {'source': os.path.basename(args.database)}
+        else:
+            app, dataset, seconds = create_database(database, counts_from_args(args), args.seed)
+            print(', '.join(f'{count} {name}' for name, count in dataset.items()) + f' generated in {seconds:.1f}s')
+            dataset = dict(dataset, scale=args.scale, seed=args.seed)
+
+        with app.app_context():
+            data = {
+                'categories': [category_id for category_id, in db.session.query(Category.id)],
+                'products': [product_id for product_id, in db.session.query(Product.id).filter(Product.stock > 100)],
+            }
+            usernames = [username for username, in db.session.query(User.username)
+                         .filter(User.is_admin.is_(False)).order_by(User.id).limit(args.concurrency)]
+            if not db.session.query(User.id).filter_by(username=ADMIN_USERNAME).first():
+                sys.exit(f'The database has no {ADMIN_USERNAME} user; generate it with benchmarks/synthetic_data.py')
+            db.engine.dispose()
+
+        capture = None
+        if args.capture_sql:
+            capture = QueryCapture()
+            with app.app_context():
+                capture.listen(db.engine)
+
+        server = None
+        if args.server == 'gunicorn':
+            server, base_url = start_gunicorn(database, args.workers)
+            make_session = lambda: HttpSession(base_url)
+        else:
+            make_session = lambda: TestClientSession(app)
+
+        try:
+            admin_session = make_session()
+            admin_session.request('POST', '/login', {'username': ADMIN_USERNAME, 'password': PASSWORD})
+            admin_session.request('POST', '/admin/metrics/reset')
+
+            recorder = Recorder()
+            remaining = {'count': args.journeys, 'lock': threading.Lock()}
+            threads = [threading.Thread(target=virtual_user, args=(make_session, username, recorder, data, remaining, n))
+                       for n, username in enumerate(usernames)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+
+            server_side = server_results(admin_session)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    commit, dirty = git_commit()
+    requests_made = sum(len(latencies) for latencies in recorder.latencies.values())
+    results = {
+        'meta': {
+            'commit': commit,
+            'dirty': dirty,
+            'timestamp': datetime.utcnow().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'platform': platform.platform(),
+            'server': args.server,
+            'workers': args.workers if args.server == 'gunicorn' else None,
+            'concurrency': len(usernames),
+            'dataset': dataset,
+        },
+        'summary': {
+            'journeys': args.journeys,
+            'orders_placed': len(recorder.latencies['POST /checkout']) - recorder.errors['POST /checkout'],
+            'seconds': round(elapsed, 2),
+            'journeys_per_second': round(args.journeys / elapsed, 2),
+            'requests_per_second': round(requests_made / elapsed, 1),
+            'errors': sum(recorder.errors.values()),
+        },
+        'routes': route_results(recorder, elapsed),
+        'server': server_side,
+    }
+    print_results(results)
+
+    if capture is not None:
+        print(f'{capture.save(args.capture_sql)} distinct statements written to {args.capture_sql}')
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+        print(f'Results written to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as previous:
+            regressions = compare(results, json.load(previous), args.tolerance)
+        if regressions:
+            print('\nREGRESSIONS')
+            for regression in regressions:
+                print(f'  {regression}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""Measure bulk order status transitions against one ORM update and commit per order
+
+Copies the checked-in database to a throwaway directory and bulk-inserts
+--orders pending orders of one to three lines. It then times:
+
+  - a sample of orders cancelled the way admin_update_order_status() used to
+    (load the order and its lines, set the status, adjust stock, commit each)
+  - every order moved pending -> processing through POST /api/admin/orders/status
+  - every order cancelled the same way, which also returns their stock
+
+and reports orders per second and SQL statements per request. Afterwards it
+checks that product stock went up by exactly the cancelled units and that
+the sales rollups match a full rebuild.
+
+Usage: python benchmarks/order_transitions.py [--orders 20000] [--batch 500] [--orm-sample 300]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from sqlalchemy import event
+
+from app import create_app, db
+from app.inventory import adjust_stock
+from app.models import User, Product, Order, OrderLine, OrderStatusChange, ProductSales, SalesDaily
+from app.rollups import rebuild_rollups, store_totals
+
+
+def seed_orders(count, user_id, product_ids):
+    """Insert pending orders with lines directly, then rebuild the rollups they bypassed"""
+    rng = random.Random(5)
+    start = datetime.utcnow() - timedelta(days=90)
+    first_id = (db.session.query(db.func.max(Order.id)).scalar() or 0) + 1
+    for offset in range(0, count, 10000):
+        orders, lines = [], []
+        for n in range(offset, min(offset + 10000, count)):
+            order_id = first_id + n
+            total = 0.0
+            for product_id in rng.sample(product_ids, rng.randint(1, 3)):
+                quantity = rng.randint(1, 2)
+                lines.append({'order_id': order_id, 'product_id': product_id, 'quantity': quantity,
+                              'unit_price': 10.0, 'total_price': 10.0 * quantity})
+                total += 10.0 * quantity
+            orders.append({'id': order_id, 'user_id': user_id, 'total_price': total, 'status': 'pending',
+                           'payment_method': 'card', 'payment_status': 'completed',
+                           'created_at': start + timedelta(seconds=n * 90 * 86400 // count)})
+        db.session.execute(Order.__table__.insert(), orders)
+        db.session.execute(OrderLine.__table__.insert(), lines)
+        db.session.commit()
+    rebuild_rollups()
+    return list(range(first_id, first_id + count))
+
+
+def cancel_one_by_one(order_ids):
+    """The pre-bulk admin_update_order_status(): one ORM round trip and commit per order"""
+    for order_id in order_ids:
+        order = db.session.get(Order, order_id)
+        order.status = Order.STATUS_CANCELLED
+        quantities = defaultdict(int)
+        for line in order.lines:
+            quantities[line.product_id] += line.quantity
+        adjust_stock({product_id: -quantity for product_id, quantity in quantities.items()})
+        db.session.commit()
+
+
+def rollup_snapshot():
+    totals = store_totals()
+    return (
+        {name: round(value, 2) for name, value in totals.items()},
+        sorted((row.product_id, row.units_sold, round(row.revenue, 2)) for row in ProductSales.query if row.units_sold),
+        sorted((row.day, row.order_count, row.units_sold, round(row.revenue, 2)) for row in SalesDaily.query
+               if row.order_count),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=20000, help='synthetic pending orders to add')
+    parser.add_argument('--batch', type=int, default=500, help='orders per bulk request')
+    parser.add_argument('--orm-sample', type=int, default=300, help='orders cancelled one at a time for comparison')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy(os.path.join(REPO_ROOT, 'instance', 'store.db'), os.path.join(tmp, 'store.db'))
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(tmp, "store.db")}'})
+        with app.app_context():
+            admin_id = User.query.filter_by(is_admin=True).first().id
+            product_ids = [product_id for product_id, in db.session.query(Product.id)]
+            # Enough stock that restoring is never refused
+            db.session.query(Product).update({Product.stock: 1000000})
+            db.session.commit()
+            order_ids = seed_orders(args.orders, admin_id, product_ids)
+            engine = db.engine
+
+            sample, order_ids = order_ids[:args.orm_sample], order_ids[args.orm_sample:]
+            start = time.perf_counter()
+            cancel_one_by_one(sample)
+            orm_rate = len(sample) / (time.perf_counter() - start)
+            print(f'{len(order_ids)} orders; ORM update + commit per order: {orm_rate:>8.0f} orders/s')
+
+            stock_before = db.session.query(db.func.sum(Product.stock)).scalar()
+            units = db.session.query(db.func.sum(OrderLine.quantity)) \
+                .filter(OrderLine.order_id >= order_ids[0]).scalar()
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(admin_id)
+            session['_fresh'] = True
+
+        statements = []
+        event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(1))
+        for label, status in (('Bulk pending -> processing', 'processing'), ('Bulk processing -> cancelled', 'cancelled')):
+            per_request = []
+            start = time.perf_counter()
+            for offset in range(0, len(order_ids), args.batch):
+                del statements[:]
+                response = client.post('/api/admin/orders/status',
+                                       json={'order_ids': order_ids[offset:offset + args.batch], 'status': status})
+                data = response.get_json()
+                if response.status_code != 200 or data['rejected']:
+                    sys.exit(f'{label} failed: {response.status_code} {data}')
+                per_request.append(len(statements))
+            elapsed = time.perf_counter() - start
+            print(f'{label + ":":<34}{len(order_ids) / elapsed:>8.0f} orders/s ({elapsed:.1f}s, '
+                  f'{min(per_request)}-{max(per_request)} statements per {args.batch} orders)')
+
+        with app.app_context():
+            stock_after = db.session.query(db.func.sum(Product.stock)).scalar()
+            logged = db.session.query(db.func.count(OrderStatusChange.id)).scalar()
+            incremental = rollup_snapshot()
+            rebuild_rollups()
+            rebuilt = rollup_snapshot()
+        print(f'Stock returned: {stock_after - stock_before} units (expected {units}); '
+              f'{logged} audit log entries (expected {2 * len(order_ids)}); '
+              f'rollups {"match" if incremental == rebuilt else "DO NOT match"} a rebuild')
+
+
+if __name__ == '__main__':
+    main()
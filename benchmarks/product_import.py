@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Measure bulk product import throughput against one ORM add and commit per product
+
+Copies the checked-in database to a throwaway directory and generates a
+supplier catalog CSV of --rows products across the existing categories. It
+times three things:
+
+  - a sample of rows added the way admin_add_product() does it (ORM add, commit each)
+  - the whole file through `flask import-products` (batched upserts; all inserts)
+  - the same file imported again (all updates)
+
+Usage: python benchmarks/product_import.py [--rows 50000] [--orm-sample 500]
+"""
+import argparse
+import csv
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from app import create_app, db
+from app.imports import import_products
+from app.models import Product, Category
+
+
+def write_catalog(path, rows, categories):
+    rng = random.Random(11)
+    with open(path, 'w', newline='') as output:
+        writer = csv.writer(output)
+        writer.writerow(['sku', 'name', 'price', 'stock', 'category', 'description', 'is_featured'])
+        for n in range(rows):
+            writer.writerow([f'SUP-{n:07d}', f'Supplier toy {n}', f'{rng.uniform(3, 300):.2f}', rng.randint(0, 80),
+                             rng.choice(categories), f'Imported toy number {n}', 'yes' if n % 50 == 0 else 'no'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50000, help='products in the generated catalog')
+    parser.add_argument('--orm-sample', type=int, default=500, help='products added one at a time for comparison')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy(os.path.join(REPO_ROOT, 'instance', 'store.db'), os.path.join(tmp, 'store.db'))
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(tmp, "store.db")}'})
+        path = os.path.join(tmp, 'catalog.csv')
+        with app.app_context():
+            categories = {name: category_id for category_id, name in db.session.query(Category.id, Category.name)}
+            write_catalog(path, args.rows, list(categories))
+
+            start = time.perf_counter()
+            with open(path, newline='') as catalog:
+                for n, row in enumerate(csv.DictReader(catalog)):
+                    if n == args.orm_sample:
+                        break
+                    db.session.add(Product(name=row['name'], price=float(row['price']), stock=int(row['stock']),
+                                           description=row['description'], category_id=categories[row['category']]))
+                    db.session.commit()
+            orm_rate = args.orm_sample / (time.perf_counter() - start)
+            print(f'ORM add + commit per product: {orm_rate:>8.0f} rows/s '
+                  f'({args.rows / orm_rate:.0f}s for {args.rows} rows)')
+
+            for label in ('Bulk import (inserts)', 'Bulk import (updates)'):
+                with open(path, newline='') as catalog:
+                    result = import_products(catalog, 'csv')
+                print(f'{label + ":":<30}{result.rows_per_second:>8.0f} rows/s ({result.elapsed:.1f}s, '
+                      f'{result.inserted} new, {result.updated} updated, {result.failed} failed)')
+
+            imported = db.session.query(db.func.count(Product.id)).filter(Product.sku.isnot(None)).scalar()
+            counted = db.session.query(db.func.sum(Category.product_count)).scalar()
+            total = db.session.query(db.func.count(Product.id)).filter(Product.category_id.isnot(None)).scalar()
+            print(f'{imported} products with a SKU; category counts {"match" if counted == total else "DO NOT match"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""Benchmark full-text product search against a LIKE '%term%' baseline
+
+Seeds a throwaway SQLite database with a large synthetic catalog (indexed by
+the FTS5 triggers as it is inserted) and times search_products() for queries
+of different selectivity, once through FTS5 and once through the LIKE
+fallback used on databases without FTS5.
+
+Usage: python benchmarks/product_search.py [--products 200000] [--repeat 30]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db
+from app import search
+from app.catalog import refresh_category_counts
+from app.models import Product, Category
+
+BRANDS = ['Lego', 'Hotwheels', 'Barbie', 'Playmobil', 'Melissa', 'Crayola', 'Nerf', 'Hasbro', 'Mattel', 'Vtech']
+ADJECTIVES = ['Classic', 'Deluxe', 'Mini', 'Giant', 'Electric', 'Wooden', 'Magnetic', 'Glowing', 'Rainbow', 'Turbo',
+              'Fluffy', 'Pocket', 'Musical', 'Foldable', 'Racing', 'Galactic', 'Jungle', 'Ocean', 'Arctic', 'Retro']
+NOUNS = ['Dinosaur', 'Castle', 'Rocket', 'Unicorn', 'Train', 'Puzzle', 'Robot', 'Dollhouse', 'Kite', 'Truck',
+         'Spaceship', 'Pirate', 'Dragon', 'Submarine', 'Tractor', 'Helicopter', 'Treehouse', 'Marble', 'Yoyo', 'Teddy']
+WORDS = ['fun', 'kids', 'colorful', 'durable', 'gift', 'ages', 'build', 'play', 'imagination', 'set', 'pieces',
+         'batteries', 'included', 'safe', 'family', 'creative', 'learning', 'adventure', 'collectible', 'bright']
+
+# (label, query, filters)
+QUERIES = [
+    ('rare term', 'submarine arctic', {}),
+    ('common term', 'dinosaur', {}),
+    ('prefix', 'heli', {}),
+    ('brand + noun', 'lego castle', {}),
+    ('filtered', 'robot', {'max_price': 20, 'in_stock': True}),
+    ('typo', 'dinosuar', {}),
+]
+
+
+def seed_products(count):
+    """Bulk insert synthetic products; the FTS5 triggers index them as they go"""
+    rng = random.Random(42)
+    for name in ['Building Sets', 'Vehicles', 'Dolls', 'Games', 'Outdoor']:
+        db.session.add(Category(name=name))
+    db.session.commit()
+    category_ids = [category.id for category in Category.query.all()]
+    start = datetime.utcnow() - timedelta(days=365)
+    batch = []
+    for i in range(count):
+        # Make the 'rare term' pair appear in only a handful of products
+        adjective = rng.choice(ADJECTIVES[:-3]) if i % 5000 else 'Arctic'
+        noun = rng.choice(NOUNS) if i % 5000 else 'Submarine'
+        batch.append({
+            'name': f'{rng.choice(BRANDS)} {adjective} {noun} {i}',
+            'price': round(rng.uniform(3, 150), 2),
+            'description': ' '.join(rng.choices(WORDS, k=20)),
+            'stock': rng.randint(0, 40),
+            'category_id': rng.choice(category_ids),
+            'created_at': start + timedelta(seconds=i),
+            'updated_at': start + timedelta(seconds=i),
+        })
+        if len(batch) == 10000:
+            db.session.execute(db.insert(Product), batch)
+            batch = []
+    if batch:
+        db.session.execute(db.insert(Product), batch)
+    db.session.commit()
+    # Bulk inserts bypass the ORM events that maintain the counts
+    refresh_category_counts()
+
+
+def time_search(query, filters, repeat):
+    """Return sorted search latencies in milliseconds and the number of results"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        page = search.search_products(query, **filters)
+        timings.append((time.perf_counter() - start) * 1000)
+        db.session.expunge_all()
+    return sorted(timings), len(page.products)
+
+
+def percentile(timings, pct):
+    return timings[min(len(timings) - 1, int(round(pct / 100 * (len(timings) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=30)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(tmp, "search.db")}'})
+
+        with app.app_context():
+            print(f'Seeding {args.products} products...')
+            started = time.perf_counter()
+            seed_products(args.products)
+            print(f'Seeded and indexed in {time.perf_counter() - started:.1f} s')
+
+            print(f'\n{"query":<14}{"":<20}{"FTS5 p50":>10}{"p95":>8}{"hits":>6}{"LIKE p50":>11}{"p95":>8}{"hits":>6}')
+            for label, query, filters in QUERIES:
+                search.search_products(query, **filters)  # warm up
+                fts_timings, fts_hits = time_search(query, filters, args.repeat)
+                with mock.patch.object(search, '_uses_fts', return_value=False):
+                    like_timings, like_hits = time_search(query, filters, args.repeat)
+                print(f'{label:<14}{query!r:<20}'
+                      f'{statistics.median(fts_timings):>10.2f}{percentile(fts_timings, 95):>8.2f}{fts_hits:>6}'
+                      f'{statistics.median(like_timings):>11.2f}{percentile(like_timings, 95):>8.2f}{like_hits:>6}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""Stress the SQLite write path with many concurrent writer processes
+
+Generates a synthetic database (benchmarks/synthetic_data.py) and starts
+--writers processes, each with its own app and connection pool like a
+gunicorn worker. Each logs in as its own customer and, for --seconds, adds a
+random product to its cart and checks out (cash on delivery) through the
+real routes. The run is repeated on a fresh copy of the database without the
+write coordinator (pysqlite's deferred transactions and no retries) and with
+it (BEGIN IMMEDIATE, in-process writer lock, SQLITE_BUSY retries).
+
+For each variant it reports requests, failures (5xx responses and "busy"
+flashes) with the error rate, orders per second and p50/p95/p99 checkout
+latency, plus the coordinator's lock waits and retries summed over the
+writers. Orders written must match the checkouts reported as placed.
+
+Usage: python benchmarks/sqlite_writers.py [--writers 50] [--seconds 20] [--output results.json]
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from app.metrics import percentile
+from synthetic_data import create_database, scale_counts
+
+CHECKOUT_FORM = {
+    'full_name': 'Stress Test',
+    'email': 'stress@example.com',
+    'phone': '5550100',
+    'shipping_address': '1 Benchmark Way',
+    'city': 'Wonderland',
+    'state': 'WL',
+    'postal_code': '00000',
+    'payment_method': 'cash_on_delivery',
+}
+VARIANTS = [('deferred, no retries', False), ('write coordinator', True)]
+
+
+def writer(database, coordinated, user_id, product_ids, barrier, seconds, results, seed):
+    """One writer process: add to cart and check out until the time is up"""
+    # 500s are expected without the coordinator; keep their tracebacks out of the report
+    logging.disable(logging.CRITICAL)
+    from app import create_app, db
+
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{database}',
+        'SQLITE_WRITE_COORDINATOR': coordinated,
+        # Confirmation emails stay queued; no job threads competing for the lock
+        'JOB_MODE': 'worker',
+    })
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    rng = random.Random(seed)
+    outcomes = {'placed': 0, 'busy': 0, 'server_error': 0, 'other': 0}
+    cart_failures = 0
+    latencies = []
+
+    barrier.wait()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        response = client.post(f'/cart/add/{rng.choice(product_ids)}', data={'quantity': 1})
+        if response.status_code >= 500 or 'busy' in _flashes(client):
+            cart_failures += 1
+            continue
+        started = time.perf_counter()
+        response = client.post('/checkout', data=CHECKOUT_FORM)
+        latencies.append(time.perf_counter() - started)
+        flashes = _flashes(client)
+        if response.status_code >= 500:
+            outcomes['server_error'] += 1
+        elif response.headers.get('Location', '').endswith('/orders'):
+            outcomes['placed'] += 1
+        elif 'busy' in flashes:
+            outcomes['busy'] += 1
+        else:
+            outcomes['other'] += 1
+
+    writes = app.extensions.get('writes')
+    results.put({
+        'outcomes': outcomes,
+        'cart_failures': cart_failures,
+        'latencies': latencies,
+        'writes': writes.stats.summary() if writes else None,
+        'lock_waits': list(writes.stats.recent_waits) if writes else [],
+    })
+    with app.app_context():
+        db.engine.dispose()
+
+
+def _flashes(client):
+    """Flash messages waiting in the client's session, lowercased"""
+    with client.session_transaction() as session:
+        return ' '.join(message for _, message in session.pop('_flashes', [])).lower()
+
+
+def run_variant(database, coordinated, user_ids, product_ids, seconds):
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(len(user_ids) + 1)
+    results = context.Queue()
+    processes = [context.Process(target=writer, args=(database, coordinated, user_id, product_ids, barrier, seconds,
+                                                      results, n))
+                 for n, user_id in enumerate(user_ids)]
+    for process in processes:
+        process.start()
+    # Every writer has started its app; time from the common start
+    barrier.wait()
+    started = time.perf_counter()
+    reports = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+    return reports, elapsed
+
+
+def summarize(reports, elapsed, database):
+    import sqlite3
+
+    outcomes = {name: sum(report['outcomes'][name] for report in reports) for name in reports[0]['outcomes']}
+    checkouts = sum(outcomes.values())
+    cart_adds = checkouts + sum(report['cart_failures'] for report in reports)
+    failures = outcomes['busy'] + outcomes['server_error'] + sum(report['cart_failures'] for report in reports)
+    latencies = [latency for report in reports for latency in report['latencies']]
+    connection = sqlite3.connect(database)
+    orders = connection.execute("SELECT COUNT(*) FROM orders WHERE email = 'stress@example.com'").fetchone()[0]
+    negative = connection.execute('SELECT COUNT(*) FROM products WHERE stock < 0').fetchone()[0]
+    connection.close()
+
+    summary = {
+        'requests': cart_adds + checkouts,
+        'failures': failures,
+        'error_rate': round(failures / (cart_adds + checkouts), 4) if cart_adds + checkouts else 0,
+        'checkouts': outcomes,
+        'orders_written': orders,
+        'orders_per_second': round(orders / elapsed, 1),
+        'checkout_p50_ms': round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+        'checkout_p95_ms': round(percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+        'checkout_p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        'consistent': orders == outcomes['placed'] and negative == 0,
+    }
+    writes = [report['writes'] for report in reports if report['writes']]
+    if writes:
+        waits = [wait for report in reports for wait in report['lock_waits']]
+        summary['write_transactions'] = sum(stats['transactions'] for stats in writes)
+        summary['busy_retries'] = sum(stats['busy_errors'] for stats in writes)
+        summary['lock_wait_p50_ms'] = round(percentile(waits, 0.50) * 1000, 1) if waits else None
+        summary['lock_wait_p95_ms'] = round(percentile(waits, 0.95) * 1000, 1) if waits else None
+        summary['max_lock_wait_ms'] = max(stats['max_lock_wait_ms'] for stats in writes)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', type=int, default=50, help='concurrent writer processes')
+    parser.add_argument('--seconds', type=float, default=20, help='how long each variant runs')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = {'writers': args.writers, 'seconds': args.seconds, 'variants': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        template = os.path.join(tmp, 'template.db')
+        counts = scale_counts('tiny', users=args.writers, carts=0)
+        app, _, _ = create_database(template, counts)
+        from app import db
+        from app.models import User, Product
+        with app.app_context():
+            user_ids = [user_id for user_id, in db.session.query(User.id).filter(User.is_admin.is_(False))
+                        .order_by(User.id).limit(args.writers)]
+            product_ids = [product_id for product_id, in db.session.query(Product.id).filter(Product.stock > 0)]
+            db.session.execute(db.text('PRAGMA wal_checkpoint(TRUNCATE)'))
+            db.engine.dispose()
+
+        for name, coordinated in VARIANTS:
+            database = os.path.join(tmp, f'{"coordinated" if coordinated else "deferred"}.db')
+            shutil.copy(template, database)
+            reports, elapsed = run_variant(database, coordinated, user_ids, product_ids, args.seconds)
+            results['variants'][name] = summarize(reports, elapsed, database)
+
+    print(f'{args.writers} writer processes, {args.seconds:g}s each variant: add to cart + checkout')
+    print(f'\n{"variant":<24}{"requests":>9}{"failed":>8}{"err %":>7}{"orders/s":>10}{"p50 ms":>9}{"p95 ms":>9}'
+          f'{"p99 ms":>9}{"retries":>9}{"wait p95":>10}')
+    for name, row in results['variants'].items():
+        print(f'{name:<24}{row["requests"]:>9}{row["failures"]:>8}{row["error_rate"] * 100:>7.1f}'
+              f'{row["orders_per_second"]:>10}{row["checkout_p50_ms"]:>9}{row["checkout_p95_ms"]:>9}'
+              f'{row["checkout_p99_ms"]:>9}{row.get("busy_retries", "-"):>9}{row.get("lock_wait_p95_ms", "-"):>10}')
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+        print(f'Results written to {args.output}')
+
+    consistent = all(row['consistent'] for row in results['variants'].values())
+    print('\nOK' if consistent else '\nFAILED: orders written do not match checkouts placed, or stock went negative')
+    return 0 if consistent else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
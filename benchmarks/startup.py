@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""Measure worker startup under gunicorn: time to first response and memory per worker
+
+Starts gunicorn (with gunicorn.conf.py) against a throwaway database in each
+startup mode, polls the homepage until it answers, then warms every worker
+and reads its resident (RSS) and proportional (PSS, shared pages split
+between processes) memory from /proc. Linux only.
+
+Modes:
+  development         full bootstrap in every worker
+  production, lazy    no database bootstrap; models and views load on first request
+  production, preload app loaded once in the master and shared by forked workers
+
+Usage: python benchmarks/startup.py [--workers 4] [--runs 3]
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+MODES = [
+    ('development', {'STARTUP_MODE': 'development', 'GUNICORN_PRELOAD': '0'}),
+    ('production, lazy', {'STARTUP_MODE': 'production', 'LAZY_SETUP': '1', 'GUNICORN_PRELOAD': '0'}),
+    ('production, preload', {'STARTUP_MODE': 'production', 'GUNICORN_PRELOAD': '1'}),
+]
+
+WSGI_MODULE = '''
+import os
+from app import create_app
+app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.environ['BENCHMARK_DB']})
+'''
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def get(url):
+    with urllib.request.urlopen(url, timeout=10) as response:
+        response.read()
+        return response.status
+
+
+def memory_kb(pid):
+    """Return (RSS, PSS) of a process in kB"""
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as smaps:
+        for line in smaps:
+            name, _, rest = line.partition(':')
+            if name in ('Rss', 'Pss'):
+                values[name] = int(rest.split()[0])
+    return values['Rss'], values['Pss']
+
+
+def worker_pids(master_pid):
+    with open(f'/proc/{master_pid}/task/{master_pid}/children') as children:
+        return [int(pid) for pid in children.read().split()]
+
+
+def run_mode(env_overrides, workers, tmp):
+    """Start gunicorn once; return (seconds to first response, [(RSS, PSS) per worker])"""
+    port = free_port()
+    env = {
+        **os.environ,
+        **env_overrides,
+        'GUNICORN_WORKERS': str(workers),
+        'GUNICORN_BIND': f'127.0.0.1:{port}',
+        'BENCHMARK_DB': os.path.join(tmp, 'startup.db'),
+    }
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO_ROOT, 'gunicorn.conf.py'),
+         '--pythonpath', f'{REPO_ROOT},{tmp}', 'startup_wsgi:app'],
+        cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while True:
+            try:
+                if get(f'http://127.0.0.1:{port}/') == 200:
+                    break
+            except OSError:
+                if server.poll() is not None:
+                    raise RuntimeError('gunicorn exited during startup')
+                time.sleep(0.005)
+        first_response = time.perf_counter() - started
+
+        # Make sure every worker has served requests before measuring memory
+        for _ in range(workers * 10):
+            get(f'http://127.0.0.1:{port}/products')
+        return first_response, [memory_kb(pid) for pid in worker_pids(server.pid)]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'startup_wsgi.py'), 'w') as module:
+            module.write(WSGI_MODULE)
+
+        # Create and migrate the database once, as a deploy would
+        from app import create_app
+        create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'startup.db')})
+
+        print(f'{args.workers} workers, median of {args.runs} starts')
+        print(f'{"mode":<22}{"first response ms":>19}{"RSS/worker MB":>15}{"PSS/worker MB":>15}')
+        for label, env_overrides in MODES:
+            firsts, rss, pss = [], [], []
+            for _ in range(args.runs):
+                first_response, memory = run_mode(env_overrides, args.workers, tmp)
+                firsts.append(first_response * 1000)
+                rss.append(statistics.mean(r for r, _ in memory) / 1024)
+                pss.append(statistics.mean(p for _, p in memory) / 1024)
+            print(f'{label:<22}{statistics.median(firsts):>19.0f}'
+                  f'{statistics.median(rss):>15.1f}{statistics.median(pss):>15.1f}')
+
+
+if __name__ == '__main__':
+    main()
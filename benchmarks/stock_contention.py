@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""Stress checkout of one hot product from many threads
+
+Every thread logs in as its own customer and repeatedly adds the hot product
+to its cart and checks out (cash on delivery), asking for more units in total
+than are in stock. Afterwards the units sold must equal the stock consumed
+and never exceed the starting stock. For comparison the old read-modify-write
+decrement (``product.stock -= quantity`` in Python) is run under the same
+contention; it loses updates and sells more units than exist.
+
+Usage: python benchmarks/stock_contention.py [--threads 16] [--stock 200]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db
+from app.models import User, Product, Cart, Order, OrderLine
+
+CHECKOUT_FORM = {
+    'full_name': 'Stress Test',
+    'email': 'stress@example.com',
+    'phone': '5550100',
+    'shipping_address': '1 Benchmark Way',
+    'city': 'Wonderland',
+    'state': 'WL',
+    'postal_code': '00000',
+    'payment_method': 'cash_on_delivery',
+}
+
+
+def create_customers(count):
+    """Create customers with empty carts and return their ids"""
+    user_ids = []
+    for i in range(count):
+        user = User(username=f'stress{i}', email=f'stress{i}@example.com')
+        user.set_password('password')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(Cart(user_id=user.id))
+        user_ids.append(user.id)
+    db.session.commit()
+    return user_ids
+
+
+def run_threads(count, target):
+    """Start count threads running target(index) together; return elapsed seconds"""
+    barrier = threading.Barrier(count)
+
+    def run(index):
+        barrier.wait()
+        target(index)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def stress_checkout(app, product_id, user_ids, attempts):
+    """Check out the hot product through the real routes; return (elapsed, errors)"""
+    errors = []
+
+    def shopper(index):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_ids[index])
+            session['_fresh'] = True
+        for _ in range(attempts):
+            try:
+                client.post(f'/cart/add/{product_id}', data={'quantity': 1})
+                client.post('/checkout', data=CHECKOUT_FORM)
+            except Exception as e:
+                errors.append(e)
+
+    return run_threads(len(user_ids), shopper), errors
+
+
+def stress_legacy(app, product_id, threads, attempts):
+    """Decrement stock the old way, read-modify-write in Python; return (elapsed, units sold)"""
+    sold = []
+
+    def shopper(index):
+        with app.app_context():
+            for _ in range(attempts):
+                product = db.session.get(Product, product_id)
+                if product.stock >= 1:
+                    product.stock -= 1
+                    db.session.commit()
+                    sold.append(1)
+                else:
+                    db.session.rollback()
+                db.session.expire_all()
+
+    return run_threads(threads, shopper), len(sold)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--stock', type=int, default=200)
+    args = parser.parse_args()
+    # Ask for 50% more units than exist
+    attempts = (args.stock * 3 // 2) // args.threads + 1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(tmp, "stock.db")}'})
+
+        with app.app_context():
+            hot = Product(name='Hot Toy', price=9.99, stock=args.stock)
+            legacy = Product(name='Legacy Toy', price=9.99, stock=args.stock)
+            db.session.add_all([hot, legacy])
+            db.session.commit()
+            hot_id, legacy_id = hot.id, legacy.id
+            user_ids = create_customers(args.threads)
+
+        elapsed, errors = stress_checkout(app, hot_id, user_ids, attempts)
+        with app.app_context():
+            remaining = db.session.get(Product, hot_id).stock
+            orders = Order.query.count()
+            units = db.session.query(db.func.coalesce(db.func.sum(OrderLine.quantity), 0)) \
+                .filter(OrderLine.product_id == hot_id).scalar()
+        legacy_elapsed, legacy_sold = stress_legacy(app, legacy_id, args.threads, attempts)
+        with app.app_context():
+            legacy_remaining = db.session.get(Product, legacy_id).stock
+
+    print(f'{args.threads} threads x {attempts} attempts against {args.stock} units in stock')
+    print(f'{"variant":<28}{"sold":>8}{"left":>8}{"oversold":>10}{"seconds":>10}{"per sec":>10}')
+    print(f'{"atomic checkout (routes)":<28}{units:>8}{remaining:>8}{units - (args.stock - remaining):>10}'
+          f'{elapsed:>10.2f}{orders / elapsed:>10.1f}')
+    print(f'{"legacy read-modify-write":<28}{legacy_sold:>8}{legacy_remaining:>8}'
+          f'{legacy_sold - (args.stock - legacy_remaining):>10}{legacy_elapsed:>10.2f}{legacy_sold / legacy_elapsed:>10.1f}')
+    if errors:
+        print(f'{len(errors)} requests raised, e.g. {errors[0]!r}')
+
+    ok = not errors and remaining >= 0 and units == args.stock - remaining and units <= args.stock
+    print('\nOK' if ok else '\nFAILED: stock and units sold disagree')
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""Generate a synthetic store database at a configurable scale
+
+Builds a fresh database (schema from the migrations) and fills it with
+categories, products, users, orders with lines, carts and wishlists using
+Core INSERTs in batches of INSERT_BATCH_SIZE rows, then recomputes the counters and rollups the
+inserts bypassed. The same --seed always produces the same data.
+
+Every generated user, and the admin "bench_admin", has the password
+PASSWORD. Used by benchmarks/journeys.py; run on its own to keep a database
+around, e.g. for a server started by hand:
+
+Usage: python benchmarks/synthetic_data.py instance/bench.db [--scale small] [--orders 20000] [--seed 1]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from werkzeug.security import generate_password_hash
+
+from app import create_app, db
+from app.admin_reports import refresh_user_order_stats
+from app.cache import cache
+from app.catalog import refresh_category_counts
+from app.models import User, Product, Category, Order, OrderLine, Cart, CartItem, Wishlist
+from app.rollups import rebuild_rollups
+
+SCALES = {
+    'tiny': {'users': 50, 'products': 200, 'orders': 500, 'carts': 20, 'wishlists': 100},
+    'small': {'users': 500, 'products': 2000, 'orders': 10000, 'carts': 200, 'wishlists': 1000},
+    'medium': {'users': 5000, 'products': 20000, 'orders': 100000, 'carts': 2000, 'wishlists': 10000},
+    'large': {'users': 50000, 'products': 100000, 'orders': 1000000, 'carts': 20000, 'wishlists': 100000},
+}
+DEFAULT_SCALE = 'small'
+
+PASSWORD = 'benchmark'
+ADMIN_USERNAME = 'bench_admin'
+INSERT_BATCH_SIZE = 10000
+# Orders and accounts are spread over this many days before now
+HISTORY_DAYS = 365
+
+CATEGORIES = ['Lego', 'Plush toys', 'Board games', 'Arts and Crafts', 'Hotwheels',
+              'Action Figures & Collectibles', 'Barbie', 'Puzzles', 'Outdoor play', 'Baby & Toddler']
+ADJECTIVES = ['Deluxe', 'Classic', 'Mini', 'Giant', 'Rainbow', 'Turbo', 'Cosmic', 'Wooden', 'Magnetic', 'Glow']
+NOUNS = ['Castle', 'Racer', 'Dragon', 'Robot', 'Unicorn', 'Train Set', 'Spaceship', 'Teddy Bear', 'Puzzle', 'Dollhouse']
+STATUSES = [(Order.STATUS_DELIVERED, 50), (Order.STATUS_SHIPPED, 15), (Order.STATUS_PROCESSING, 10),
+            (Order.STATUS_PENDING, 15), (Order.STATUS_CANCELLED, 10)]
+PAYMENT_METHODS = [Order.PAYMENT_CARD, Order.PAYMENT_CASH_ON_DELIVERY, Order.PAYMENT_PAYPAL]
+
+
+def scale_counts(scale=DEFAULT_SCALE, **overrides):
+    """Row counts for a named scale, with any of them overridden"""
+    counts = dict(SCALES[scale])
+    counts.update({name: value for name, value in overrides.items() if value is not None})
+    return counts
+
+
+def _insert(table, rows):
+    """Insert rows (an iterable of dicts) in batches of INSERT_BATCH_SIZE"""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == INSERT_BATCH_SIZE:
+            db.session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+    db.session.commit()
+
+
+def generate(counts, seed=1):
+    """Fill the current app's (empty, migrated) database; returns the row counts written"""
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    start = now - timedelta(days=HISTORY_DAYS)
+
+    def moment():
+        return start + timedelta(seconds=rng.randrange(HISTORY_DAYS * 86400))
+
+    _insert(Category.__table__, ({'name': name, 'description': f'{name} for every age', 'created_at': start}
+                                 for name in CATEGORIES))
+    category_ids = [category_id for category_id, in db.session.query(Category.id).order_by(Category.id)]
+
+    # One hash for everyone: hashing is deliberately slow
+    password_hash = generate_password_hash(PASSWORD)
+    _insert(User.__table__, [{'username': ADMIN_USERNAME, 'email': 'bench_admin@example.com',
+                              'password_hash': password_hash, 'is_admin': True, 'created_at': start}])
+    _insert(User.__table__, ({'username': f'bench_user{n}', 'email': f'bench_user{n}@example.com',
+                              'password_hash': password_hash, 'is_admin': False, 'created_at': moment()}
+                             for n in range(counts['users'])))
+    user_ids = [user_id for user_id, in db.session.query(User.id).filter(User.is_admin.is_(False))]
+
+    def products():
+        for n in range(counts['products']):
+            adjective, noun = rng.choice(ADJECTIVES), rng.choice(NOUNS)
+            price = round(rng.uniform(3, 300), 2)
+            yield {
+                'sku': f'BENCH-{n:07d}',
+                'name': f'{adjective} {noun} {n}',
+                'price': price,
+                'description': f'A {adjective.lower()} {noun.lower()} from the synthetic catalog, item {n}.',
+                # About one in ten sold out
+                'stock': 0 if rng.random() < 0.1 else rng.randint(100, 1000),
+                'category_id': rng.choice(category_ids),
+                'is_featured': rng.random() < 0.02,
+                'created_at': moment(),
+            }
+    _insert(Product.__table__, products())
+    product_rows = db.session.query(Product.id, Product.price).order_by(Product.id).all()
+
+    order_statuses = [status for status, _ in STATUSES]
+    status_weights = [weight for _, weight in STATUSES]
+    first_order_id = (db.session.query(db.func.max(Order.id)).scalar() or 0) + 1
+    for offset in range(0, counts['orders'], INSERT_BATCH_SIZE):
+        orders, lines = [], []
+        for n in range(offset, min(offset + INSERT_BATCH_SIZE, counts['orders'])):
+            order_id = first_order_id + n
+            total = 0.0
+            for product_id, price in rng.sample(product_rows, min(len(product_rows), rng.randint(1, 4))):
+                quantity = rng.randint(1, 3)
+                lines.append({'order_id': order_id, 'product_id': product_id, 'quantity': quantity,
+                              'unit_price': price, 'discount_amount': 0, 'total_price': round(price * quantity, 2)})
+                total += price * quantity
+            status = rng.choices(order_statuses, status_weights)[0]
+            created_at = moment()
+            orders.append({
+                'id': order_id,
+                'user_id': rng.choice(user_ids),
+                'total_price': round(total, 2),
+                'status': status,
+                'full_name': 'Synthetic Customer',
+                'email': 'customer@example.com',
+                'phone': '5550100',
+                'shipping_address': f'{n} Benchmark Way',
+                'city': 'Wonderland',
+                'state': 'WL',
+                'postal_code': f'{n % 100000:05d}',
+                'payment_method': rng.choice(PAYMENT_METHODS),
+                'payment_status': Order.PAYMENT_FAILED if status == Order.STATUS_CANCELLED else Order.PAYMENT_COMPLETED,
+                'tracking_number': f'BENCH{order_id:010d}',
+                'created_at': created_at,
+                'updated_at': created_at,
+            })
+        db.session.execute(Order.__table__.insert(), orders)
+        db.session.execute(OrderLine.__table__.insert(), lines)
+        db.session.commit()
+
+    cart_users = rng.sample(user_ids, min(counts['carts'], len(user_ids)))
+    _insert(Cart.__table__, ({'user_id': user_id, 'created_at': now, 'updated_at': now} for user_id in cart_users))
+    cart_ids = [cart_id for cart_id, in db.session.query(Cart.id)]
+    _insert(CartItem.__table__, ({'cart_id': cart_id, 'product_id': product_id, 'quantity': 1, 'added_at': now}
+                                 for cart_id in cart_ids
+                                 for product_id, _ in rng.sample(product_rows, min(len(product_rows), rng.randint(1, 5)))))
+
+    wishlist = set()
+    while len(wishlist) < min(counts['wishlists'], len(user_ids) * len(product_rows)):
+        wishlist.add((rng.choice(user_ids), rng.choice(product_rows)[0]))
+    _insert(Wishlist.__table__, ({'user_id': user_id, 'product_id': product_id, 'added_at': now}
+                                 for user_id, product_id in sorted(wishlist)))
+
+    # Counters, category counts and rollups are normally kept up by mapper events
+    refresh_category_counts()
+    refresh_user_order_stats()
+    rebuild_rollups()
+    cache.invalidate('categories', 'products', 'catalog', 'pages', 'fragments', 'facets')
+    return {
+        'categories': len(category_ids),
+        'users': len(user_ids),
+        'products': len(product_rows),
+        'orders': counts['orders'],
+        'carts': len(cart_ids),
+        'wishlists': len(wishlist),
+    }
+
+
+def create_database(path, counts, seed=1):
+    """Create a new SQLite database file at path and fill it; returns (app, row counts, seconds)"""
+    app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}'})
+    started = time.perf_counter()
+    with app.app_context():
+        written = generate(counts, seed)
+    return app, written, time.perf_counter() - started
+
+
+def add_scale_arguments(parser):
+    parser.add_argument('--scale', choices=sorted(SCALES), default=DEFAULT_SCALE, help='dataset size preset')
+    for name in SCALES[DEFAULT_SCALE]:
+        parser.add_argument(f'--{name}', type=int, help=f'override the number of {name}')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+
+
+def counts_from_args(args):
+    return scale_counts(args.scale, **{name: getattr(args, name) for name in SCALES[DEFAULT_SCALE]})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database', help='path of the SQLite database to create')
+    add_scale_arguments(parser)
+    args = parser.parse_args()
+
+    if os.path.exists(args.database):
+        sys.exit(f'{args.database} already exists')
+    _, written, elapsed = create_database(os.path.abspath(args.database), counts_from_args(args), args.seed)
+    print(', '.join(f'{count} {name}' for name, count in written.items()) + f' in {elapsed:.1f}s')
+    print(f'Log in as {ADMIN_USERNAME} or bench_user0..{written["users"] - 1} with password "{PASSWORD}"')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""Measure admin image upload latency as the uploaded image grows
+
+Copies the checked-in database and product images to a throwaway directory
+and uploads generated JPEGs of increasing size through the admin edit-product
+form. The upload request only stores the original and queues a job, so its
+time should stay flat; the "inline" column adds the time the variant
+encoding takes, which is what each request used to wait for. Jobs are run
+afterwards (as `flask run-worker` would) to check they all succeed.
+
+Usage: python benchmarks/upload_latency.py [--repeat 3]
+"""
+import argparse
+import io
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from PIL import Image
+
+from app import create_app, db
+from app.images import images_folder, process_image
+from app.jobs import run_pending_jobs
+from app.models import User, Product, Job
+
+SIZES = [400, 1200, 2400, 4000]
+
+
+def jpeg(size, seed):
+    """A noisy (so poorly compressible) JPEG of size x size pixels"""
+    image = Image.effect_noise((size, size), 40 + seed).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3, help='uploads per image size')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy(os.path.join(REPO_ROOT, 'instance', 'store.db'), os.path.join(tmp, 'store.db'))
+        static_folder = os.path.join(tmp, 'static')
+        shutil.copytree(os.path.join(REPO_ROOT, 'app', 'static'), static_folder)
+        # Leave the jobs queued so the request timings do not share the CPU with them
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(tmp, "store.db")}',
+                          'JOB_MODE': 'worker'})
+        app.static_folder = static_folder
+        with app.app_context():
+            admin_id = User.query.filter_by(is_admin=True).first().id
+            product = Product.query.order_by(Product.id).first()
+            form = {'name': product.name, 'price': str(product.price), 'description': product.description or '',
+                    'stock': str(product.stock), 'category_id': str(product.category_id)}
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(admin_id)
+            session['_fresh'] = True
+
+        print(f'{"pixels":>8}{"upload KB":>11}{"request ms":>12}{"encode ms":>11}{"inline ms":>11}')
+        for size in SIZES:
+            request_times, encode_times, upload_size = [], [], 0
+            for seed in range(args.repeat):
+                data = jpeg(size, seed)
+                upload_size = len(data)
+                start = time.perf_counter()
+                response = client.post(f'/admin/products/edit/{product.id}', data={
+                    **form, 'image': (io.BytesIO(data), 'upload.jpg')}, content_type='multipart/form-data')
+                request_times.append((time.perf_counter() - start) * 1000)
+                assert response.status_code == 302, response.status_code
+                # What the same request spent encoding variants before they moved to a job
+                with app.app_context():
+                    folder = os.path.join(tmp, 'inline')
+                    start = time.perf_counter()
+                    process_image(data, folder)
+                    encode_times.append((time.perf_counter() - start) * 1000)
+            request_ms = statistics.median(request_times)
+            encode_ms = statistics.median(encode_times)
+            print(f'{size:>8}{upload_size / 1024:>11.0f}{request_ms:>12.1f}{encode_ms:>11.1f}{request_ms + encode_ms:>11.1f}')
+
+        with app.app_context():
+            start = time.perf_counter()
+            ran = run_pending_jobs()
+            elapsed = time.perf_counter() - start
+            counts = dict(db.session.query(Job.status, db.func.count(Job.id)).group_by(Job.status).all())
+            product = db.session.get(Product, product.id)
+            processed = bool(product.image_variants) and os.path.exists(
+                os.path.join(images_folder(), product.image_variants['variants']['card']['files']['jpeg']))
+        print(f'Ran {ran} queued jobs in {elapsed:.1f}s: {counts}; latest upload processed: {processed}')
+
+
+if __name__ == '__main__':
+    main()
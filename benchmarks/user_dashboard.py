@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""Micro-benchmark the customer dashboard statistics
+
+Compares the original per-request queries of dashboard() (recent orders,
+wishlist count, total spent, order count, plus lazy loads of each recent
+order's lines and products) with the cached two-statement stats service, reporting
+SQL statements and latency for each.
+
+Usage: python benchmarks/user_dashboard.py [--orders 2000] [--repeat 200]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event
+
+from app import create_app, db
+from app.models import User, Product, Order, OrderLine, Wishlist
+from app.user_stats import get_user_stats, invalidate_user_stats
+
+
+def legacy_dashboard_data(user_id):
+    """The queries dashboard() ran before the stats service"""
+    user_orders = Order.query.filter_by(user_id=user_id).order_by(Order.created_at.desc()).limit(5).all()
+    wishlist_count = Wishlist.query.filter_by(user_id=user_id).count()
+    total_spent = db.session.query(db.func.sum(Order.total_price)).filter_by(user_id=user_id).scalar() or 0
+    orders_count = Order.query.filter_by(user_id=user_id).count()
+    product_names = [line.product.name for order in user_orders for line in order.lines]
+    return user_orders, wishlist_count, total_spent, orders_count, product_names
+
+
+def cold_stats(user_id):
+    invalidate_user_stats(user_id)
+    return get_user_stats(user_id)
+
+
+def measure(engine, func, user_id, repeat):
+    """Return (statements per call, p50 ms, p95 ms)"""
+    statements = []
+
+    def count(*args):
+        statements.append(args[2])
+
+    timings = []
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        for _ in range(repeat):
+            statements.clear()
+            # Start from an empty identity map, as a new request would
+            db.session.expunge_all()
+            start = time.perf_counter()
+            func(user_id)
+            timings.append((time.perf_counter() - start) * 1000)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    timings.sort()
+    return len(statements), statistics.median(timings), timings[int(0.95 * (len(timings) - 1))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(tmp, "dashboard.db")}'})
+        with app.app_context():
+            user = User(username='benchmark', email='benchmark@example.com')
+            user.set_password('password')
+            db.session.add(user)
+            db.session.flush()
+            products = [Product(name=f'Toy {i}', price=10 + i, stock=100) for i in range(20)]
+            db.session.add_all(products)
+            db.session.flush()
+            db.session.execute(db.insert(Order), [
+                {'id': i + 1, 'user_id': user.id, 'total_price': 10.0, 'status': 'pending'}
+                for i in range(args.orders)
+            ])
+            db.session.execute(db.insert(OrderLine), [
+                {'order_id': i + 1, 'product_id': products[i % 20].id, 'quantity': 1, 'unit_price': 10.0, 'total_price': 10.0}
+                for i in range(args.orders)
+            ])
+            db.session.add_all([Wishlist(user_id=user.id, product_id=product.id) for product in products[:10]])
+            db.session.commit()
+            user_id = user.id
+
+            print(f'{"variant":<24} {"queries":>8} {"p50 ms":>9} {"p95 ms":>9}')
+            for name, func in [
+                ('before (4 queries + N)', legacy_dashboard_data),
+                ('after, cache miss', cold_stats),
+                ('after, cache hit', get_user_stats),
+            ]:
+                queries, p50, p95 = measure(db.engine, func, user_id, args.repeat)
+                print(f'{name:<24} {queries:>8} {p50:>9.3f} {p95:>9.3f}')
+
+
+if __name__ == '__main__':
+    main()
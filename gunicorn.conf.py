@@ -0,0 +1,21 @@
+"""Gunicorn configuration for production
+
+    gunicorn -c gunicorn.conf.py app.app:app
+
+Run `flask upgrade-schema` before starting; in production mode the app does
+not touch the database at startup.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+
+os.environ.setdefault('STARTUP_MODE', 'production')
+
+# Load the app once in the master so workers share its memory copy-on-write.
+# Models and views are then imported up front instead of on the first request;
+# each worker drops the inherited database connections after the fork.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+if preload_app:
+    os.environ.setdefault('LAZY_SETUP', '0')
@@ -9,8 +9,14 @@ mkdir -p /app/app/static/images/products
 chmod 777 /app/app/static/images
 chmod 777 /app/app/static/images/products
 
+echo "🗄️ Applying database migrations..."
+flask upgrade-schema
+
 echo "🌱 Seeding database..."
 python seed_data.py
 
+echo "🖼️ Generating product image variants..."
+flask process-images
+
 echo "🚀 Starting Flask application..."
 python run.py